@@ -1,5 +1,7 @@
 import pandas as pd
 import os
+import sys
+import glob
 
 # Specify your directory path
 directory = "C:\\Users\\Pc\\Downloads\\pyScrcClient-master\\pyScrcClient-master\\logs"
@@ -16,7 +18,18 @@ for filename in os.listdir(directory):
         all_dataframes.append(df)
 
 # Concatenate all dataframes
-combined_df = pd.concat(all_dataframes, ignore_index=True)
+if all_dataframes:
+    combined_df = pd.concat(all_dataframes, ignore_index=True)
 
-# Save to a new CSV file
-combined_df.to_csv('combined_output.csv', index=False)
\ No newline at end of file
+    # Save to a new CSV file
+    combined_df.to_csv('combined_output.csv', index=False)
+
+# Binary sessions (pyclient.py --telemetry binary) are memory-mapped and
+# concatenated directly, no text parsing involved
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import telemetry
+
+if glob.glob(os.path.join(directory, '*.tlm')):
+    records = telemetry.load_sessions(directory)
+    telemetry.write_session('combined_output.tlm', records)
+    print(f"Merged {len(records)} binary telemetry records into combined_output.tlm")
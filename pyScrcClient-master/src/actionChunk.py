@@ -0,0 +1,125 @@
+'''
+Action chunks: a model whose output is the next k actions (accel, brake,
+clutch, steer for ticks t, t+1, ..., t+k-1) instead of one, so the driver can
+send a command every tick while running the network only every few ticks.
+
+chunkExport.py builds the training windows from telemetry logs and fits the
+chunk head; ChunkScheduler plays the chunks in the Driver.
+'''
+import numpy as np
+import mlpModel
+
+# Model outputs per action, in apply_predictions order
+ACTION_WIDTH = 4
+# Export the driver runs in chunk mode, the backend adds the extension
+CHUNK_STEM = 'model_driver_chunk'
+
+
+class ChunkScheduler(object):
+    '''
+    Emits one action of the current chunk per tick and runs the model every stride
+    ticks. A new chunk is crossfaded in over blend ticks from what is left of the
+    old one, so the commands do not jump when the plan changes.
+    '''
+
+    def __init__(self, stride=3, blend=2):
+        '''Constructor, stride is the number of ticks between forward passes'''
+        if stride < 1 or blend < 0:
+            raise ValueError('stride must be at least 1 and blend not negative')
+        self.stride = stride
+        self.blend = blend
+        self.actions = None    # (k, ACTION_WIDTH) actions being played
+        self.position = 0      # index of the next action to play
+        self.chunks = 0        # forward passes
+        self.ticks = 0
+
+    def check(self, outputs):
+        '''Raise unless a model with this many outputs gives chunks of at least stride actions'''
+        if outputs % ACTION_WIDTH or outputs // ACTION_WIDTH < self.stride:
+            raise ValueError('A model with %d outputs does not give chunks of %d or more actions'
+                             % (outputs, self.stride))
+
+    def reset(self):
+        '''Drop the current chunk, e.g. after the driver was in manual mode'''
+        self.actions = None
+
+    def due(self):
+        return self.actions is None or self.position >= self.stride or self.position >= len(self.actions)
+
+    def step(self, run_model, row):
+        '''The action for this tick, running the model on row when a new chunk is due'''
+        if self.due():
+            self.start(np.asarray(run_model(row), dtype=np.float32).reshape(-1, ACTION_WIDTH))
+        action = self.actions[self.position]
+        self.position += 1
+        self.ticks += 1
+        return action
+
+    def start(self, chunk):
+        old, position = self.actions, self.position
+        self.actions = chunk.copy()  # the model may reuse its output row
+        self.position = 0
+        self.chunks += 1
+        if old is None:
+            return
+        # Crossfade: weight of the new chunk goes 1/(blend+1), 2/(blend+1), ... 1
+        overlap = min(self.blend, len(old) - position, len(chunk))
+        if overlap > 0:
+            weights = (np.arange(1, overlap + 1, dtype=np.float32) / (self.blend + 1))[:, None]
+            self.actions[:overlap] = weights * chunk[:overlap] + (1 - weights) * old[position:position + overlap]
+
+    def report(self):
+        per_chunk = self.ticks / self.chunks if self.chunks else 0.0
+        return f"Action chunks: {self.chunks} forward passes for {self.ticks} ticks ({per_chunk:.2f} ticks each)"
+
+
+def segments(times, max_gap):
+    '''(start, end) index ranges of the logs between pauses longer than max_gap seconds
+    (and where time goes back: the next file starts)'''
+    gaps = np.diff(times)
+    breaks = np.flatnonzero((gaps > max_gap) | (gaps <= 0)) + 1
+    bounds = np.concatenate([[0], breaks, [len(times)]])
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b - a > 1]
+
+
+def target_windows(records, actions, k, tick=0.02, max_gap=0.5):
+    '''(row indices, (n, k, ACTION_WIDTH) targets): for each telemetry row, the actions
+    at its time and the k - 1 ticks after it, interpolated from actions ((rows, ACTION_WIDTH),
+    one per record). The logs need not be written every tick (pyclient.py drives every
+    third step); rows whose window runs past a pause or the end of the log are left out.'''
+    times = np.asarray(records['timestamp'], dtype=np.float64)
+    offsets = np.arange(k) * tick
+    indices, targets = [], []
+    for start, end in segments(times, max_gap):
+        t = times[start:end]
+        rows = np.flatnonzero(t + offsets[-1] <= t[-1])
+        if not len(rows):
+            continue
+        at = t[rows, None] + offsets  # (rows, k) target times
+        window = np.empty((len(rows), k, ACTION_WIDTH), dtype=np.float32)
+        for j in range(ACTION_WIDTH):
+            window[:, :, j] = np.interp(at, t, actions[start:end, j])
+        indices.append(rows + start)
+        targets.append(window)
+    if not indices:
+        return np.empty(0, dtype=np.int64), np.empty((0, k, ACTION_WIDTH), dtype=np.float32)
+    return np.concatenate(indices), np.concatenate(targets)
+
+
+def fit_head(mlp, x, y, drop_layers=0, l2=1e-3):
+    '''A copy of mlp whose output layer is replaced by a linear head with y.shape[1]
+    outputs, fitted to y by ridge regression on the last kept hidden layer. drop_layers
+    also removes that many hidden layers below the old output layer.'''
+    keep = len(mlp.kernels) - 1 - drop_layers
+    if keep < 0:
+        raise ValueError('The network has only %d hidden layers' % (len(mlp.kernels) - 1))
+    h = np.asarray(x, dtype=np.float32)
+    if keep:
+        h = mlpModel.NumpyMLP(mlp.kernels[:keep], mlp.biases[:keep], mlp.activations[:keep],
+                              mlp.raw_input).predict(h)
+    h = np.hstack([h.astype(np.float64), np.ones((len(h), 1))])
+    penalty = l2 * len(h) * np.eye(h.shape[1])
+    penalty[-1, -1] = 0.0  # the bias is not penalized
+    weights = np.linalg.solve(h.T @ h + penalty, h.T @ np.asarray(y, dtype=np.float64))
+    return mlpModel.NumpyMLP(mlp.kernels[:keep] + [weights[:-1]], mlp.biases[:keep] + [weights[-1]],
+                             mlp.activations[:keep] + ['linear'], mlp.raw_input)
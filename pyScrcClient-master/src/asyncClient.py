@@ -0,0 +1,234 @@
+'''
+asyncio client for the TORCS SCRC server, an alternative to pyclient.py built on
+the same Driver contract (init/drive/onShutDown/onRestart).
+
+Every sensor datagram is timestamped when it arrives and the reply is sent
+within a response budget measured from that moment. drive() runs on a worker
+thread; if it has not finished when the budget runs out, the last action is
+sent instead and the tick is counted as a deadline miss.
+
+    python asyncClient.py --port 3001 --backend numpy --budget 8
+'''
+import time
+start_time = time.perf_counter()
+import sys
+import asyncio
+import argparse
+import concurrent.futures
+import udpLink
+import udpCapture
+import clientLog
+import clientOptions
+import_time = time.perf_counter() - start_time
+
+
+class DriverProtocol(asyncio.DatagramProtocol):
+    '''
+    Hands every datagram to the AsyncClient together with its arrival time
+    '''
+
+    def __init__(self, client):
+        '''Constructor'''
+        self.client = client
+
+    def connection_made(self, transport):
+        self.client.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.client.on_datagram(data, time.perf_counter())
+
+    def error_received(self, exc):
+        print("Socket error:", exc)
+
+
+class AsyncClient(object):
+    '''
+    Runs a Driver against the server on one event loop, replying to each sensor
+    message before its deadline
+    '''
+
+    def __init__(self, driver, host='localhost', port=3001, bot_id='SCR', budget=0.008,
+                 max_steps=0, max_episodes=1, capture=None):
+        '''Constructor, budget is the time in seconds from packet arrival to reply,
+        capture an optional udpCapture.CaptureWriter'''
+        self.driver = driver
+        self.address = (host, port)
+        self.bot_id = bot_id
+        self.budget = budget
+        self.max_steps = max_steps or 1000000
+        self.max_episodes = max_episodes
+        self.transport = None
+        self.capture = capture
+        self.packets = None
+        self.identified = None
+        # A single worker keeps drive() calls in order, the Driver is not thread-safe
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='drive')
+        self.inflight = None      # drive() future still running past its deadline
+        self.last_action = None   # last control message, resent on a miss
+
+        self.ticks = 0            # sensor messages answered
+        self.misses = 0           # replies that fell back to the last action
+        self.busy_ticks = 0       # misses because the previous drive() was still running
+        self.skipped = 0          # stale sensor frames dropped for a newer one
+        self.total_response = 0.0
+        self.max_response = 0.0
+
+    def on_datagram(self, data, arrival):
+        if self.capture:
+            self.capture.write(udpCapture.INBOUND, data)
+        if not self.identified.is_set():
+            if b'***identified***' in data:
+                self.identified.set()
+            return
+        self.packets.put_nowait((data, arrival))
+
+    def send(self, msg, direction=udpCapture.OUTBOUND):
+        self.transport.sendto(msg.encode('utf-8'))
+        if self.capture:
+            self.capture.write(direction, msg)
+
+    async def handshake(self):
+        '''Send the id and init string until the server identifies us'''
+        self.identified = asyncio.Event()
+        self.packets = asyncio.Queue()
+        while True:
+            print('Sending id to server: ', self.bot_id)
+            self.send(self.bot_id + self.driver.init(), udpCapture.INIT)
+            try:
+                await asyncio.wait_for(self.identified.wait(), 1.0)
+            except asyncio.TimeoutError:
+                continue
+            if 'handshake' not in self.driver.startup_times:
+                self.driver.startup_times['handshake'] = time.perf_counter() - start_time
+            return
+
+    def finish_late(self, future):
+        '''A late drive() result is still the newest action, keep it for the next miss'''
+        if not future.cancelled() and future.exception() is None and future.result():
+            self.last_action = future.result()
+
+    async def tick(self, data, arrival):
+        '''Drive on one sensor message and send the reply before arrival + budget'''
+        loop = asyncio.get_running_loop()
+        if self.inflight is not None and not self.inflight.done():
+            msg = None
+            self.busy_ticks += 1
+        else:
+            # The tick is timed from the datagram's arrival, like in pyclient.py
+            self.driver.stats.start(int(arrival * 1e9))
+            self.driver.stats.mark('receive')
+            self.inflight = loop.run_in_executor(self.executor, self.driver.drive, data)
+            remaining = self.budget - (time.perf_counter() - arrival)
+            try:
+                msg = await asyncio.wait_for(asyncio.shield(self.inflight), max(remaining, 0.0))
+            except asyncio.TimeoutError:
+                msg = None
+                self.inflight.add_done_callback(self.finish_late)
+
+        if msg is None:
+            self.misses += 1
+            msg = self.last_action
+        else:
+            self.last_action = msg
+        if msg:
+            self.send(msg)
+        self.driver.stats.mark('send')
+        self.driver.stats.finish()  # on a miss the tick ends with the resent action
+
+        response = time.perf_counter() - arrival
+        self.ticks += 1
+        self.total_response += response
+        self.max_response = max(self.max_response, response)
+        if 'first_command' not in self.driver.startup_times and self.driver.model_ready.is_set():
+            self.driver.startup_times['first_command'] = time.perf_counter() - start_time
+
+    async def episode(self):
+        '''Run one episode, True when the server shut down'''
+        await self.handshake()
+        self.last_action = self.driver.control.toMsg()
+        for step in range(self.max_steps, 0, -1):
+            try:
+                data, arrival = await asyncio.wait_for(self.packets.get(), 1.0)
+            except asyncio.TimeoutError:
+                print("Didn't get response from server")
+                continue
+            # Only answer the newest frame; a restart/shutdown stops the drain
+            while not udpLink.is_control(data) and not self.packets.empty():
+                data, arrival = self.packets.get_nowait()
+                self.skipped += 1
+
+            if b'***shutdown***' in data:
+                await self.wait_inflight()
+                self.driver.onShutDown()
+                print('Client Shutdown')
+                return True
+
+            if b'***restart***' in data:
+                await self.wait_inflight()
+                self.driver.onRestart()
+                print('Client Restart')
+                return False
+
+            await self.tick(data, arrival)
+
+        self.send('(meta 1)')
+        return False
+
+    async def wait_inflight(self):
+        if self.inflight is not None:
+            await asyncio.wait([self.inflight])
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: DriverProtocol(self), remote_addr=self.address)
+        try:
+            episodes = 0
+            while True:
+                shutdown = await self.episode()
+                episodes += 1
+                if shutdown or episodes == self.max_episodes:
+                    break
+        finally:
+            self.transport.close()
+            self.executor.shutdown(wait=True)
+        self.print_report()
+
+    def print_report(self):
+        print('Ticks answered:', self.ticks)
+        if self.ticks:
+            print(f'Response time: mean {self.total_response / self.ticks * 1000:.2f} ms, '
+                  f'max {self.max_response * 1000:.2f} ms (budget {self.budget * 1000:.1f} ms)')
+            print(f'Deadline misses (last action resent): {self.misses} '
+                  f'({self.busy_ticks} while the previous drive was still running)')
+        print('Stale sensor frames skipped:', self.skipped)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='asyncio client to connect to the TORCS SCRC server.')
+    clientOptions.add_session_options(parser)
+    clientOptions.add_model_options(parser)
+    clientOptions.add_single_car_options(parser)
+    # The server waits about 10 ms for a reply before it moves on
+    parser.add_argument('--budget', action='store', type=float, dest='budget', default=8.0,
+                        help='Milliseconds from packet arrival to reply (default: 8)')
+    arguments = parser.parse_args(argv)
+    clientLog.setup(arguments.log_level)
+
+    driver_start = time.perf_counter()
+    d = clientOptions.create_driver(arguments)
+    d.startup_times['imports'] = import_time
+    d.startup_times['driver_init'] = time.perf_counter() - driver_start
+
+    client = AsyncClient(d, arguments.host_ip, arguments.host_port, arguments.id,
+                         budget=arguments.budget / 1000.0, max_steps=arguments.max_steps,
+                         max_episodes=arguments.max_episodes,
+                         capture=udpCapture.CaptureWriter(arguments.capture) if arguments.capture else None)
+    asyncio.run(client.run())
+    if client.capture:
+        client.capture.close()
+        print(f'Captured {client.capture.count} datagrams to {client.capture.filename}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
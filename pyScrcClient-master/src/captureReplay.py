@@ -0,0 +1,133 @@
+'''
+Feed a session recorded with pyclient.py --capture back into Driver.drive, at
+the recorded pace, N times faster or as fast as possible, and time the whole
+decode -> features -> inference -> encode path of every tick.
+
+With --compare-backend / --compare-model-dir a second driver gets the same
+inputs and the two are compared tick by tick; otherwise the replies are
+compared with the ones recorded in the capture.
+
+    python captureReplay.py session.cap --speed 0 --backend numpy
+    python captureReplay.py session.cap --speed 4 --backend tflite --compare-backend numpy
+'''
+import sys
+import time
+import argparse
+import numpy as np
+import msgParser
+import udpCapture
+import inferenceBackend
+import driver
+
+# Control values compared between replies
+OUTPUTS = ('accel', 'brake', 'clutch', 'steer', 'gear')
+
+
+def sensor_ticks(records):
+    '''(seconds, sensor message, recorded reply or None) for every inbound sensor message'''
+    ticks = []
+    for timestamp, direction, data in records:
+        if direction == udpCapture.INBOUND:
+            if data.startswith(b'***'):
+                continue  # ***identified***, ***restart***, ***shutdown***
+            ticks.append([timestamp, data, None])
+        elif direction == udpCapture.OUTBOUND and ticks and ticks[-1][2] is None:
+            ticks[-1][2] = data.decode('utf-8')
+    return ticks
+
+
+def control_values(parser, msg):
+    '''OUTPUTS of a control message as floats (NaN when missing)'''
+    actions = parser.parse(msg) or {}
+    return [float(actions[name][0]) if name in actions else np.nan for name in OUTPUTS]
+
+
+def replay(ticks, drivers, speed=1.0):
+    '''Drive every driver on every tick; returns (replies per driver, drive() seconds per driver)'''
+    replies = [[] for d in drivers]
+    times = [np.zeros(len(ticks)) for d in drivers]
+    start = time.perf_counter()
+    first = ticks[0][0] if ticks else 0.0
+    for i, (timestamp, data, recorded) in enumerate(ticks):
+        if speed:
+            delay = start + (timestamp - first) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        for d, out, elapsed in zip(drivers, replies, times):
+            t = time.perf_counter()
+            out.append(d.drive(data))
+            elapsed[i] = time.perf_counter() - t
+    return replies, times
+
+
+def print_latency(name, seconds):
+    ms = seconds * 1000
+    print(f'{name}: drive() p50 {np.percentile(ms, 50):.3f} ms, p99 {np.percentile(ms, 99):.3f} ms, '
+          f'max {ms.max():.3f} ms over {len(ms)} ticks')
+
+
+def print_comparison(name, a, b):
+    '''Per-output max/mean absolute difference between two (ticks, OUTPUTS) arrays'''
+    valid = ~(np.isnan(a).any(axis=1) | np.isnan(b).any(axis=1))
+    print(f'{name} ({valid.sum()} ticks):')
+    diff = np.abs(a[valid] - b[valid])
+    for i, output in enumerate(OUTPUTS):
+        if diff.size:
+            print(f'  {output:6s} max {diff[:, i].max():.6f}  mean {diff[:, i].mean():.6f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a captured session into Driver.drive.')
+    parser.add_argument('capture', help='Capture file written with --capture')
+    parser.add_argument('--speed', action='store', type=float, dest='speed', default=1.0,
+                        help='1 for the recorded pace, N for N times faster, 0 for as fast as possible (default: 1)')
+    parser.add_argument('--backend', action='store', dest='backend', default='tflite',
+                        choices=inferenceBackend.CHOICES, help='Inference backend, auto picks the fastest on this host (default: tflite)')
+    parser.add_argument('--raw-input', action='store_true', dest='raw_input',
+                        help='Use the model exported with the scaler folded in')
+    parser.add_argument('--model-dir', action='store', dest='model_dir', default=None,
+                        help='Models directory (default: ../models)')
+    parser.add_argument('--threads', action='store', type=int, dest='threads', default=None,
+                        help='TFLite interpreter threads (default: the runtime\'s choice)')
+    parser.add_argument('--compare-backend', action='store', dest='compare_backend', default=None,
+                        choices=inferenceBackend.CHOICES, help='Backend of a second driver to compare against')
+    parser.add_argument('--compare-raw-input', action='store_true', dest='compare_raw_input',
+                        help='Second driver uses the scaler-folded model')
+    parser.add_argument('--compare-model-dir', action='store', dest='compare_model_dir', default=None,
+                        help='Models directory of a second driver to compare against')
+    arguments = parser.parse_args(argv)
+
+    ticks = sensor_ticks(udpCapture.read_capture(arguments.capture))
+    if not ticks:
+        print('No sensor messages in', arguments.capture)
+        return 1
+    print(f'{len(ticks)} sensor messages over {ticks[-1][0] - ticks[0][0]:.1f} s')
+
+    drivers = [driver.Driver(3, arguments.backend, raw_input=arguments.raw_input, headless=True,
+                             model_dir=arguments.model_dir, num_threads=arguments.threads, car=0)]
+    compare = (arguments.compare_backend or arguments.compare_model_dir or arguments.compare_raw_input)
+    if compare:
+        drivers.append(driver.Driver(3, arguments.compare_backend or arguments.backend,
+                                     raw_input=arguments.compare_raw_input, headless=True,
+                                     model_dir=arguments.compare_model_dir, num_threads=arguments.threads,
+                                     car=1))
+
+    replies, times = replay(ticks, drivers, arguments.speed)
+    for d in drivers:
+        d.onShutDown()
+
+    msg_parser = msgParser.MsgParser()
+    values = [np.array([control_values(msg_parser, r) for r in out]) for out in replies]
+    print_latency('Driver', times[0])
+    if compare:
+        print_latency('Compared driver', times[1])
+        print_comparison('Driver vs compared driver', values[0], values[1])
+    else:
+        recorded = np.array([control_values(msg_parser, t[2]) if t[2] else [np.nan] * len(OUTPUTS)
+                             for t in ticks])
+        print_comparison('Driver vs recorded replies', values[0], recorded)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -53,6 +53,30 @@ class CarState(object):
         self.setWheelSpinVelD()
         self.setZD()
     
+    def setFromDecoder(self, decoder):
+        '''Fill the state from a SensorDecoder that has already decoded this tick'''
+        self.sensors = None
+        
+        self.angle = decoder.getFloat('angle')
+        self.curLapTime = decoder.getFloat('curLapTime')
+        self.damage = decoder.getFloat('damage')
+        self.distFromStart = decoder.getFloat('distFromStart')
+        self.distRaced = decoder.getFloat('distRaced')
+        self.focus = decoder.getList('focus')
+        self.fuel = decoder.getFloat('fuel')
+        self.gear = decoder.getInt('gear')
+        self.lastLapTime = decoder.getFloat('lastLapTime')
+        self.opponents = decoder.getList('opponents')
+        self.racePos = decoder.getInt('racePos')
+        self.rpm = decoder.getFloat('rpm')
+        self.speedX = decoder.getFloat('speedX')
+        self.speedY = decoder.getFloat('speedY')
+        self.speedZ = decoder.getFloat('speedZ')
+        self.track = decoder.getList('track')
+        self.trackPos = decoder.getFloat('trackPos')
+        self.wheelSpinVel = decoder.getList('wheelSpinVel')
+        self.z = decoder.getFloat('z')
+    
     def toMsg(self):
         self.sensors = {}
         
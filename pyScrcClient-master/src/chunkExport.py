@@ -0,0 +1,109 @@
+'''
+Action-chunk export: replaces the driver model's output layer with a head that
+predicts the next k actions, fitted on windows of recorded telemetry, so
+Driver(action_chunk=True) runs the network every few ticks and still sends a
+command on every tick (see actionChunk.ChunkScheduler).
+
+    python chunkExport.py ../models/model_driver.npz ../models/model_driver_chunk.npz \\
+        --logs ../logs --chunk 6 --tick-ms 20
+
+The targets for a row are the logged accel, brake, clutch and steer at its
+time and the k - 1 ticks after it. Sessions recorded before clutch was logged
+use the float model's clutch output on the logged states instead. The hidden layers are kept as they are
+and the head is solved in closed form (ridge regression), so no training
+framework is needed. The report compares the chunk's error at each step ahead
+with holding the float model's current action for as long.
+'''
+import os
+import sys
+import argparse
+import numpy as np
+import actionChunk
+import featureSchema
+import mlpExport
+import mlpModel
+import replayServer
+import telemetry
+
+OUTPUTS = ('accel', 'brake', 'clutch', 'steer')
+
+
+def training_set(records, mlp, schema, k, tick):
+    '''(inputs (n, features), targets (n, k * ACTION_WIDTH)) of the telemetry records'''
+    raw = telemetry.feature_matrix(records, schema)
+    x = raw if mlp.raw_input else ((raw - schema.means) / schema.stds).astype(np.float32)
+    clutch = records['clutch_input']
+    if not np.isfinite(clutch).all():
+        clutch = np.where(np.isfinite(clutch), clutch, mlp.predict(x)[:, 2])
+    actions = np.stack([records['accel_input'], records['brake_input'],
+                        clutch, records['steer_input']], axis=1).astype(np.float32)
+    rows, windows = actionChunk.target_windows(records, actions, k, tick)
+    x, y = x[rows], windows.reshape(len(rows), -1)
+    finite = np.isfinite(x).all(axis=1) & np.isfinite(y).all(axis=1)
+    return x[finite], y[finite]
+
+
+def print_step_errors(name, outputs, targets, k):
+    '''Mean absolute error per output at each step ahead'''
+    error = np.abs(outputs - targets).reshape(len(targets), k, actionChunk.ACTION_WIDTH).mean(axis=0)
+    print(f'{name}:')
+    print('  step  ' + ''.join(f'{output:>9s}' for output in OUTPUTS))
+    for step in range(k):
+        print(f'  {step:4d}  ' + ''.join(f'{value:9.4f}' for value in error[step]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fit an action-chunk head to the driver model on telemetry logs.')
+    parser.add_argument('model', help='Float model (.npz, .tflite, .keras or .h5)')
+    parser.add_argument('output', help='Chunk model .npz to write (the driver loads model_driver_chunk.npz)')
+    parser.add_argument('--logs', nargs='+', dest='logs', required=True,
+                        help='Telemetry files (.tlm or .csv) or directories')
+    parser.add_argument('--model-dir', dest='model_dir', default=None,
+                        help='Directory with the feature schema (default: next to the model)')
+    parser.add_argument('--chunk', type=int, dest='chunk', default=6,
+                        help='Actions per chunk, at least the driver\'s --chunk-stride (default: 6)')
+    parser.add_argument('--tick-ms', type=float, dest='tick_ms', default=20.0,
+                        help='Server tick the chunk steps are spaced by (default: 20)')
+    parser.add_argument('--drop-layers', type=int, dest='drop_layers', default=0,
+                        help='Hidden layers to remove below the new head (default: 0)')
+    parser.add_argument('--l2', type=float, dest='l2', default=1e-3,
+                        help='Ridge penalty of the head (default: 0.001)')
+    parser.add_argument('--hold-out', type=float, dest='hold_out', default=0.2,
+                        help='Fraction of the windows, the latest, kept for the report (default: 0.2)')
+    parser.add_argument('--tflite-output', dest='tflite_output', default=None,
+                        help='Also save the chunk model as a .tflite model (needs TensorFlow)')
+    args = parser.parse_args(argv)
+
+    model_dir = args.model_dir or os.path.dirname(os.path.abspath(args.model))
+    schema = featureSchema.FeatureSchema.load(model_dir)
+    if args.model.endswith('.npz'):
+        mlp = mlpModel.NumpyMLP.load(args.model)
+    else:
+        mlp = mlpExport.load_source(args.model)[0]
+    schema.check_width(mlp.input_width, args.model)
+
+    records = replayServer.load_records(args.logs)
+    x, y = training_set(records, mlp, schema, args.chunk, args.tick_ms / 1000.0)
+    held_out = int(len(x) * args.hold_out)
+    if len(x) - held_out < 10 * (mlp.kernels[-1].shape[0] + 1):
+        print(f'Only {len(x)} windows of {args.chunk} ticks in {len(records)} telemetry rows, record more laps')
+        return 1
+    print(f'Windows: {len(x)} from {len(records)} telemetry rows, {held_out} held out')
+
+    chunk = actionChunk.fit_head(mlp, x[:len(x) - held_out], y[:len(x) - held_out], args.drop_layers, args.l2)
+    chunk.save(args.output)
+    print('Chunk model saved to', args.output, f'({args.chunk} actions of {actionChunk.ACTION_WIDTH} outputs)')
+
+    if held_out:
+        x, y = x[-held_out:], y[-held_out:]
+        print_step_errors('Chunk model, held-out windows', chunk.predict(x), y, args.chunk)
+        print_step_errors('Float model action held', np.tile(mlp.predict(x), args.chunk), y, args.chunk)
+
+    if args.tflite_output:
+        mlpExport.to_tflite(mlpExport.to_keras(chunk), args.tflite_output, quantize=not chunk.raw_input)
+        print('TFLite model saved to', args.tflite_output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -57,7 +57,12 @@ import json
 import sys
 import getopt
 import numpy as np
-from keras.models import load_model
+import featureSchema
+import modelRuntime
+import udpLink
+import clientLog
+
+log = clientLog.get_logger('client')
 
 
 PI = 3.14159265359
@@ -72,6 +77,8 @@ ophelp += ' --episodes, -e <#>   Maximum learning episodes. [1]\n'
 ophelp += ' --track, -t <track>  Your name for this track. Used for learning. [unknown]\n'
 ophelp += ' --stage, -s <#>      0=warm up, 1=qualifying, 2=race, 3=unknown. [3]\n'
 ophelp += ' --file, -f <name>    parameter file name [default_parameters]\n'
+ophelp += ' --recv-buffer <#>    Receive buffer bytes, longer datagrams are dropped. [4096]\n'
+ophelp += ' --rcvbuf <#>         Socket SO_RCVBUF bytes. [OS default]\n'
 ophelp += ' --debug, -d          Output full telemetry.\n'
 ophelp += ' --help, -h           Show this help.\n'
 ophelp += ' --version, -v        Show current version.'
@@ -134,6 +141,8 @@ class Client():
         self.debug = False
         self.maxSteps = 100000  # 50steps/second
         self.pfilename = 'default_parameters'
+        self.bufsize = udpLink.DEFAULT_BUFSIZE  # receive buffer, longer datagrams are dropped
+        self.rcvbuf = None  # socket SO_RCVBUF, None for the OS default
         self.parse_the_command_line()
         if H: self.host = H
         if p: self.port = p
@@ -145,8 +154,11 @@ class Client():
         self.S = ServerState()
         self.R = DriverAction()
         self.P = None
-        self.stds = np.load('./model/stds.npy', allow_pickle=True)
-        self.means = np.load('./model/means.npy', allow_pickle=True)
+        # Model input layout and scaling, one decoder fills the inputs straight from the server string
+        self.schema = featureSchema.FeatureSchema.load('./model')
+        self.decoder = self.schema.decoder()
+        self.stds = self.schema.stds
+        self.means = self.schema.means
 
         if f: self.pfilename = f
         pfile = open(self.pfilename, 'r')
@@ -162,6 +174,8 @@ class Client():
             sys.exit(-1)
         # == Initialize Connection To Server ==
         self.so.settimeout(1)
+        # Datagrams are read into one reusable buffer (see udpLink.DatagramReceiver)
+        self.receiver = udpLink.DatagramReceiver(self.so, self.bufsize, self.rcvbuf)
         while True:
             # This string establishes track sensor angles! You can customize them.
             # a= "-90 -75 -60 -45 -30 -20 -15 -10 -5 0 5 10 15 20 30 45 60 75 90"
@@ -180,14 +194,12 @@ class Client():
 
             except socket.error:  # , emsg:
                 sys.exit(-1)
-            sockdata = str()
             try:
-                sockdata, addr = self.so.recvfrom(1024)
-                sockdata = sockdata.decode()
+                self.receiver.recv()
             except socket.error:
                 # print "Waiting for server on %d............" % self.port
                 pass
-            if '***identified***' in sockdata:
+            if self.receiver.contains(b'***identified***'):
                 # print "Client connected on %d.............." % self.port
                 break
 
@@ -196,6 +208,7 @@ class Client():
             (opts, args) = getopt.getopt(sys.argv[1:], 'f:H:p:i:m:e:t:s:dhv',
                                          ['host=', 'port=', 'id=', 'steps=',
                                           'episodes=', 'file=', 'track=', 'stage=',
+                                          'recv-buffer=', 'rcvbuf=',
                                           'debug', 'help', 'version'])
         except getopt.error:
             # print 'getopt error: %s\n%s' % (why, usage)
@@ -223,6 +236,10 @@ class Client():
                     self.pfilename = opt[1]
                 if opt[0] == '-m' or opt[0] == '--steps':
                     self.maxSteps = int(opt[1])
+                if opt[0] == '--recv-buffer':
+                    self.bufsize = int(opt[1])
+                if opt[0] == '--rcvbuf':
+                    self.rcvbuf = int(opt[1])
                 if opt[0] == '-v' or opt[0] == '--version':
                     print('%s %s' % (sys.argv[0], version))
                     sys.exit(0)
@@ -237,32 +254,31 @@ class Client():
     def get_servers_input(self):
         '''Server's input is stored in a ServerState object'''
         if not self.so: return
-        sockdata = str()
         while True:
+            sockdata = None
             try:
-                # Receive server data 
-                sockdata, addr = self.so.recvfrom(1024)
-                sockdata = sockdata.decode()
+                # Receive server data into the reusable buffer, None if it was truncated
+                sockdata = self.receiver.recv()
             except socket.error:  # , emsg:
                 print('.')
                 # print "Waiting for data on %d.............." % self.port)
-            if '***identified***' in sockdata:
+            if not sockdata:  # Empty, truncated or timed out?
+                continue  # Try again.
+            elif self.receiver.contains(b'***identified***'):
                 print("Client connected on %d.............." % self.port)
                 continue
-            elif '***shutdown***' in sockdata:
+            elif self.receiver.contains(b'***shutdown***'):
                 print(("Server has stopped the race on %d. " +
                        "You were in %d place.") %
                       (self.port, self.S.d['racePos']))
                 self.shutdown()
                 return
-            elif '***restart***' in sockdata:
+            elif self.receiver.contains(b'***restart***'):
                 # What do I do here?
                 print("Server has restarted the race on %d." % self.port)
                 # I haven't actually caught the server doing this.
                 self.shutdown()
                 return
-            elif not sockdata:  # Empty?
-                continue  # Try again.
             else:
                 self.S.parse_server_str(sockdata)
                 if self.debug:
@@ -295,10 +311,15 @@ class ServerState():
 
     def __init__(self):
         self.servstr = str()
+        self.raw = bytes()
         self.d = dict()
 
     def parse_server_str(self, server_string):
-        '''Parse the server string.'''
+        '''Parse the server string. The raw message (bytes or a memoryview of the
+        receive buffer) is kept in self.raw for the feature decoder.'''
+        self.raw = server_string
+        if not isinstance(server_string, str):
+            server_string = str(server_string, 'utf-8')
         self.servstr = server_string.strip()[:-1]
         sslisted = self.servstr.strip().lstrip('(').rstrip(')').split(')(')
         for i in sslisted:
@@ -601,28 +622,13 @@ def my_drive_fn(c, model):
         gear = 1
         count = 0
     # logic for reverse end
-    test_example = np.ndarray((71,), dtype=np.float64)
     R['gear'] = gear
-    test_example[0] = S['angle']
-    test_example[1] = S['distFromStart']
-    test_example[2] = S['distRaced']
-    test_example[3] = S['fuel']
-    test_example[4] = S['gear']
-    test_example[5:41] = S['opponents']
-    test_example[41] = S['racePos']
-    test_example[42] = S['rpm']
-    test_example[43] = S['speedX']
-    test_example[44] = S['speedY']
-    test_example[45] = S['speedZ']
-    test_example[46:65] = S['track']
-    test_example[65] = S['trackPos']
-    test_example[66:70] = S['wheelSpinVel']
-    test_example[70] = S['z']
+    test_example = c.decoder.decode(c.S.raw)
 
     test_example = test_example - c.means
     test_example = test_example / c.stds
     predictions = model.predict(test_example.reshape(1, -1), batch_size=1).flatten()
-    print(predictions)
+    log.debug('Predictions: %s', predictions)
 
     R['accel'] = predictions[0]
     R['brake'] = predictions[1]
@@ -634,8 +640,10 @@ def my_drive_fn(c, model):
 
 # ================ MAIN ================
 if __name__ == "__main__":
-    model = load_model(r'./model/FullModel_Symm1024_b2048.h5')
+    model = modelRuntime.load_keras_model(r'./model/FullModel_Symm1024_b2048.h5')
     C = Client()
+    clientLog.setup('debug' if C.debug else 'warning')
+    C.schema.check_width(model.input_shape[-1], 'FullModel_Symm1024_b2048.h5')
     count = 0
     for step in range(C.maxSteps, 0, -1):
         C.get_servers_input()
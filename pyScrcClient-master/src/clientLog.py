@@ -0,0 +1,107 @@
+'''
+Logging for the control loop. Records go through a bounded queue to a
+listener thread that does the actual writing, so a log call in a tick never
+waits on the terminal or a pipe. Every message (format string) is rate-limited
+on its own, and per-tick messages are DEBUG, so at the default WARNING level
+the control loop logs nothing.
+
+    log = clientLog.get_logger(__name__)
+    log.debug('inference %.3f ms', ms)      # format lazily, never with f-strings
+
+    clientLog.setup('debug')                # once, in the client entry point
+'''
+import sys
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+ROOT = 'torcs'
+LEVELS = ('debug', 'info', 'warning', 'error')
+
+logging.getLogger(ROOT).setLevel(logging.WARNING)
+
+
+def get_logger(name):
+    '''Logger under the client's root logger'''
+    return logging.getLogger(ROOT + '.' + name)
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Lets each message through at most once per interval seconds; the next one
+    that passes says how many were suppressed in between
+    '''
+
+    def __init__(self, interval=1.0):
+        '''Constructor'''
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.last = {}        # (logger, format string) -> time it last passed
+        self.suppressed = {}  # (logger, format string) -> records dropped since
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        if now - self.last.get(key, -self.interval) < self.interval:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+        self.last[key] = now
+        count = self.suppressed.pop(key, 0)
+        if count:
+            record.msg = '%s [%d similar suppressed]' % (record.msg, count)
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that drops (and counts) records when the queue is full
+    instead of blocking the caller
+    '''
+
+    def __init__(self, queue):
+        logging.handlers.QueueHandler.__init__(self, queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+
+
+def setup(level='warning', stream=None, rate_limit=1.0, max_queue=1024):
+    '''Route the client's logging through a background listener thread.
+    rate_limit is the shortest interval (seconds) between two copies of one message.'''
+    global _listener
+    shutdown()
+    root = logging.getLogger(ROOT)
+    root.setLevel(getattr(logging, level.upper()))
+    root.propagate = False
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    writer = logging.StreamHandler(stream or sys.stderr)
+    writer.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    handler = DroppingQueueHandler(queue.Queue(maxsize=max_queue))
+    if rate_limit:
+        handler.addFilter(RateLimitFilter(rate_limit))
+    root.addHandler(handler)
+    _listener = logging.handlers.QueueListener(handler.queue, writer)
+    _listener.start()
+    return handler
+
+
+def shutdown():
+    '''Write out the queued records and stop the listener thread'''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,104 @@
+'''
+Command-line options shared by the clients (pyclient.py, asyncClient.py and
+multiClient.py), and the Driver they describe. Every client adds the groups it
+supports and builds its drivers with create_driver(), so an option added here
+reaches all of them.
+'''
+import udpLink
+import clientLog
+import inferenceBackend
+import driver
+
+
+def add_session_options(parser, port_help='Host port number (default: 3001)'):
+    '''Server address, bot id, episode limits, telemetry format and log level'''
+    parser.add_argument('--host', action='store', dest='host_ip', default='localhost',
+                        help='Host IP address (default: localhost)')
+    parser.add_argument('--port', action='store', type=int, dest='host_port', default=3001,
+                        help=port_help)
+    parser.add_argument('--id', action='store', dest='id', default='SCR',
+                        help='Bot ID (default: SCR)')
+    parser.add_argument('--maxEpisodes', action='store', dest='max_episodes', type=int, default=1,
+                        help='Maximum number of learning episodes (default: 1)')
+    parser.add_argument('--maxSteps', action='store', dest='max_steps', type=int, default=0,
+                        help='Maximum number of steps (default: 0)')
+    parser.add_argument('--track', action='store', dest='track', default=None,
+                        help='Name of the track')
+    parser.add_argument('--stage', action='store', dest='stage', type=int, default=3,
+                        help='Stage (0 - Warm-Up, 1 - Qualifying, 2 - Race, 3 - Unknown)')
+    parser.add_argument('--telemetry', action='store', dest='telemetry', default='csv',
+                        choices=['csv', 'binary'],
+                        help='Telemetry log format (default: csv)')
+    parser.add_argument('--log-level', action='store', dest='log_level', default='warning',
+                        choices=clientLog.LEVELS,
+                        help='Log level, per-tick messages are debug (default: warning)')
+
+
+def add_model_options(parser):
+    '''Inference backend, model export, interpreter threads and the output cache'''
+    parser.add_argument('--backend', action='store', dest='backend', default='tflite',
+                        choices=inferenceBackend.CHOICES,
+                        help='Inference backend, auto picks the fastest on this host (default: tflite)')
+    parser.add_argument('--raw-input', action='store_true', dest='raw_input',
+                        help='Use the model exported with the scaler folded in (mlpExport.py --fold-scaler)')
+    parser.add_argument('--threads', action='store', type=int, dest='threads', default=None,
+                        help='TFLite interpreter threads (default: the runtime\'s choice)')
+    parser.add_argument('--cache-size', action='store', type=int, dest='cache_size', default=0,
+                        help='Cache the model outputs of this many nearly identical states (default: 0, off)')
+    parser.add_argument('--cache-resolution', action='store', type=float, dest='cache_resolution', default=0.001,
+                        help='Cache grid step in standard deviations of each input (default: 0.001)')
+
+
+def add_single_car_options(parser):
+    '''Options of the clients that drive one car with its own model: keyboard, background
+    load, hot swap, inference server, action chunks, pipelining and capture'''
+    parser.add_argument('--headless', action='store_true', dest='headless',
+                        help='Run without keyboard input (the keyboard module needs root on Linux)')
+    parser.add_argument('--fast-start', action='store_true', dest='fast_start',
+                        help='Load the model in the background while connecting to the server')
+    parser.add_argument('--watch-models', action='store', dest='watch_models', default=None,
+                        help='Swap in the model file in this directory whenever it changes')
+    parser.add_argument('--control-port', action='store', type=int, dest='control_port', default=None,
+                        help='Local UDP port for "load <model file>" messages')
+    parser.add_argument('--inference-server', action='store', dest='inference_server', default=None,
+                        help='Run the model in this inferenceServer.py daemon (default: in process)')
+    parser.add_argument('--action-chunk', action='store_true', dest='action_chunk',
+                        help='Drive every tick from action chunks of model_driver_chunk.* (chunkExport.py)')
+    parser.add_argument('--chunk-stride', action='store', type=int, dest='chunk_stride', default=3,
+                        help='Ticks between forward passes with --action-chunk (default: 3)')
+    parser.add_argument('--pipelined', action='store_true', dest='pipelined',
+                        help='Run inference on a worker thread, overlapped with receiving and sending')
+    parser.add_argument('--pipeline-wait', action='store', type=float, dest='pipeline_wait', default=0.0,
+                        help='Milliseconds to wait for the current frame\'s action with --pipelined (default: 0)')
+    parser.add_argument('--capture', action='store', dest='capture', default=None,
+                        help='Record every datagram to this file for captureReplay.py')
+
+
+def add_receive_options(parser):
+    '''Receive buffer sizes of the clients that read their sockets with udpLink'''
+    parser.add_argument('--recv-buffer', action='store', type=int, dest='recv_buffer', default=udpLink.DEFAULT_BUFSIZE,
+                        help='Receive buffer size in bytes, longer datagrams are dropped (default: %d)'
+                             % udpLink.DEFAULT_BUFSIZE)
+    parser.add_argument('--rcvbuf', action='store', type=int, dest='rcvbuf', default=None,
+                        help='Socket SO_RCVBUF in bytes (default: OS default)')
+
+
+def driver_options(arguments):
+    '''Driver keyword arguments for the parsed options of the groups above'''
+    options = dict(raw_input=arguments.raw_input, telemetry_format=arguments.telemetry,
+                   num_threads=arguments.threads, cache_size=arguments.cache_size,
+                   cache_resolution=arguments.cache_resolution)
+    if hasattr(arguments, 'pipelined'):
+        options.update(background_load=arguments.fast_start, headless=arguments.headless,
+                       watch_models=arguments.watch_models, control_port=arguments.control_port,
+                       inference_server=arguments.inference_server, action_chunk=arguments.action_chunk,
+                       chunk_stride=arguments.chunk_stride, pipelined=arguments.pipelined,
+                       pipeline_wait=arguments.pipeline_wait / 1000.0)
+    return options
+
+
+def create_driver(arguments, **overrides):
+    '''The Driver the parsed options describe; overrides replace or add keyword arguments'''
+    options = driver_options(arguments)
+    options.update(overrides)
+    return driver.Driver(arguments.stage, arguments.backend, **options)
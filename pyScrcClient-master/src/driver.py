@@ -1,34 +1,77 @@
 
 import warnings
 import msgParser
+import featureSchema
+import telemetry
+import latencyStats
+import clientLog
+import inferenceBackend
+import modelRegistry
+import inferenceCache
+import actionChunk
+import inferencePipeline
 import carState
 import carControl
-import keyboard
+import keyInput
 import time
 import os
-import csv
+import threading
 import numpy as np
-import joblib
 from datetime import datetime
-import tensorflow as tf
+
+log = clientLog.get_logger('driver')
 
 class Driver(object):
     '''
     A driver object for the SCRC
     '''
 
-    def __init__(self, stage):
-        '''Constructor'''
+    def __init__(self, stage, backend='tflite', background_load=False, raw_input=False, telemetry_format='csv',
+                 headless=False, model_source=None, car=None, model_dir=None, num_threads=None,
+                 watch_models=None, control_port=None, inference_server=None, cache_size=None,
+                 cache_resolution=0.001, action_chunk=False, chunk_stride=3,
+                 pipelined=False, pipeline_wait=0.0):
+        '''Constructor, backend is one of inferenceBackend.CHOICES ('auto' picks the fastest).
+        With background_load the model loads on a thread and the car is held until it is ready.
+        With raw_input the model_driver_raw.* export is used, which has the scaler folded in.
+        telemetry_format is 'csv' or 'binary' (fixed-size records, see telemetry.read_session).
+        headless runs without the keyboard module (no manual control, no root needed).
+        model_source is another Driver whose loaded model is shared instead of loading
+        a copy, and car numbers the telemetry file (both used by multiClient.py).
+        model_dir replaces the models directory, e.g. to compare two model versions.
+        num_threads is the TFLite interpreter's thread count (default: the runtime's choice).
+        watch_models (a directory) and control_port (a local UDP port) let new models be
+        swapped in while driving, see modelRegistry.
+        inference_server names a running inferenceServer.py daemon to run the model in;
+        the model is loaded in process if it is not available.
+        cache_size enables an LRU cache of that many model outputs for nearly identical
+        states, quantized to cache_resolution standard deviations (see inferenceCache).
+        action_chunk loads model_driver_chunk.* (chunkExport.py), which predicts the next
+        actions, and runs it every chunk_stride ticks (see actionChunk.ChunkScheduler).
+        pipelined runs the model on a worker thread and applies the newest finished action,
+        waiting up to pipeline_wait seconds for the current frame's (see inferencePipeline).'''
         self.WARM_UP = 0
         self.QUALIFYING = 1
         self.RACE = 2
         self.UNKNOWN = 3
         self.stage = stage
+        self.backend = backend
+        self.raw_input = raw_input
+        self.num_threads = num_threads
+        self.inference_server = inference_server
+        self.remote_model = None  # inferenceServer.RemoteModel while connected to the daemon
+        self.startup_times = {}  # seconds spent in each startup stage
+        self.stats = latencyStats.TickStats()  # per-stage tick latency, see latencyStats.STAGES
         
         self.parser = msgParser.MsgParser()
         
         self.state = carState.CarState()
         
+        # Model input layout and scaling, loaded once and checked against the model
+        self.model_dir = model_dir or os.path.join(os.path.dirname(os.path.dirname(__file__)), "models")
+        self.schema = featureSchema.FeatureSchema.load(self.model_dir)
+        self.decoder = self.schema.decoder()
+        
         self.control = carControl.CarControl()
         
         self.steer_lock = 0.785398  # Maximum steering lock (in radians)
@@ -38,8 +81,12 @@ class Driver(object):
         # Initialize CSV logging
         log_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "logs")
         os.makedirs(log_dir, exist_ok=True)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.csv_filename = os.path.join(log_dir, f"telemetry_{timestamp}.csv")
+        # Microseconds: several Drivers of one process (multiClient.py, captureReplay.py) start in the same second
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        self.telemetry_format = telemetry_format
+        extension = "tlm" if telemetry_format == 'binary' else "csv"
+        car_suffix = f"_car{car}" if car is not None else ""
+        self.csv_filename = os.path.join(log_dir, f"telemetry_{timestamp}{car_suffix}.{extension}")
         self.create_csv_file()
         
         # Control settings for smooth steering
@@ -47,8 +94,9 @@ class Driver(object):
         self.manual_influence = 0.0      # How much manual steering is applied (0.0-1.0)
         self.target_position = 0.0       # Target track position (-1.0 to 1.0)
         self.position_change_rate = 0.05 # How quickly target position changes
-        self.stds = np.load('../models/stds.npy', allow_pickle=True)
-        self.means = np.load('../models/means.npy', allow_pickle=True)
+        self.stds = self.schema.stds
+        self.means = self.schema.means
+        self.scaled_state = np.zeros((1, len(self.schema)), dtype=np.float32)
         
         
         # steering parameters
@@ -62,140 +110,302 @@ class Driver(object):
         self.shift_delay_time = 10  # Frames to wait between shifts
         
         # Load AI model and scaler
-        self.load_ai_model()
+        self.model_stem = actionChunk.CHUNK_STEM if action_chunk else inferenceBackend.MODEL_STEM
+        self.chunks = actionChunk.ChunkScheduler(chunk_stride) if action_chunk else None
+        if pipelined and action_chunk:
+            raise ValueError("Pipelined inference and action chunks cannot be combined")
+        self.pipeline = inferencePipeline.InferencePipeline(len(self.schema)) if pipelined else None
+        self.pipeline_wait = pipeline_wait
+        self.frame = 0  # sensor frames read, the sequence numbers of pipelined inference
+        self.action_lags = [0, 0, 0, 0]  # pipelined actions 0, 1, 2 and 3+ frames old
+        self.cache = None
+        if cache_size:
+            self.cache = inferenceCache.InferenceCache(self.schema, raw_input, cache_size, cache_resolution)
+        self.registry = None
+        self.hot_swap = (watch_models, control_port) if watch_models or control_port else None
+        self.swap_times = []  # nanoseconds each model swap took
+        self.model_loaded = False
+        self.model_error = None
+        self.model_ready = threading.Event()
+        if model_source is not None:
+            self.share_model(model_source)
+        elif background_load:
+            threading.Thread(target=self.load_ai_model_in_background, daemon=True).start()
+        else:
+            self.load_ai_model()
         
         # Mode selection (AI or manual)
         self.ai_mode = True
         
+        # Keyboard state, read once per tick in drive()
+        self.keys = keyInput.create(headless)
+        self.key_state = keyInput.NO_KEYS
+        
         print("Driver initialized.")
-        print("Press 'M' to toggle between AI mode and Manual mode")
-        print("Manual Controls: W: Accelerate | S: Brake/Reverse | A: Turn Left | D: Turn Right | Q: Quit")
+        if not headless:
+            print("Press 'M' to toggle between AI mode and Manual mode")
+            print("Manual Controls: W: Accelerate | S: Brake/Reverse | A: Turn Left | D: Turn Right | Q: Quit")
         
     def load_ai_model(self):
-        '''Load the trained TFLite model and scaler'''
-        model_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "models")
-        tflite_path = os.path.join(model_dir, "model_driver.tflite")
-        scaler_path = os.path.join(model_dir, "torcs_scaler.joblib")
+        '''Load the trained model for the selected backend (see inferenceBackend.CHOICES)'''
+        load_start = time.perf_counter()
         try:
-            # Load TFLite model and allocate tensors
-            self.tflite_interpreter = tf.lite.Interpreter(model_path=tflite_path)
-            self.tflite_interpreter.allocate_tensors()
-            # Get input/output details for later use
-            self.tflite_input_details = self.tflite_interpreter.get_input_details()
-            self.tflite_output_details = self.tflite_interpreter.get_output_details()
-            # Load scaler
-            self.scaler = joblib.load(scaler_path)
-            print(f"TFLite model loaded successfully from {tflite_path}")
+            self.model = None
+            if self.inference_server is not None:
+                self.model = self.connect_inference_server()
+            if self.model is None:
+                self.model = self.load_local_model()
+            self.bind_model(self.model)
+            print(f"{self.backend} model loaded successfully from {self.model.path}")
+            self.startup_times['model_load'] = time.perf_counter() - load_start
+            warm_up_start = time.perf_counter()
+            self.warm_up_model()
+            self.startup_times['warm_up'] = time.perf_counter() - warm_up_start
+            if self.chunks is not None:
+                self.chunks.check(len(self.model.predict(np.zeros_like(self.scaled_state))))
+            if self.hot_swap is not None and self.remote_model is not None:
+                print("Model hot swap is not available with an inference server, restart the server instead")
+            elif self.hot_swap is not None:
+                watch_models, control_port = self.hot_swap
+                watch_path = os.path.join(watch_models, os.path.basename(self.model.path)) if watch_models else None
+                check_outputs = self.chunks.check if self.chunks is not None else None
+                self.registry = modelRegistry.ModelRegistry(self.schema, self.raw_input, self.num_threads,
+                                                            watch_path, control_port, test_dir=self.model_dir,
+                                                            check_outputs=check_outputs)
             self.model_loaded = True
+            self.model_ready.set()
         except Exception as e:
-            print(f"Failed to load TFLite model: {e}")
+            print(f"Failed to load {self.backend} model: {e}")
+            self.model_error = e
+            self.model_ready.set()
             exit(1)
             print("Falling back to manual control mode")
             self.model_loaded = False
             self.ai_mode = False
             
+    def load_local_model(self):
+        '''Load the model in this process for the selected backend'''
+        if self.backend == 'auto':
+            # Every backend this host can run is checked and timed, the fastest is kept
+            model, report = inferenceBackend.select(self.schema, self.model_dir, self.raw_input, self.num_threads,
+                                                    stem=self.model_stem)
+            print("Inference backends:")
+            for line in report:
+                print("  " + line)
+            self.backend = model.name
+        else:
+            model = inferenceBackend.create(self.backend, self.model_dir, self.raw_input, self.num_threads,
+                                            self.model_stem)
+            self.schema.check_width(model.input_width, model.path)
+        return model
+    
+    def connect_inference_server(self):
+        '''Claim a slot of the inference daemon, None if it is not available'''
+        import inferenceServer  # only with --inference-server: shared memory and slot locks
+        try:
+            model = inferenceServer.RemoteModel(self.inference_server, self.schema, self.raw_input,
+                                                fallback=self.fall_back_to_local_model)
+        except (OSError, ValueError) as e:
+            print(f"Inference server {self.inference_server} not available ({e}), running the model in process")
+            return None
+        self.local_backend = self.backend  # for the fallback
+        self.backend = model.name
+        self.remote_model = model
+        return model
+    
+    def fall_back_to_local_model(self):
+        '''Called by the RemoteModel on a thread after the daemon's first late reply; it
+        switches to this model if the daemon does not recover'''
+        self.backend = self.local_backend
+        model = self.load_local_model()
+        print(f"Inference server is late, {self.backend} model loaded from {model.path} as a fallback")
+        return model
+    
+    def warm_up_model(self, runs=10):
+        '''Run the model a few times on a zero row, so delegate setup and first-call
+        allocations happen at load time instead of on the first racing tick'''
+        warm_up_state = np.zeros_like(self.scaled_state)
+        for _ in range(runs):
+            self.model.predict(warm_up_state)
+    
+    def share_model(self, source):
+        '''Use the model already loaded by another Driver'''
+        if not source.model_loaded:
+            raise ValueError("The shared driver has no model loaded")
+        self.backend = source.backend
+        self.raw_input = source.raw_input
+        self.bind_model(source.model)
+        self.model_loaded = True
+        self.model_ready.set()
+    
+    def bind_model(self, model):
+        '''Run the model on the next tick, through the cache if there is one'''
+        self.model = model
+        self.run_model = model.predict
+        self.predict_batch = model.predict_batch
+        if self.cache is not None:
+            self.cache.set_model(model)
+            self.run_model = self.cache.predict
+        if self.pipeline is not None:
+            self.pipeline.run = self.run_model
+    
+    def setup_batch(self, capacity):
+        '''Prepare the model for predict_batch() on up to capacity input rows'''
+        self.model.setup_batch(capacity)
+        self.warm_up_model()
+        if self.registry is not None:
+            self.registry.batch_capacity = capacity
+    
+    def swap_model(self):
+        '''Swap in a model the registry has loaded and warmed up, between two ticks'''
+        start = time.perf_counter_ns()
+        model = self.registry.take()
+        if model is None:
+            return
+        # The old model is released on the registry thread, freeing it can take longer than a tick
+        self.registry.retire(self.model)
+        self.bind_model(model)
+        self.backend = model.name
+        elapsed = time.perf_counter_ns() - start
+        self.swap_times.append(elapsed)
+        print(f"Swapped in {model.path} ({model.name}) in {elapsed / 1000:.1f} us")
+    
+    def load_ai_model_in_background(self):
+        '''Thread target for background_load, a failure stops the client on the next tick'''
+        try:
+            self.load_ai_model()
+        except SystemExit:
+            pass
+    
     def create_csv_file(self):
-        '''Create CSV file with headers for telemetry data'''
-        with open(self.csv_filename, 'w', newline='') as csvfile:
-            fieldnames = [
-                'timestamp', 'angle', 'curLapTime', 'damage', 'distFromStart', 
-                'distRaced', 'fuel', 'gear', 'lastLapTime', 'racePos', 'rpm',
-                'speedX', 'speedY', 'speedZ', 'trackPos', 'z', 'opponents','wheelSpinVel','focus','track',
-                'accel_input', 'brake_input', 'steer_input', 'gear_input',
-                'key_w', 'key_s', 'key_a', 'key_d' 
-            ]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
+        '''Create CSV file with headers for telemetry data, rows are written in the background'''
+        if self.telemetry_format == 'binary':
+            self.telemetry = telemetry.BinaryTelemetryWriter(self.csv_filename, angles=self.rangefinder_angles())
+        elif self.telemetry_format == 'csv':
+            self.telemetry = telemetry.TelemetryWriter(self.csv_filename)
+        else:
+            raise ValueError(f"Unknown telemetry format: {self.telemetry_format}")
         print(f"Telemetry will be saved to: {self.csv_filename}")
     
     def log_data(self):
-        '''Log current state and control data to CSV'''
-        with open(self.csv_filename, 'a', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=[
-                'timestamp', 'angle', 'curLapTime', 'damage', 'distFromStart', 
-                'distRaced', 'fuel', 'gear', 'lastLapTime', 'racePos', 'rpm',
-                'speedX', 'speedY', 'speedZ', 'trackPos','opponents','wheelSpinVel','focus','track', 'z',
-                'accel_input', 'brake_input', 'steer_input', 'gear_input',
-                'key_w', 'key_s', 'key_a', 'key_d'  
-            ])
-            
-       
-            data = {
-                'timestamp': time.time(),
-                'angle': self.state.angle,
-                'curLapTime': self.state.curLapTime,
-                'damage': self.state.damage,
-                'distFromStart': self.state.distFromStart,
-                'distRaced': self.state.distRaced,
-                'fuel': self.state.fuel,
-                'gear': self.state.gear,
-                'lastLapTime': self.state.lastLapTime,
-                'racePos': self.state.racePos,
-                'rpm': self.state.rpm,
-                'speedX': self.state.speedX,
-                'speedY': self.state.speedY,
-                'speedZ': self.state.speedZ,
-                'trackPos': self.state.trackPos,
-                'opponents': self.state.opponents,
-                'wheelSpinVel': self.state.wheelSpinVel,
-                'focus': self.state.focus,
-                'track': self.state.track,
-                'z': self.state.z,
-                'accel_input': self.control.getAccel(),
-                'brake_input': self.control.getBrake(),
-                'steer_input': self.control.getSteer(),
-                'gear_input': self.control.getGear(),
-                # Store keyboard states (1 for pressed, 0 for not pressed)
-                'key_w': 1 if keyboard.is_pressed('w') else 0,
-                'key_s': 1 if keyboard.is_pressed('s') else 0,
-                'key_a': 1 if keyboard.is_pressed('a') else 0,
-                'key_d': 1 if keyboard.is_pressed('d') else 0
-            }
-            
-            writer.writerow(data)
+        '''Queue current state and control data for the telemetry writer'''
+        self.telemetry.write((
+            time.time(),
+            self.state.angle,
+            self.state.curLapTime,
+            self.state.damage,
+            self.state.distFromStart,
+            self.state.distRaced,
+            self.state.fuel,
+            self.state.gear,
+            self.state.lastLapTime,
+            self.state.racePos,
+            self.state.rpm,
+            self.state.speedX,
+            self.state.speedY,
+            self.state.speedZ,
+            self.state.trackPos,
+            self.state.z,
+            self.state.opponents,
+            self.state.wheelSpinVel,
+            self.state.focus,
+            self.state.track,
+            self.control.getAccel(),
+            self.control.getBrake(),
+            self.control.getClutch(),
+            self.control.getSteer(),
+            self.control.getGear(),
+            # Store keyboard states (1 for pressed, 0 for not pressed)
+            1 if self.key_state.is_pressed('w') else 0,
+            1 if self.key_state.is_pressed('s') else 0,
+            1 if self.key_state.is_pressed('a') else 0,
+            1 if self.key_state.is_pressed('d') else 0,
+        ))
     
-    def init(self):
-        '''Return init string with rangefinder angles'''
-        self.angles = [0 for x in range(19)]
+    def rangefinder_angles(self):
+        '''Angles of the 19 track rangefinders requested in the init string'''
+        angles = [0 for x in range(19)]
         
         for i in range(5):
-            self.angles[i] = -90 + i * 15
-            self.angles[18 - i] = 90 - i * 15
+            angles[i] = -90 + i * 15
+            angles[18 - i] = 90 - i * 15
         
         for i in range(5, 9):
-            self.angles[i] = -20 + (i-5) * 5
-            self.angles[18 - i] = 20 - (i-5) * 5
+            angles[i] = -20 + (i-5) * 5
+            angles[18 - i] = 20 - (i-5) * 5
+        
+        return angles
+    
+    def init(self):
+        '''Return init string with rangefinder angles'''
+        self.angles = self.rangefinder_angles()
         
         return self.parser.stringify({'init': self.angles})
     
     def drive(self, msg):
-        self.state.setFromMsg(msg)
+        # The client loop starts the tick when the datagram arrives; without one, time drive() alone
+        own_tick = not self.stats.open
+        if own_tick:
+            self.stats.start()
+        hold = self.read_state(msg)
+        if hold is None:
+            # Use AI model for control or manual input
+            if self.ai_mode and self.model_loaded:
+                self.handle_ai_control()
+            else:
+                self.handle_keyboard_input()
+            msg = self.finish_tick()
+        else:
+            msg = hold
+        if own_tick:
+            self.stats.finish()
+        return msg
+    
+    def read_state(self, msg):
+        '''First part of drive(): decode the message, read the keyboard and switch modes.
+        Returns the message to send straight away while the model is still loading, else None.'''
+        self.decoder.decode(msg)
+        self.state.setFromDecoder(self.decoder)
+        self.frame += 1
+        self.stats.mark('parse')
         
-        # Check for mode switch
-        if keyboard.is_pressed('m'):
-            
-            
+        if not self.model_ready.is_set():
+            # Model still loading in the background: hold the car on the brakes
+            self.control.setAccel(0.0)
+            self.control.setBrake(1.0)
+            return self.control.toMsg()
+        if self.model_error is not None:
+            exit(1)
+        if self.registry is not None:
+            self.swap_model()
+        
+        self.key_state = self.keys.snapshot()
+        
+        # Check for mode switch, once per key press
+        if self.key_state.was_pressed('m'):
             if self.model_loaded:
                 self.ai_mode = not self.ai_mode
+                if self.chunks is not None:
+                    self.chunks.reset()  # the plan from before manual driving is out of date
                 mode_name = "AI" if self.ai_mode else "Manual"
                 print(f"Switched to {mode_name} mode")
             else:
                 print("AI mode not available - model not loaded")
-        
-        # Use AI model for control or manual input
-        if self.ai_mode and self.model_loaded:
-            self.handle_ai_control()
-        else:
-            self.handle_keyboard_input()
-        
+        return None
+    
+    def finish_tick(self):
+        '''Last part of drive(): log the tick and return the control message'''
         # Save telemetry data
         self.log_data()
+        self.stats.mark('logging')
         
-        if keyboard.is_pressed('q'):
+        if self.key_state.was_pressed('q'):
             print("User requested to quit")
             return "(meta 1)"
         
-        return self.control.toMsg()
+        msg = self.control.toMsg()
+        self.stats.mark('encode')
+        return msg
     
     def prepare_state_for_model(self):
         '''Convert current car state to the format expected by the model'''
@@ -225,115 +435,128 @@ class Driver(object):
 
         #--------------------------------------------------#
 
-        features = np.ndarray((71,), dtype=np.float64)
-        features[0] = self.state.angle
-        features[1] = self.state.distFromStart
-        features[2] = self.state.distRaced
-        features[3] = self.state.fuel
-        # Use gear_override if provided (for gear logic before prediction)
-        features[4] =  self.state.gear
-        features[5:41] = self.state.opponents
-        features[41] = self.state.racePos
-        features[42] = self.state.rpm
-        features[43] = self.state.speedX
-        features[44] = self.state.speedY
-        features[45] = self.state.speedZ
-        features[46:65] = self.state.track
-        features[65] = self.state.trackPos
-        features[66:70] = self.state.wheelSpinVel
-        features[70] = self.state.z
+        # The decoder has already laid the sensor values out in model input order
+        features = self.decoder.features
+        if self.raw_input:
+            # The scaler is folded into the model's first layer
+            return features.reshape(1, -1)
 
         #---------------------------------------------#
 
-        # Scale the features using the same scaler used during training
-        scaled_features = (features - self.means) / self.stds
-        # # Ensure the shape is correct for the model
-        scaled_features = scaled_features.reshape(1, -1)
-        
-
-        #scaled_features = self.scaler.transform(features)
+        # Scale the features using the same scaler used during training, in place
+        scaled_features = self.scaled_state[0]
+        np.subtract(features, self.means, out=scaled_features)
+        np.divide(scaled_features, self.stds, out=scaled_features)
         
-        return scaled_features.reshape(1, -1)
+        return self.scaled_state
     def handle_ai_control(self):
         '''Use the trained TFLite neural network to control the car'''
         try:
-            global count
-            count = 0
-            gear = self.control.getGear()
-            rpm = self.state.getRpm()
-            speed = self.state.getSpeedX()
-            distRaced = self.state.getDistRaced()
-            if rpm >= 9200 and gear < 6:
-                gear += 1
-                count = 0
-            elif rpm <= 5500 and gear > 1:
-                gear -= 1
-                count = 0
-            
+            scaled_state = self.prepare_ai_control()
             
+            # Run inference on the selected backend, the timing covers set_tensor, invoke and get_tensor
+            start_time = time.perf_counter()
+            if self.pipeline is not None:
+                predictions = self.exchange_pipelined(scaled_state)
+                if predictions is None:
+                    return  # no action finished yet, the controls stay as they are
+            elif self.chunks is None:
+                predictions = self.run_model(scaled_state)
+            else:
+                # The next action of the current chunk, the model only runs when a new one is due
+                predictions = self.chunks.step(self.run_model, scaled_state)
+            inference_time = time.perf_counter() - start_time
+            self.apply_predictions(predictions)
+            self.stats.mark('inference')
+            if 'first_inference' not in self.startup_times:
+                self.startup_times['first_inference'] = inference_time
+            log.debug("Model inference time: %.3f ms", inference_time * 1000)
             
-            # if int(distRaced) > 2 and speed < 4:
-            #     count += 1
-            # if 20 <= count < 1200 * 3:
-            #     gear = -1
-            #     count += 1
-            # if count >= 1200 * 3:
-            #     gear = 1
-            #    count = 0
+        except Exception as e:
+            self.ai_control_failed(e)
+    
+    def exchange_pipelined(self, scaled_state):
+        '''Hand this frame's row to the inference worker and return the newest finished
+        action (None before the first one)'''
+        self.pipeline.submit(scaled_state, self.frame)
+        predictions, sequence = self.pipeline.latest(self.frame, self.pipeline_wait)
+        if predictions is not None:
+            self.action_lags[min(self.frame - sequence, 3)] += 1
+            log.debug("Frame %d: action from frame %d", self.frame, sequence)
+        return predictions
+    
+    def prepare_ai_control(self):
+        '''Pick the gear and return the model input row for this tick'''
+        global count
+        count = 0
+        gear = self.control.getGear()
+        rpm = self.state.getRpm()
+        speed = self.state.getSpeedX()
+        distRaced = self.state.getDistRaced()
+        if rpm >= 9200 and gear < 6:
+            gear += 1
+            count = 0
+        elif rpm <= 5500 and gear > 1:
+            gear -= 1
+            count = 0
+        
+        
+        
+        # if int(distRaced) > 2 and speed < 4:
+        #     count += 1
+        # if 20 <= count < 1200 * 3:
+        #     gear = -1
+        #     count += 1
+        # if count >= 1200 * 3:
+        #     gear = 1
+        #    count = 0
 
-            if abs(speed) < 2.0 and int(self.state.distRaced) > 5 and self.state.angle > 0.5:
-                if gear == 1 or gear == 0:
-                    gear = -1
-            
-            # If car is aligned with track and in reverse, switch to first gear
-            if abs(self.state.angle) < 0.2 and gear == -1 and abs(speed) < 3.0:
-                gear = 1
+        if abs(speed) < 2.0 and int(self.state.distRaced) > 5 and self.state.angle > 0.5:
+            if gear == 1 or gear == 0:
+                gear = -1
+        
+        # If car is aligned with track and in reverse, switch to first gear
+        if abs(self.state.angle) < 0.2 and gear == -1 and abs(speed) < 3.0:
+            gear = 1
 
-            self.control.setGear(gear)
-            
+        self.control.setGear(gear)
+        
 
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore", category=UserWarning, message="X does not have valid feature names")
-                scaled_state = self.prepare_state_for_model().astype(np.float32)
-       
-            
-            # Set input tensor
-            self.tflite_interpreter.set_tensor(self.tflite_input_details[0]['index'], scaled_state)
-            # Run inference
-            self.tflite_interpreter.invoke()
-            # Get output tensor
-            start_time = time.time()
-            predictions = self.tflite_interpreter.get_tensor(self.tflite_output_details[0]['index'])[0]
-            end_time = time.time()
-            print(f"Model inference time: {end_time - start_time:.4f} seconds")
-            # Extract individual control values
-            acceleration = float(predictions[0])  # Acceleration
-            brake = float(predictions[1])         # Braking
-            clutch = float(predictions[2])        # Clutch
-            steering = float(predictions[3])      # Steering
-            
-            # Clip values to valid ranges
-            acceleration = max(0.0, min(1.0, acceleration))
-            brake = max(0.0, min(1.0, brake))
-            clutch = max(0.0, min(1.0, clutch))
-            steering = max(-1.0, min(1.0, steering))
-            
-            # Apply the values to control
-            self.control.setAccel(acceleration)
-            self.control.setBrake(brake)
-            self.control.setSteer(steering)
-            self.control.setClutch(clutch)            
-            # Use rule-based gear selection instead of model prediction
-            #self.set_gear_based_on_rpm()
-            
-            # Update current steer for smoothness in transitions
-            #self.current_steer = steering
-            
-        except Exception as e:
-            print(f"Error in AI control: {e}")
-            print("Falling back to manual control")
-            self.ai_mode = False
-            self.handle_keyboard_input()
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category=UserWarning, message="X does not have valid feature names")
+            scaled_state = self.prepare_state_for_model()
+        self.stats.mark('features')
+        return scaled_state
+    
+    def apply_predictions(self, predictions):
+        '''Clip the model outputs (accel, brake, clutch, steer) and apply them'''
+        # Extract individual control values
+        acceleration = float(predictions[0])  # Acceleration
+        brake = float(predictions[1])         # Braking
+        clutch = float(predictions[2])        # Clutch
+        steering = float(predictions[3])      # Steering
+        
+        # Clip values to valid ranges
+        acceleration = max(0.0, min(1.0, acceleration))
+        brake = max(0.0, min(1.0, brake))
+        clutch = max(0.0, min(1.0, clutch))
+        steering = max(-1.0, min(1.0, steering))
+        
+        # Apply the values to control
+        self.control.setAccel(acceleration)
+        self.control.setBrake(brake)
+        self.control.setSteer(steering)
+        self.control.setClutch(clutch)            
+        # Use rule-based gear selection instead of model prediction
+        #self.set_gear_based_on_rpm()
+        
+        # Update current steer for smoothness in transitions
+        #self.current_steer = steering
+    
+    def ai_control_failed(self, e):
+        log.warning("Error in AI control, falling back to manual control: %s", e)
+        self.ai_mode = False
+        self.handle_keyboard_input()
     
     def set_gear_based_on_rpm(self):
         '''Apply rule-based gear selection based on RPM'''
@@ -386,7 +609,7 @@ class Driver(object):
             self.shift_delay -= 1
         
         # Handle acceleration (W key)
-        if keyboard.is_pressed('w'):
+        if self.key_state.is_pressed('w'):
             if gear == -1:  # If in reverse gear and pressing W, switch to first gear
                 gear = 1
             accel += self.acceleration_step
@@ -394,7 +617,7 @@ class Driver(object):
             if accel > 1.0:
                 accel = 1.0
         
-        if keyboard.is_pressed('s'):
+        if self.key_state.is_pressed('s'):
             if gear == -1:
                 # accelerate backwords
                 accel += self.acceleration_step
@@ -415,7 +638,7 @@ class Driver(object):
         if self.shift_delay == 0 and gear >= -1:  
             if gear == -1:
                 # Only shift out of reverse when going forward
-                if keyboard.is_pressed('w'):
+                if self.key_state.is_pressed('w'):
                     gear = 1
                     self.shift_delay = self.shift_delay_time
             else:
@@ -434,9 +657,9 @@ class Driver(object):
                         self.shift_delay = self.shift_delay_time
 
      
-        if keyboard.is_pressed('a'):  # Left turn (+1)
+        if self.key_state.is_pressed('a'):  # Left turn (+1)
             self.current_steer = min(1.0, self.current_steer + self.steer_step)
-        elif keyboard.is_pressed('d'):  # Right turn (-1)
+        elif self.key_state.is_pressed('d'):  # Right turn (-1)
             self.current_steer = max(-1.0, self.current_steer - self.steer_step)
         else:
             # Gradually return to center when no keys are pressed
@@ -458,7 +681,33 @@ class Driver(object):
         self.prev_rpm = rpm
     
     def onShutDown(self):
+        self.keys.close()
+        if self.remote_model is not None:
+            self.remote_model.close()
+            if self.remote_model.late:
+                print(f"Inference server: {self.remote_model.late} late replies"
+                      + (", fell back to the local model" if self.remote_model.local is not None else ""))
+        print("Tick latency:")
+        print(self.stats.report())
+        if self.cache is not None:
+            print(self.cache.report())
+        if self.chunks is not None:
+            print(self.chunks.report())
+        if self.pipeline is not None:
+            self.pipeline.close()
+            print(f"Pipelined actions by age: {self.action_lags[0]} from their own frame, "
+                  f"{self.action_lags[1]} one frame old, {self.action_lags[2]} two, {self.action_lags[3]} older; "
+                  f"{self.pipeline.superseded} frames superseded before inference")
+        if self.registry is not None:
+            self.registry.close()
+            longest = max(self.swap_times) / 1000 if self.swap_times else 0.0
+            print(f"Model swaps: {len(self.swap_times)} (longest {longest:.1f} us), "
+                  f"rejected models: {self.registry.rejected}")
+        self.telemetry.flush()
         print("Session ended - telemetry saved to:", self.csv_filename)
+        if self.telemetry.dropped:
+            print(f"Telemetry rows dropped because the writer fell behind: {self.telemetry.dropped}")
     
     def onRestart(self):
+        self.telemetry.flush()
         print("Session restarted - continuing to log telemetry")
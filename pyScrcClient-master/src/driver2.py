@@ -1,35 +1,44 @@
 import warnings
 import msgParser
+import featureSchema
+import telemetry
+import latencyStats
+import clientLog
+import modelRuntime
 import carState
 import carControl
+import keyInput
 import time
 import os
-import csv
-import keyboard
 import numpy as np
-import joblib
 from datetime import datetime
 import pickle
-import tensorflow as tf
-from keras.models import load_model
+
+log = clientLog.get_logger('driver2')
 
 class Driver(object):
     '''
     A driver object for the SCRC
     '''
 
-    def __init__(self, stage):
-        '''Constructor'''
+    def __init__(self, stage, headless=False):
+        '''Constructor, headless runs without the keyboard module'''
         self.WARM_UP = 0
         self.QUALIFYING = 1
         self.RACE = 2
         self.UNKNOWN = 3
         self.stage = stage
+        self.stats = latencyStats.TickStats()  # per-stage tick latency, see latencyStats.STAGES
         
         self.parser = msgParser.MsgParser()
         
         self.state = carState.CarState()
         
+        # Model input layout and scaling, loaded once and checked against the model
+        self.model_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "models")
+        self.schema = featureSchema.FeatureSchema.load(self.model_dir)
+        self.decoder = self.schema.decoder()
+        
         self.control = carControl.CarControl()
         
         self.steer_lock = 0.785398  # Maximum steering lock (in radians)
@@ -61,26 +70,34 @@ class Driver(object):
         
         # Load AI model and scaler
         self.load_ai_model()
-        self.stds = np.load('../models/stds.npy', allow_pickle=True)
-        self.means = np.load('../models/means.npy', allow_pickle=True)
+        self.stds = self.schema.stds
+        self.means = self.schema.means
+        self.scaled_state = np.zeros((1, len(self.schema)), dtype=np.float32)
         
         # Mode selection (AI or manual)
         self.ai_mode = True
         
+        # Keyboard state, read once per tick in drive()
+        self.keys = keyInput.create(headless)
+        self.key_state = keyInput.NO_KEYS
+        
         print("Driver initialized.")
-        print("Press 'M' to toggle between AI mode and Manual mode")
-        print("Manual Controls: W: Accelerate | S: Brake/Reverse | A: Turn Left | D: Turn Right | Q: Quit")
+        if not headless:
+            print("Press 'M' to toggle between AI mode and Manual mode")
+            print("Manual Controls: W: Accelerate | S: Brake/Reverse | A: Turn Left | D: Turn Right | Q: Quit")
         
     def load_ai_model(self):
         '''Load the trained neural network model and scaler'''
        
-        model_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "models")
+        model_dir = self.model_dir
         model_path = os.path.join(model_dir, "FullModel_Symm1024_b2048.h5")
         model_path = r'../models/torcs_model_driver.h5'
         scaler_path = os.path.join(model_dir, "torcs_scaler.joblib")
         try:
-            self.model = load_model(model_path)
-           # self.scaler = joblib.load(scaler_path)
+            # Keras (and TensorFlow behind it) is only imported here
+            self.model = modelRuntime.load_keras_model(model_path)
+            self.schema.check_width(self.model.input_shape[-1], model_path)
+           # self.scaler = modelRuntime.load_joblib(scaler_path)
             print(f"AI model loaded successfully from {model_path}")
             self.model_loaded = True
         except Exception as e:
@@ -91,64 +108,44 @@ class Driver(object):
             self.ai_mode = False
             
     def create_csv_file(self):
-        '''Create CSV file with headers for telemetry data'''
-        with open(self.csv_filename, 'w', newline='') as csvfile:
-            fieldnames = [
-                'timestamp', 'angle', 'curLapTime', 'damage', 'distFromStart', 
-                'distRaced', 'fuel', 'gear', 'lastLapTime', 'racePos', 'rpm',
-                'speedX', 'speedY', 'speedZ', 'trackPos', 'z', 'opponents','wheelSpinVel','focus','track',
-                'accel_input', 'brake_input', 'steer_input', 'gear_input',
-                'key_w', 'key_s', 'key_a', 'key_d' 
-            ]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
+        '''Create CSV file with headers for telemetry data, rows are written in the background'''
+        self.telemetry = telemetry.TelemetryWriter(self.csv_filename)
         print(f"Telemetry will be saved to: {self.csv_filename}")
     
     def log_data(self):
-        '''Log current state and control data to CSV'''
-        with open(self.csv_filename, 'a', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=[
-                'timestamp', 'angle', 'curLapTime', 'damage', 'distFromStart', 
-                'distRaced', 'fuel', 'gear', 'lastLapTime', 'racePos', 'rpm',
-                'speedX', 'speedY', 'speedZ', 'trackPos','opponents','wheelSpinVel','focus','track', 'z',
-                'accel_input', 'brake_input', 'steer_input', 'gear_input',
-                'key_w', 'key_s', 'key_a', 'key_d'  
-            ])
-            
-       
-            data = {
-                'timestamp': time.time(),
-                'angle': self.state.angle,
-                'curLapTime': self.state.curLapTime,
-                'damage': self.state.damage,
-                'distFromStart': self.state.distFromStart,
-                'distRaced': self.state.distRaced,
-                'fuel': self.state.fuel,
-                'gear': self.state.gear,
-                'lastLapTime': self.state.lastLapTime,
-                'racePos': self.state.racePos,
-                'rpm': self.state.rpm,
-                'speedX': self.state.speedX,
-                'speedY': self.state.speedY,
-                'speedZ': self.state.speedZ,
-                'trackPos': self.state.trackPos,
-                'opponents': self.state.opponents,
-                'wheelSpinVel': self.state.wheelSpinVel,
-                'focus': self.state.focus,
-                'track': self.state.track,
-                'z': self.state.z,
-                'accel_input': self.control.getAccel(),
-                'brake_input': self.control.getBrake(),
-                'steer_input': self.control.getSteer(),
-                'gear_input': self.control.getGear(),
-                # Store keyboard states (1 for pressed, 0 for not pressed)
-                'key_w': 1 if keyboard.is_pressed('w') else 0,
-                'key_s': 1 if keyboard.is_pressed('s') else 0,
-                'key_a': 1 if keyboard.is_pressed('a') else 0,
-                'key_d': 1 if keyboard.is_pressed('d') else 0
-            }
-            
-            writer.writerow(data)
+        '''Queue current state and control data for the telemetry writer'''
+        self.telemetry.write((
+            time.time(),
+            self.state.angle,
+            self.state.curLapTime,
+            self.state.damage,
+            self.state.distFromStart,
+            self.state.distRaced,
+            self.state.fuel,
+            self.state.gear,
+            self.state.lastLapTime,
+            self.state.racePos,
+            self.state.rpm,
+            self.state.speedX,
+            self.state.speedY,
+            self.state.speedZ,
+            self.state.trackPos,
+            self.state.z,
+            self.state.opponents,
+            self.state.wheelSpinVel,
+            self.state.focus,
+            self.state.track,
+            self.control.getAccel(),
+            self.control.getBrake(),
+            self.control.getClutch(),
+            self.control.getSteer(),
+            self.control.getGear(),
+            # Store keyboard states (1 for pressed, 0 for not pressed)
+            1 if self.key_state.is_pressed('w') else 0,
+            1 if self.key_state.is_pressed('s') else 0,
+            1 if self.key_state.is_pressed('a') else 0,
+            1 if self.key_state.is_pressed('d') else 0,
+        ))
     
     def init(self):
         '''Return init string with rangefinder angles'''
@@ -165,12 +162,20 @@ class Driver(object):
         return self.parser.stringify({'init': self.angles})
     
     def drive(self, msg):
-        self.state.setFromMsg(msg)
+        self.stats.start()
+        msg = self.drive_tick(msg)
+        self.stats.finish()
+        return msg
+    
+    def drive_tick(self, msg):
+        self.decoder.decode(msg)
+        self.state.setFromDecoder(self.decoder)
+        self.stats.mark('parse')
         
-        # Check for mode switch
-        if keyboard.is_pressed('m'):
-            # Simple debounce
-            time.sleep(0.2)
+        self.key_state = self.keys.snapshot()
+        
+        # Check for mode switch, once per key press
+        if self.key_state.was_pressed('m'):
             if self.model_loaded:
                 self.ai_mode = not self.ai_mode
                 mode_name = "AI" if self.ai_mode else "Manual"
@@ -187,35 +192,26 @@ class Driver(object):
         # Save telemetry data
        # self.log_data()
         
-        if keyboard.is_pressed('q'):
+        if self.key_state.was_pressed('q'):
             print("User requested to quit")
             return "(meta 1)"
         
-        return self.control.toMsg()
+        msg = self.control.toMsg()
+        self.stats.mark('encode')
+        return msg
     
     def prepare_state_for_model(self, gear_override=None):
         '''Convert current car state to the format expected by the model'''
-        features = np.ndarray((71,), dtype=np.float64)
-        features[0] = self.state.angle
-        features[1] = self.state.distFromStart
-        features[2] = self.state.distRaced
-        features[3] = self.state.fuel
-        # Use gear_override if provided (for gear logic before prediction)
-        features[4] = gear_override if gear_override is not None else self.state.gear
-        features[5:41] = self.state.opponents
-        features[41] = self.state.racePos
-        features[42] = self.state.rpm
-        features[43] = self.state.speedX
-        features[44] = self.state.speedY
-        features[45] = self.state.speedZ
-        features[46:65] = self.state.track
-        features[65] = self.state.trackPos
-        features[66:70] = self.state.wheelSpinVel
-        features[70] = self.state.z
-
-        # Apply scaling as in client.py
-        features = (features - self.means) / self.stds
-        return features
+        # The decoder has already laid the sensor values out in model input order
+        features = self.decoder.features
+        gear_slot = self.schema.index('Gear')
+        if gear_override is not None and gear_slot is not None:
+            features[gear_slot] = gear_override
+        # Apply scaling as in client.py, in place
+        scaled_features = self.scaled_state[0]
+        np.subtract(features, self.means, out=scaled_features)
+        np.divide(scaled_features, self.stds, out=scaled_features)
+        return self.scaled_state
     
     def handle_ai_control(self):
         '''Use the trained neural network to control the car'''
@@ -243,12 +239,14 @@ class Driver(object):
             
             # Prepare input for the model with gear override
             scaled_state = self.prepare_state_for_model(gear_override=gear)
+            self.stats.mark('features')
             # --- Model prediction  ---
-            start_time = time.time()
+            start_time = time.perf_counter()
             predictions = self.model.predict(scaled_state.reshape(1, -1), batch_size=1).flatten()
-            end_time = time.time()
-            print(f"Model prediction time: {end_time - start_time:.4f} seconds")  
-            print(f"Predictions: {predictions}")
+            end_time = time.perf_counter()
+            self.stats.mark('inference')
+            log.debug("Model prediction time: %.3f ms", (end_time - start_time) * 1000)
+            log.debug("Predictions: %s", predictions)
            
             self.control.setAccel(predictions[0])
             self.control.setBrake(predictions[1])
@@ -257,8 +255,7 @@ class Driver(object):
             self.control.setGear(gear)
             self.current_steer = predictions[3]
         except Exception as e:
-            print(f"Error in AI control: {e}")
-            print("Falling back to manual control")
+            log.warning("Error in AI control, falling back to manual control: %s", e)
             self.ai_mode = False
             self.handle_keyboard_input()
     
@@ -313,7 +310,7 @@ class Driver(object):
             self.shift_delay -= 1
         
         # Handle acceleration (W key)
-        if keyboard.is_pressed('w'):
+        if self.key_state.is_pressed('w'):
             if gear == -1:  # If in reverse gear and pressing W, switch to first gear
                 gear = 1
             accel += self.acceleration_step
@@ -321,7 +318,7 @@ class Driver(object):
             if accel > 1.0:
                 accel = 1.0
         
-        if keyboard.is_pressed('s'):
+        if self.key_state.is_pressed('s'):
             if gear == -1:
                 # accelerate backwords
                 accel += self.acceleration_step
@@ -342,7 +339,7 @@ class Driver(object):
         if self.shift_delay == 0 and gear >= -1:  
             if gear == -1:
                 # Only shift out of reverse when going forward
-                if keyboard.is_pressed('w'):
+                if self.key_state.is_pressed('w'):
                     gear = 1
                     self.shift_delay = self.shift_delay_time
             else:
@@ -361,9 +358,9 @@ class Driver(object):
                         self.shift_delay = self.shift_delay_time
 
      
-        if keyboard.is_pressed('a'):  # Left turn (+1)
+        if self.key_state.is_pressed('a'):  # Left turn (+1)
             self.current_steer = min(1.0, self.current_steer + self.steer_step)
-        elif keyboard.is_pressed('d'):  # Right turn (-1)
+        elif self.key_state.is_pressed('d'):  # Right turn (-1)
             self.current_steer = max(-1.0, self.current_steer - self.steer_step)
         else:
             # Gradually return to center when no keys are pressed
@@ -385,7 +382,14 @@ class Driver(object):
         self.prev_rpm = rpm
     
     def onShutDown(self):
+        self.keys.close()
+        print("Tick latency:")
+        print(self.stats.report())
+        self.telemetry.flush()
         print("Session ended - telemetry saved to:", self.csv_filename)
+        if self.telemetry.dropped:
+            print(f"Telemetry rows dropped because the writer fell behind: {self.telemetry.dropped}")
     
     def onRestart(self):
+        self.telemetry.flush()
         print("Session restarted - continuing to log telemetry")
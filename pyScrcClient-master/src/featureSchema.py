@@ -0,0 +1,99 @@
+import os
+import pickle
+import numpy as np
+import sensorDecoder
+
+# Feature names used in the training data -> sensor tag sent by the server.
+# Names ending in _N are the N-th (1-based) value of a list sensor.
+NAME_TAGS = {
+    'Angle': 'angle',
+    'CurrentLapTime': 'curLapTime',
+    'Damage': 'damage',
+    'DistanceFromStart': 'distFromStart',
+    'DistanceCovered': 'distRaced',
+    'FuelLevel': 'fuel',
+    'Gear': 'gear',
+    'LastLapTime': 'lastLapTime',
+    'Opponent': 'opponents',
+    'RacePosition': 'racePos',
+    'RPM': 'rpm',
+    'SpeedX': 'speedX',
+    'SpeedY': 'speedY',
+    'SpeedZ': 'speedZ',
+    'Track': 'track',
+    'TrackPosition': 'trackPos',
+    'WheelSpinVelocity': 'wheelSpinVel',
+    'Z': 'z',
+}
+
+# Names of the inputs of models/model_driver.tflite, the model the drivers run
+DRIVER_FEATURE_NAMES = 'model_driver_feature_names.pkl'
+
+
+def name_to_slot(name):
+    '''Map a feature name such as "Track_3" to its (sensor tag, element) pair'''
+    if name in NAME_TAGS:
+        return NAME_TAGS[name], 0
+    base, _, number = name.rpartition('_')
+    if base in NAME_TAGS and number.isdigit() and int(number) > 0:
+        return NAME_TAGS[base], int(number) - 1
+    raise ValueError('Unknown feature name: %s' % name)
+
+
+class FeatureSchema(object):
+    '''
+    The input layout of a model: which sensor value goes into which input,
+    and the scaling applied to it
+    '''
+
+    def __init__(self, names, means=None, stds=None):
+        '''Constructor'''
+        self.names = list(names)
+        self.slots = [name_to_slot(name) for name in self.names]
+        if len(set(self.slots)) != len(self.slots):
+            raise ValueError('Feature names map to the same sensor value more than once')
+
+        self.means = None
+        self.stds = None
+        if means is not None or stds is not None:
+            if means is None or stds is None:
+                raise ValueError('Feature scaling needs both means and stds')
+            self.means = np.asarray(means, dtype=np.float32).reshape(-1)
+            self.stds = np.asarray(stds, dtype=np.float32).reshape(-1)
+            if self.means.size != len(self.names) or self.stds.size != len(self.names):
+                raise ValueError('Schema has %d features but means/stds have %d/%d values'
+                                 % (len(self.names), self.means.size, self.stds.size))
+            if not np.all(self.stds > 0):
+                raise ValueError('stds must be positive')
+
+    @classmethod
+    def load(cls, model_dir, names_file=DRIVER_FEATURE_NAMES, means_file='means.npy', stds_file='stds.npy'):
+        '''Load the feature names pickle and the matching means/stds from a models directory'''
+        with open(os.path.join(model_dir, names_file), 'rb') as f:
+            names = pickle.load(f)
+        means = stds = None
+        if means_file is not None:
+            means = np.load(os.path.join(model_dir, means_file), allow_pickle=True)
+        if stds_file is not None:
+            stds = np.load(os.path.join(model_dir, stds_file), allow_pickle=True)
+        return cls(names, means, stds)
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, name):
+        '''Input index of a feature name, or None if the model does not use it'''
+        try:
+            return self.names.index(name)
+        except ValueError:
+            return None
+
+    def decoder(self):
+        '''A SensorDecoder that fills features in this schema's input order'''
+        return sensorDecoder.SensorDecoder(slots=self.slots)
+
+    def check_width(self, width, what='model'):
+        '''Raise if a model or data file does not take this many features'''
+        if int(width) != len(self.names):
+            raise ValueError('%s expects %d inputs but the feature schema has %d'
+                             % (what, int(width), len(self.names)))
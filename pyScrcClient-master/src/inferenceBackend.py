@@ -0,0 +1,314 @@
+'''
+Inference backends for the driver's model, created by name:
+
+    model = inferenceBackend.create('numpy', model_dir)
+    outputs = model.predict(scaled_state)    # (1, inputs) row -> (outputs,) row
+
+Every backend loads its own export of the same network (model_driver.keras,
+model_driver.tflite, model_driver.npz, the _raw variants with the scaler folded
+in, or the full-integer _int8 exports of quantizeExport.py). 'auto' (select()) loads every backend this host can run, checks
+each one against the reference test vector and picks the fastest that agrees.
+'''
+import os
+import time
+import pickle
+import numpy as np
+import mlpModel
+import modelRuntime
+
+# Export the driver runs, the backend adds the extension
+MODEL_STEM = 'model_driver'
+
+
+class InferenceBackend(object):
+    '''
+    A loaded model. predict() returns a row that may be reused by the next call; it is
+    the backend's own array, never a view into a runtime's memory, so it can be kept.
+    '''
+    name = None
+    extension = None
+    variant = ''  # file name suffix of the export the backend loads
+
+    def __init__(self, path, raw_input=False, num_threads=None):
+        '''Constructor, loads the model file'''
+        self.path = path
+        self.raw_input = raw_input
+        self.batch_input = None
+
+    def predict(self, row):
+        '''Model outputs for one (1, inputs) row'''
+        raise NotImplementedError
+
+    def setup_batch(self, capacity):
+        '''Prepare predict_batch() for up to capacity rows'''
+        self.batch_input = np.zeros((capacity, self.input_width), dtype=np.float32)
+
+    def predict_batch(self, rows):
+        '''Model outputs (n, outputs) for a list of n (1, inputs) rows in one forward pass'''
+        n = len(rows)
+        for i, row in enumerate(rows):
+            self.batch_input[i] = row[0]
+        return self.predict_rows(self.batch_input[:n])
+
+    def predict_rows(self, x):
+        '''Model outputs for an (n, inputs) array'''
+        raise NotImplementedError
+
+
+class NumpyBackend(InferenceBackend):
+    '''
+    mlpModel.NumpyMLP on the weights exported by mlpExport.py
+    '''
+    name = 'numpy'
+    extension = 'npz'
+    model_class = mlpModel.NumpyMLP
+
+    def __init__(self, path, raw_input=False, num_threads=None):
+        '''Constructor'''
+        InferenceBackend.__init__(self, path, raw_input, num_threads)
+        self.model = self.model_class.load(path)
+        if self.model.raw_input != raw_input:
+            raise ValueError(f"{path} does not match raw_input={raw_input}")
+        self.input_width = self.model.input_width
+
+    def predict(self, row):
+        return self.model.predict(row)[0]
+
+    def predict_rows(self, x):
+        return self.model.predict(x)
+
+
+class QuantizedBackend(NumpyBackend):
+    '''
+    The NumPy weights quantized to int8 at load time (mlpModel.QuantizedMLP)
+    '''
+    name = 'numpy_int8'
+    model_class = mlpModel.QuantizedMLP
+
+
+class Int8Backend(NumpyBackend):
+    '''
+    The full-integer model written by quantizeExport.py (mlpModel.Int8MLP)
+    '''
+    name = 'numpy_full_int8'
+    variant = '_int8'
+    model_class = mlpModel.Int8MLP
+
+
+class TFLiteBackend(InferenceBackend):
+    '''
+    TFLite interpreter, writing its input tensor through a tensor() view and copying the
+    output into the backend's own array
+    '''
+    name = 'tflite'
+    extension = 'tflite'
+
+    def __init__(self, path, raw_input=False, num_threads=None):
+        '''Constructor'''
+        InferenceBackend.__init__(self, path, raw_input, num_threads)
+        self.interpreter = modelRuntime.tflite_interpreter(path, num_threads)
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.input_width = self.input_details[0]['shape'][-1]
+        self.bind_tensors()
+
+    def bind_tensors(self):
+        '''Look up the accessors of the interpreter's own input and output buffers.
+        They are called on every use: a view must not be held across invoke().'''
+        self.input_tensor = self.interpreter.tensor(self.input_details[0]['index'])
+        self.output_tensor = self.interpreter.tensor(self.output_details[0]['index'])
+        self.outputs = np.empty(self.output_tensor().shape, dtype=np.float32)
+
+    def predict(self, row):
+        # Write into the input tensor in place (no set_tensor copy or dtype/shape checks)
+        self.input_tensor()[0] = row[0]
+        self.interpreter.invoke()
+        # Copy out of the interpreter (a held view makes the next invoke() raise),
+        # into a preallocated array rather than get_tensor's new one
+        self.outputs[0] = self.output_tensor()[0]
+        return self.outputs[0]
+
+    def setup_batch(self, capacity):
+        # The batch is always run at full size, unused rows are ignored,
+        # so the interpreter is resized once and never reallocated
+        self.interpreter.resize_tensor_input(self.input_details[0]['index'], (capacity, self.input_width))
+        self.interpreter.allocate_tensors()
+        self.bind_tensors()
+
+    def predict_batch(self, rows):
+        n = len(rows)
+        # Rows go straight into the interpreter's input buffer
+        batch_input = self.input_tensor()
+        for i, row in enumerate(rows):
+            batch_input[i] = row[0]
+        del batch_input
+        self.interpreter.invoke()
+        self.outputs[:n] = self.output_tensor()[:n]
+        return self.outputs[:n]
+
+    def predict_rows(self, x):
+        return np.array([self.predict(row[None]).copy() for row in x])
+
+
+class TFLiteInt8Backend(TFLiteBackend):
+    '''
+    The full-integer TFLite model written by quantizeExport.py (float input and output)
+    '''
+    name = 'tflite_int8'
+    variant = '_int8'
+
+
+class KerasBackend(InferenceBackend):
+    '''
+    The Keras model, called directly (Model.predict costs milliseconds per call)
+    '''
+    name = 'keras'
+    extension = 'keras'
+
+    def __init__(self, path, raw_input=False, num_threads=None):
+        '''Constructor'''
+        InferenceBackend.__init__(self, path, raw_input, num_threads)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)  # before importing TensorFlow
+        self.model = modelRuntime.load_keras_model(path, compile=False)
+        self.input_width = self.model.input_shape[-1]
+
+    def predict(self, row):
+        return self.predict_rows(row)[0]
+
+    def predict_rows(self, x):
+        return np.asarray(self.model(x, training=False))
+
+
+BACKENDS = dict((backend.name, backend) for backend in (TFLiteBackend, NumpyBackend, QuantizedBackend, KerasBackend,
+                                                        TFLiteInt8Backend, Int8Backend))
+# Backend names for command-line choices, 'auto' runs select()
+CHOICES = tuple(BACKENDS) + ('auto',)
+
+
+def model_path(name, model_dir, raw_input=False, stem=MODEL_STEM):
+    '''File the named backend loads'''
+    suffix = "_raw" if raw_input else ""
+    backend = BACKENDS[name]
+    return os.path.join(model_dir, f"{stem}{suffix}{backend.variant}.{backend.extension}")
+
+
+def create(name, model_dir, raw_input=False, num_threads=None, stem=MODEL_STEM):
+    '''Load the model for one backend by name'''
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {name}")
+    return BACKENDS[name](model_path(name, model_dir, raw_input, stem), raw_input, num_threads)
+
+
+def load_file(path, num_threads=None):
+    '''Load any model file with the backend its extension calls for; .tflite and .keras
+    files take raw inputs when their name has _raw, like the exports of mlpExport.py'''
+    extension = os.path.splitext(path)[1]
+    if extension == '.npz':
+        model = mlpModel.load(path)
+        backend = Int8Backend if isinstance(model, mlpModel.Int8MLP) else NumpyBackend
+        return backend(path, model.raw_input)
+    raw_input = '_raw' in os.path.basename(path)
+    if extension == '.tflite':
+        return TFLiteBackend(path, raw_input, num_threads)
+    if extension in ('.keras', '.h5'):
+        return KerasBackend(path, raw_input)
+    raise ValueError(f"Not a model file: {path}")
+
+
+def sample_feature_names(names):
+    '''Column names of test_data.npz's sample_data. It was saved from the training frame,
+    which has Gear after FuelLevel and no Z column, not in the order of feature_names.pkl.'''
+    names = list(names)
+    if 'Gear' in names or 'FuelLevel' not in names:
+        return names
+    fuel = names.index('FuelLevel')
+    return [name for name in names[:fuel + 1] + ['Gear'] + names[fuel + 1:] if name != 'Z']
+
+
+def test_data_rows(schema, model_dir, max_sigma=10.0):
+    '''Raw rows of the test_data.npz sample, laid out by feature name in the schema's
+    order (features it lacks at their mean); empty when the directory has no test data.
+    Raises if a value is more than max_sigma standard deviations from its mean: the
+    columns do not match the names then, and the rows would be no test at all.'''
+    test_data = os.path.join(model_dir, 'test_data.npz')
+    names_path = os.path.join(model_dir, 'feature_names.pkl')
+    if not (os.path.exists(test_data) and os.path.exists(names_path)):
+        return np.empty((0, len(schema)), dtype=np.float32)
+    with open(names_path, 'rb') as f:
+        names = sample_feature_names(pickle.load(f))
+    with np.load(test_data) as data:
+        sample = data['sample_data'].reshape(-1, len(names))
+    rows = np.tile(schema.means, (len(sample), 1))
+    for i, name in enumerate(schema.names):
+        if name in names:
+            rows[:, i] = sample[:, names.index(name)]
+    sigma = np.abs(rows - schema.means) / schema.stds
+    if not np.isfinite(rows).all() or (sigma > max_sigma).any():
+        worst = int(np.nanargmax(sigma.max(axis=0)))
+        raise ValueError(f"{test_data} does not fit the feature schema: {schema.names[worst]} is "
+                         f"{sigma[:, worst].max():.0f} standard deviations from its mean")
+    return rows.astype(np.float32)
+
+
+def test_inputs(schema, model_dir, raw_input=False, samples=64, seed=0):
+    '''Model inputs to check a backend on: the test_data.npz sample and random rows
+    around the means. Scaled unless raw_input.'''
+    random_rows = schema.means + schema.stds * np.random.default_rng(seed).standard_normal((samples, len(schema)))
+    x = np.concatenate([test_data_rows(schema, model_dir), random_rows]).astype(np.float32)
+    if not raw_input:
+        x = (x - schema.means) / schema.stds
+    return x.astype(np.float32)
+
+
+def time_calls(model, x, calls=300):
+    '''Median seconds of a batch-1 predict() call, cycling through the rows of x'''
+    for i in range(min(calls, 20)):
+        model.predict(x[i % len(x)][None])
+    elapsed = np.empty(calls)
+    for i in range(calls):
+        row = x[i % len(x)][None]
+        t = time.perf_counter()
+        model.predict(row)
+        elapsed[i] = time.perf_counter() - t
+    return float(np.median(elapsed))
+
+
+def select(schema, model_dir, raw_input=False, num_threads=None, names=None, reference=('keras', 'numpy'),
+           tolerance=1e-2, calls=300, stem=MODEL_STEM):
+    '''Load every backend in names that this host can run, and return the fastest one whose
+    mean absolute output difference from the reference backend (the first of reference
+    that loads) is within tolerance, along with a report line per backend'''
+    names = list(names or BACKENDS)
+    x = test_inputs(schema, model_dir, raw_input)
+    loaded, report = [], []
+    for name in names:
+        try:
+            model = create(name, model_dir, raw_input, num_threads, stem)
+            schema.check_width(model.input_width, model.path)
+        except Exception as e:
+            report.append(f"{name:10s} unavailable: {e}")
+            continue
+        loaded.append((name, model))
+
+    expected = None
+    for name, model in loaded:
+        if name in reference and (expected is None or reference.index(name) < expected[0]):
+            expected = (reference.index(name), name, model.predict_rows(x).copy())
+    if expected is None:
+        report.append(f"No reference backend ({', '.join(reference)}) loaded, outputs are not checked")
+
+    best = None
+    for name, model in loaded:
+        error = 0.0
+        if expected is not None:
+            error = float(np.abs(model.predict_rows(x) - expected[2]).mean())
+        seconds = time_calls(model, x, calls)
+        accepted = error <= tolerance
+        report.append(f"{name:10s} {seconds * 1e6:9.1f} us/call  mean abs diff {error:.6f}"
+                      + ("" if accepted else f"  rejected (tolerance {tolerance:g})"))
+        if accepted and (best is None or seconds < best[0]):
+            best = (seconds, model)
+    if best is None:
+        raise ValueError("No inference backend is available and within tolerance")
+    return best[1], report
@@ -0,0 +1,101 @@
+'''
+Memoized model outputs for sensor states that repeat: a car idle on the grid,
+stuck against a wall or backing out of a spin sends nearly the same state tick
+after tick. The model input row is quantized to a grid (resolution in standard
+deviations of each feature) and the outputs for that cell are kept in a
+bounded LRU table. The default resolution is small because the driver model
+is steep: a 0.01 std change of SpeedX alone moves accel by up to 0.07.
+
+Quantizing changes the answer slightly, so the cache is only consulted while
+the car is nearly still: when SpeedX or TrackPosition moved more than the
+guard allows since the previous tick, the model runs and nothing is stored.
+'''
+import numpy as np
+from collections import OrderedDict
+
+
+class InferenceCache(object):
+    '''
+    LRU cache of one car's model outputs, keyed on the quantized input row
+    '''
+
+    def __init__(self, schema, raw_input=False, capacity=4096, resolution=0.001, max_speed_change=0.5,
+                 max_trackpos_change=0.005):
+        '''Constructor, resolution is the grid step in standard deviations; max_speed_change
+        (km/h) and max_trackpos_change are the largest changes since the previous tick
+        for which the cache is used'''
+        self.model = None
+        self.capacity = capacity
+        stds = schema.stds.astype(np.float64)
+        # Multiplier from model input to grid cell: raw inputs are in sensor units
+        step = resolution * stds if raw_input else np.full(len(schema), resolution)
+        self.inverse_step = (1.0 / step).astype(np.float32)
+        self.guards = []  # (input index, largest change in model input units)
+        for name, limit in (('SpeedX', max_speed_change), ('TrackPosition', max_trackpos_change)):
+            index = schema.index(name)
+            if index is not None:
+                self.guards.append((index, limit if raw_input else limit / stds[index]))
+        self.previous = None
+        self.quantized = np.empty(len(schema), dtype=np.float32)
+        self.cell = np.empty(len(schema), dtype=np.int64)
+        self.entries = OrderedDict()
+        self.key = None  # cell of the last miss, stored by store()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypassed = 0
+
+    def set_model(self, model):
+        '''Cache the outputs of another model, dropping those of the old one'''
+        self.model = model
+        self.entries.clear()
+        self.key = None
+
+    def lookup(self, row):
+        '''Cached outputs for a (1, inputs) row, or None; after a miss, store() keeps the
+        outputs the model gives for it'''
+        x = row[0]
+        current = [x[index] for index, _ in self.guards]
+        previous, self.previous = self.previous, current
+        self.key = None
+        if previous is None or any(abs(value - last) > limit
+                                   for value, last, (_, limit) in zip(current, previous, self.guards)):
+            self.bypassed += 1
+            return None
+        np.multiply(x, self.inverse_step, out=self.quantized)
+        np.rint(self.quantized, out=self.quantized)
+        self.cell[:] = self.quantized
+        key = self.cell.tobytes()
+        outputs = self.entries.get(key)
+        if outputs is None:
+            self.misses += 1
+            self.key = key
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return outputs
+
+    def store(self, outputs):
+        '''Keep the outputs for the row of the last lookup() miss'''
+        if self.key is None:
+            return
+        self.entries[self.key] = np.array(outputs, dtype=np.float32)  # the model may reuse its row
+        self.key = None
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def predict(self, row):
+        '''Cached outputs, or the model's (stored for next time)'''
+        outputs = self.lookup(row)
+        if outputs is None:
+            outputs = self.model.predict(row)
+            self.store(outputs)
+        return outputs
+
+    def report(self):
+        lookups = self.hits + self.misses + self.bypassed
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return (f"Inference cache: {self.hits} hits ({rate:.1f}%), {self.misses} misses, "
+                f"{self.bypassed} bypassed by the guard, {self.evictions} evictions, "
+                f"{len(self.entries)} of {self.capacity} entries")
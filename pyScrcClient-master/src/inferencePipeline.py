@@ -0,0 +1,99 @@
+'''
+Inference on a worker thread, pipelined with the client's socket I/O. The
+control loop hands over the feature row of each sensor frame and takes the
+newest finished action, without waiting for the forward pass; NumPy and TFLite
+release the GIL while they compute, so on a multi-core host the inference of
+frame n overlaps the sending of the reply and the receiving of frame n + 1.
+
+Input and output are double-buffered: the loop writes the next row while the
+worker reads the previous one, and the worker writes its result while the
+loop copies out the last one. Every row carries its frame's sequence number,
+and latest() says which frame the action was computed from, so the lag is
+explicit (0 when the worker kept up and the loop waited for it).
+'''
+import threading
+import numpy as np
+import clientLog
+
+log = clientLog.get_logger('inferencePipeline')
+
+
+class InferencePipeline(object):
+    '''
+    A worker thread running run(row) on the newest submitted row
+    '''
+
+    def __init__(self, width, run=None):
+        '''Constructor, width is the number of model inputs and run the model call
+        (it can be replaced between frames, e.g. by a model swap)'''
+        self.run = run
+        self.condition = threading.Condition()
+        self.inputs = [np.zeros((1, width), dtype=np.float32) for _ in range(2)]  # [pending, working]
+        self.pending = None      # sequence number of the row in inputs[0], None once taken
+        self.outputs = None      # [published, being written]
+        self.sequence = -1       # frame of the published outputs
+        self.delivered = None    # the control loop's copy of the published outputs
+        self.error = None
+        self.inferences = 0
+        self.superseded = 0      # rows replaced by a newer one before the worker took them
+        self.running = True
+        self.thread = threading.Thread(target=self.work, name='inference', daemon=True)
+        self.thread.start()
+
+    def submit(self, row, sequence):
+        '''Hand over the (1, inputs) row of a frame; it replaces a row the worker has not taken yet'''
+        with self.condition:
+            if self.pending is not None:
+                self.superseded += 1
+            self.inputs[0][:] = row
+            self.pending = sequence
+            self.condition.notify_all()
+
+    def latest(self, sequence=None, wait=0.0):
+        '''(outputs, frame) of the newest finished inference, (None, -1) before the first.
+        With wait, waits up to that many seconds for the given frame's result.
+        The outputs are the caller's copy, overwritten by the next call.'''
+        with self.condition:
+            if wait and sequence is not None and self.sequence < sequence:
+                self.condition.wait_for(lambda: self.sequence >= sequence or self.error is not None, wait)
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+            if self.sequence < 0:
+                return None, -1
+            if self.delivered is None:
+                self.delivered = np.empty_like(self.outputs[0])
+            self.delivered[:] = self.outputs[0]
+            return self.delivered, self.sequence
+
+    def work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None or not self.running)
+                if not self.running:
+                    return
+                # The pending row becomes the working one, the old working buffer takes the next row
+                self.inputs.reverse()
+                sequence, self.pending = self.pending, None
+            try:
+                outputs = self.run(self.inputs[1])
+            except Exception as e:
+                log.warning("Inference failed on frame %d: %s", sequence, e)
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                continue
+            if self.outputs is None:
+                self.outputs = [np.zeros(np.shape(outputs), dtype=np.float32) for _ in range(2)]
+            self.outputs[1][:] = outputs  # the model may reuse its output row
+            with self.condition:
+                self.outputs.reverse()
+                self.sequence = sequence
+                self.inferences += 1
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout=1.0)
@@ -0,0 +1,416 @@
+'''
+Local inference daemon: one process holds the model and runs it for every
+pyclient.py / asyncClient.py on the host, so the clients carry no model or
+inference runtime and their forward passes share one set of cores.
+
+    python inferenceServer.py --backend tflite --threads 2
+    python pyclient.py --port 3001 --inference-server torcs-inference
+    python pyclient.py --port 3002 --inference-server torcs-inference
+
+Clients and daemon talk through one multiprocessing.shared_memory segment, with
+a slot per client:
+
+    header     float64[8]            layout check and the daemon's heartbeat
+    requests   int64[slots]          sequence number of the slot's last request
+    responses  int64[slots]          sequence number of the last answered request
+    attached   int64[slots]          1 while a client owns the slot
+    inputs     float32[slots, width] feature rows
+    outputs    float32[slots, outs]  model outputs
+
+A client writes its row, then bumps its request number; the daemon answers the
+slots whose request is ahead of their response, writing the outputs before the
+response number. Each number has one writer and is a single aligned 8-byte
+store, and there is no lock: the row must be visible to the other process
+before the number stored after it, which holds on x86 (stores and loads are
+each kept in order, and NumPy copies rows this small with plain stores) but not
+on ARM64 or other weakly ordered CPUs, where Python cannot issue a fence. The
+daemon and its clients refuse to run there. A client that takes over a slot
+starts its sequence numbers in a new generation (the high bits), so an answer
+to the previous owner's last request can never match one of its own. Once one
+request is pending, the daemon waits up to the batch window for the other
+attached clients and runs them all in one forward pass.
+
+A client whose daemon is missing, serves another model or stops answering
+runs the model in process instead (RemoteModel's fallback). A single late reply
+is not enough: the client repeats its last answer for that tick and falls back
+after several late replies in a row, or once the heartbeat stopped. The first
+late reply starts loading the in-process model on a thread, so the switch does
+not make a tick wait for the load.
+'''
+import os
+import sys
+import time
+import signal
+import platform
+import argparse
+import threading
+import tempfile
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+import clientLog
+import featureSchema
+import inferenceBackend
+
+log = clientLog.get_logger('inferenceServer')
+
+DEFAULT_NAME = 'torcs-inference'
+MAGIC = 0x54524353  # 'TRCS'
+# header fields
+H_MAGIC, H_WIDTH, H_OUTPUTS, H_SLOTS, H_RAW_INPUT, H_HEARTBEAT, H_PID = range(7)
+HEADER_SIZE = 8
+# Sequence numbers are generation << GENERATION_SHIFT + request count
+GENERATION_SHIFT = 40
+# CPUs that keep stores in order, see the module docstring
+ORDERED_MACHINES = ('x86_64', 'amd64', 'x86', 'i386', 'i686')
+
+
+def check_machine():
+    '''Raise ValueError on a CPU the lock-free ring is not safe on'''
+    machine = platform.machine().lower()
+    if machine not in ORDERED_MACHINES:
+        raise ValueError(f"the inference server needs an x86 CPU, this one is {machine or 'unknown'} "
+                         f"and may reorder the shared memory stores")
+
+
+def layout(slots, width, outputs):
+    '''Byte offsets of the segment's arrays and its total size'''
+    offsets = {}
+    offset = HEADER_SIZE * 8
+    for name, size in (('requests', 8 * slots), ('responses', 8 * slots), ('attached', 8 * slots),
+                       ('inputs', 4 * slots * width), ('outputs', 4 * slots * outputs)):
+        offsets[name] = offset
+        offset += (size + 63) // 64 * 64  # keep every array on its own cache lines
+    return offsets, offset
+
+
+class SharedRing(object):
+    '''
+    NumPy views of the shared segment
+    '''
+
+    def __init__(self, shm, slots, width, outputs):
+        '''Constructor'''
+        self.shm = shm
+        offsets, _ = layout(slots, width, outputs)
+        buf = shm.buf
+        self.header = np.ndarray((HEADER_SIZE,), np.float64, buf, 0)
+        self.requests = np.ndarray((slots,), np.int64, buf, offsets['requests'])
+        self.responses = np.ndarray((slots,), np.int64, buf, offsets['responses'])
+        self.attached = np.ndarray((slots,), np.int64, buf, offsets['attached'])
+        self.inputs = np.ndarray((slots, width), np.float32, buf, offsets['inputs'])
+        self.outputs = np.ndarray((slots, outputs), np.float32, buf, offsets['outputs'])
+
+    @classmethod
+    def create(cls, name, slots, width, outputs, raw_input):
+        '''New segment, replacing one left behind by a daemon that did not shut down'''
+        size = layout(slots, width, outputs)[1]
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        ring = cls(shm, slots, width, outputs)
+        ring.header[:] = 0
+        ring.requests[:] = 0
+        ring.responses[:] = 0
+        ring.attached[:] = 0
+        ring.header[[H_WIDTH, H_OUTPUTS, H_SLOTS, H_RAW_INPUT, H_PID]] = (width, outputs, slots, raw_input,
+                                                                           os.getpid())
+        ring.header[H_HEARTBEAT] = time.monotonic()
+        ring.header[H_MAGIC] = MAGIC  # last: the segment is ready
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        '''Existing segment; raises FileNotFoundError if there is none'''
+        shm = shared_memory.SharedMemory(name)
+        # The segment belongs to the daemon: without this, Python's resource tracker
+        # would unlink it when this client exits (bpo-39959); Windows does not track it
+        if os.name == 'posix':
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        header = np.ndarray((HEADER_SIZE,), np.float64, shm.buf, 0)
+        if header[H_MAGIC] != MAGIC:
+            del header
+            shm.close()
+            raise ValueError(f"shared memory {name} is not an inference server")
+        slots, width, outputs = (int(v) for v in header[[H_SLOTS, H_WIDTH, H_OUTPUTS]])
+        del header
+        return cls(shm, slots, width, outputs)
+
+    def close(self):
+        del self.header, self.requests, self.responses, self.attached, self.inputs, self.outputs
+        self.shm.close()
+
+
+class InferenceServer(object):
+    '''
+    Serves one loaded model (an inferenceBackend) to the clients of a shared ring
+    '''
+
+    def __init__(self, model, name=DEFAULT_NAME, slots=16, window=300e-6, idle_sleep=50e-6):
+        '''Constructor, window is how long a pending request waits for the other clients
+        and idle_sleep how long the daemon sleeps when no request is pending'''
+        check_machine()
+        self.model = model
+        self.name = name
+        self.window = window
+        self.idle_sleep = idle_sleep
+        self.outputs = len(model.predict(np.zeros((1, model.input_width), dtype=np.float32)))
+        self.model.setup_batch(slots)
+        self.ring = SharedRing.create(name, slots, model.input_width, self.outputs, model.raw_input)
+        self.running = True
+        self.batches = 0
+        self.rows = 0
+        self.busy = 0.0  # seconds spent waiting for the batch and running it
+
+    def pending(self):
+        return np.flatnonzero(self.ring.requests != self.ring.responses)
+
+    def serve(self):
+        '''Answer requests until stop() is called'''
+        ring = self.ring
+        while self.running:
+            ring.header[H_HEARTBEAT] = time.monotonic()
+            pending = self.pending()
+            if not len(pending):
+                time.sleep(self.idle_sleep)
+                continue
+            start = time.perf_counter()
+            # Micro-batch: give the other attached clients up to the window to send theirs
+            waiting = int(ring.attached.sum())
+            deadline = start + self.window
+            while len(pending) < waiting and time.perf_counter() < deadline:
+                pending = self.pending()
+            sequences = ring.requests[pending]  # read before the rows, they were written before it
+            if len(pending) == 1:
+                ring.outputs[pending[0]] = self.model.predict(ring.inputs[pending])
+            else:
+                ring.outputs[pending] = self.model.predict_batch([ring.inputs[i:i + 1] for i in pending])
+            ring.responses[pending] = sequences
+            self.busy += time.perf_counter() - start
+            self.batches += 1
+            self.rows += len(pending)
+
+    def stop(self, *args):
+        self.running = False
+
+    def close(self):
+        self.ring.header[H_MAGIC] = 0
+        shm = self.ring.shm
+        self.ring.close()
+        shm.unlink()
+
+
+class RemoteModel(object):
+    '''
+    Client side, used by the Driver like an inferenceBackend. fallback is called to load
+    an in-process model when the daemon stops answering within timeout seconds: after
+    max_misses late replies in a row, or once its heartbeat is older than max_heartbeat_age.
+    '''
+    name = 'server'
+
+    def __init__(self, name, schema, raw_input=False, fallback=None, timeout=0.005, max_heartbeat_age=1.0,
+                 max_misses=3):
+        '''Constructor, claims a slot of the named daemon; raises OSError or ValueError
+        if there is no daemon, it serves another model or it has no free slot, and
+        ValueError on a CPU that is not x86'''
+        check_machine()
+        self.path = name
+        self.raw_input = raw_input
+        self.fallback = fallback
+        self.timeout = timeout
+        self.max_heartbeat_age = max_heartbeat_age
+        self.max_misses = max_misses
+        self.misses = 0        # late replies in a row
+        self.late = 0          # late replies in total
+        self.last = None       # copy of the last answer, repeated for a late reply
+        self.local = None  # the in-process model once the daemon has failed
+        self.standby = None    # thread loading the fallback after the first late reply
+        self.standby_model = None
+        self.standby_error = None
+        self.batch_capacity = None
+        self.ring = SharedRing.attach(name)
+        try:
+            header = self.ring.header  # a view: the except below deletes it before closing
+            self.input_width = int(header[H_WIDTH])
+            schema.check_width(self.input_width, f"inference server {name}")
+            if bool(header[H_RAW_INPUT]) != raw_input:
+                raise ValueError(f"inference server {name} takes {'raw' if header[H_RAW_INPUT] else 'scaled'} inputs")
+            if time.monotonic() - header[H_HEARTBEAT] > max_heartbeat_age:
+                raise ValueError(f"inference server {name} (pid {int(header[H_PID])}) is not running")
+            self.slot, self.lock = self.claim_slot(name, len(self.ring.requests))
+        except Exception:
+            del header
+            self.ring.close()
+            raise
+        # The previous owner may have left a request in flight: its answer will carry
+        # that owner's sequence number, which is in an older generation than ours
+        last = max(int(self.ring.requests[self.slot]), int(self.ring.responses[self.slot]))
+        self.sequence = ((last >> GENERATION_SHIFT) + 1) << GENERATION_SHIFT
+        self.ring.attached[self.slot] = 1
+
+    @staticmethod
+    def lock_file(f):
+        '''Lock an open file without waiting, OSError if another process holds it'''
+        if os.name == 'nt':
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    @staticmethod
+    def claim_slot(name, slots):
+        '''First slot whose lock file this process can lock; the lock goes with the process'''
+        for slot in range(slots):
+            lock = open(os.path.join(tempfile.gettempdir(), f"{name}.slot{slot}.lock"), 'w')
+            try:
+                RemoteModel.lock_file(lock)
+            except OSError:
+                lock.close()
+                continue
+            return slot, lock
+        raise ValueError(f"inference server {name} has no free slot ({slots} in use)")
+
+    def predict(self, row):
+        if self.local is not None:
+            return self.local.predict(row)
+        ring = self.ring
+        self.sequence += 1
+        ring.inputs[self.slot] = row[0]
+        ring.requests[self.slot] = self.sequence
+        deadline = time.perf_counter() + self.timeout
+        while ring.responses[self.slot] != self.sequence:
+            if time.perf_counter() > deadline:
+                outputs = self.miss(row)
+                if outputs is not None:
+                    return outputs
+                deadline = time.perf_counter() + self.timeout  # nothing to repeat yet: wait once more
+            time.sleep(0)  # yield the core, the daemon may share it
+        self.misses = 0
+        if self.last is None:
+            self.last = np.empty_like(ring.outputs[self.slot])
+        self.last[:] = ring.outputs[self.slot]
+        return self.last
+
+    def miss(self, row):
+        '''No answer within the timeout: repeat the last one while the daemon looks alive
+        or the fallback is still loading, None to keep waiting when there is none yet'''
+        self.misses += 1
+        self.late += 1
+        if self.fallback is not None and self.standby is None:
+            self.standby = threading.Thread(target=self.load_standby, name='fallback-load', daemon=True)
+            self.standby.start()
+        heartbeat_age = time.monotonic() - self.ring.header[H_HEARTBEAT]
+        if heartbeat_age > self.max_heartbeat_age:
+            reason = f"its heartbeat stopped {heartbeat_age:.1f} s ago"
+        elif self.misses >= self.max_misses:
+            reason = f"{self.misses} replies in a row took longer than {self.timeout * 1000:.1f} ms"
+        else:
+            reason = None
+        if reason is None or (self.last is not None and self.standby is not None and self.standby.is_alive()):
+            log.info("Inference server %s late (%d in a row), %s", self.path, self.misses,
+                     'waiting again' if self.last is None else 'repeating the last answer')
+            return self.last
+        return self.fail(row, reason)
+
+    def load_standby(self):
+        '''Thread target: load the fallback model while the daemon may still recover'''
+        try:
+            model = self.fallback()
+            if self.batch_capacity is not None:
+                model.setup_batch(self.batch_capacity)
+            for _ in range(10):
+                model.predict(np.zeros((1, self.input_width), dtype=np.float32))
+            self.standby_model = model
+        except Exception as e:
+            self.standby_error = e
+
+    def fail(self, row, reason):
+        '''The daemon is not answering: continue with the in-process model'''
+        if self.fallback is None:
+            raise TimeoutError(f"inference server {self.path} is not answering: {reason}")
+        log.warning("Inference server %s is not answering (%s), running the model in process", self.path, reason)
+        self.close()
+        self.standby.join()  # only waits when there was no answer to repeat meanwhile
+        if self.standby_error is not None:
+            raise self.standby_error
+        self.local = self.standby_model
+        return self.local.predict(row)
+
+    def setup_batch(self, capacity):
+        self.batch_capacity = capacity
+        if self.local is not None:
+            self.local.setup_batch(capacity)
+
+    def predict_batch(self, rows):
+        return self.predict_rows(np.concatenate(rows))
+
+    def predict_rows(self, x):
+        return np.array([self.predict(row[None]).copy() for row in x])
+
+    def close(self):
+        if self.ring is None:
+            return
+        self.ring.attached[self.slot] = 0
+        self.ring.close()
+        self.ring = None
+        self.lock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the driver model to the clients on this host.')
+    parser.add_argument('--name', action='store', dest='name', default=DEFAULT_NAME,
+                        help='Shared memory name the clients pass as --inference-server (default: %s)' % DEFAULT_NAME)
+    parser.add_argument('--backend', action='store', dest='backend', default='tflite',
+                        choices=inferenceBackend.CHOICES,
+                        help='Inference backend, auto picks the fastest on this host (default: tflite)')
+    parser.add_argument('--raw-input', action='store_true', dest='raw_input',
+                        help='Serve the model exported with the scaler folded in (mlpExport.py --fold-scaler)')
+    parser.add_argument('--model-dir', action='store', dest='model_dir', default=None,
+                        help='Models directory (default: ../models)')
+    parser.add_argument('--threads', action='store', type=int, dest='threads', default=None,
+                        help='TFLite interpreter threads (default: the runtime\'s choice)')
+    parser.add_argument('--slots', action='store', type=int, dest='slots', default=16,
+                        help='Maximum number of clients (default: 16)')
+    parser.add_argument('--window-us', action='store', type=float, dest='window_us', default=300.0,
+                        help='How long a request waits for the other clients\' to batch them (default: 300)')
+    parser.add_argument('--log-level', action='store', dest='log_level', default='warning',
+                        choices=clientLog.LEVELS,
+                        help='Log level (default: warning)')
+    arguments = parser.parse_args(argv)
+    clientLog.setup(arguments.log_level)
+
+    model_dir = arguments.model_dir or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                    'models')
+    schema = featureSchema.FeatureSchema.load(model_dir)
+    if arguments.backend == 'auto':
+        model, report = inferenceBackend.select(schema, model_dir, arguments.raw_input, arguments.threads)
+        for line in report:
+            print('  ' + line)
+    else:
+        model = inferenceBackend.create(arguments.backend, model_dir, arguments.raw_input, arguments.threads)
+        schema.check_width(model.input_width, model.path)
+    try:
+        server = InferenceServer(model, arguments.name, arguments.slots, arguments.window_us * 1e-6)
+    except ValueError as e:
+        print('Cannot serve the model:', e)
+        return 1
+    signal.signal(signal.SIGINT, server.stop)
+    signal.signal(signal.SIGTERM, server.stop)
+    print(f'Serving {model.path} ({model.name}) as {arguments.name}: {arguments.slots} slots, '
+          f'batch window {arguments.window_us:.0f} us')
+    try:
+        server.serve()
+    finally:
+        server.close()
+    if server.batches:
+        print(f'Batches: {server.batches}, rows: {server.rows} ({server.rows / server.batches:.2f} per batch), '
+              f'{server.busy / server.batches * 1e6:.1f} us per batch')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+'''
+Keyboard input for the drivers. A background listener keeps the key state up to
+date and the control loop takes one snapshot per tick, instead of calling
+keyboard.is_pressed for every key it looks at.
+
+The keyboard module is only imported for a KeyboardInput, so headless clients
+(create(headless=True)) run without it and without root.
+'''
+import threading
+from collections import namedtuple
+
+# Keys the drivers react to
+KEYS = ('w', 's', 'a', 'd', 'm', 'q')
+
+
+class KeyState(namedtuple('KeyState', 'held pressed')):
+    '''
+    Key state at one tick: held are the keys that are down, pressed the keys
+    that went down since the previous snapshot (so a short tap is not missed)
+    '''
+    __slots__ = ()
+
+    def is_pressed(self, key):
+        return key in self.held
+
+    def was_pressed(self, key):
+        return key in self.pressed
+
+
+NO_KEYS = KeyState(frozenset(), frozenset())
+
+
+class KeyboardInput(object):
+    '''
+    Listens to key events on the keyboard module's hook thread and keeps
+    the state of KEYS, read with snapshot()
+    '''
+
+    def __init__(self, keys=KEYS):
+        '''Constructor, starts listening straight away'''
+        import keyboard
+        self.keyboard = keyboard
+        self.keys = frozenset(keys)
+        self.lock = threading.Lock()
+        self.held = set()
+        self.pressed = set()
+        keyboard.hook(self.on_event)
+
+    def on_event(self, event):
+        '''Hook callback, runs on the listener thread'''
+        name = (event.name or '').lower()
+        if name not in self.keys:
+            return
+        with self.lock:
+            if event.event_type == self.keyboard.KEY_DOWN:
+                if name not in self.held:  # auto-repeat is not a new press
+                    self.pressed.add(name)
+                self.held.add(name)
+            else:
+                self.held.discard(name)
+
+    def snapshot(self):
+        '''Current KeyState; the pressed edges are consumed by this call'''
+        with self.lock:
+            state = KeyState(frozenset(self.held), frozenset(self.pressed))
+            self.pressed.clear()
+        return state
+
+    def close(self):
+        self.keyboard.unhook(self.on_event)
+
+
+class NullInput(object):
+    '''
+    Headless input: no key is ever pressed
+    '''
+
+    def snapshot(self):
+        return NO_KEYS
+
+    def close(self):
+        pass
+
+
+def create(headless=False):
+    '''KeyboardInput, or NullInput when running headless'''
+    if headless:
+        return NullInput()
+    return KeyboardInput()
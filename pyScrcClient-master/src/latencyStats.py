@@ -0,0 +1,107 @@
+'''
+Per-stage latency of the control loop. Every tick is split into stages by
+calling mark() after each one; durations go into fixed-bucket, HDR-style
+histograms (64 sub-buckets per power of two, about 1.5% precision), so
+recording costs the same whatever the run length and nothing is allocated.
+'''
+import time
+import numpy as np
+
+# Stages of one tick, in order
+STAGES = ('receive', 'parse', 'features', 'inference', 'logging', 'encode', 'send')
+
+SUB_BUCKETS = 64
+MAX_SHIFT = 34  # values up to 2**41 ns (about 36 minutes)
+
+
+class Histogram(object):
+    '''
+    Log-linear histogram of integer nanosecond values
+    '''
+
+    def __init__(self):
+        '''Constructor'''
+        # A list, not an array: incrementing one element of a NumPy array is about 2x slower
+        self.counts = [0] * (SUB_BUCKETS * (MAX_SHIFT + 2))
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        shift = value.bit_length() - 7
+        if shift <= 0:
+            index = value
+        else:
+            shift = min(shift, MAX_SHIFT)
+            index = SUB_BUCKETS * shift + min(value >> shift, 2 * SUB_BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def bucket_value(self, index):
+        '''Middle of a bucket, in nanoseconds'''
+        if index < 2 * SUB_BUCKETS:
+            return index
+        shift = index // SUB_BUCKETS - 1
+        low = (index - SUB_BUCKETS * shift) << shift
+        return low + (1 << shift) // 2
+
+    def percentile(self, p):
+        '''Value (ns) below which p percent of the recorded values fall'''
+        if self.count == 0:
+            return 0
+        rank = max(1, int(np.ceil(self.count * p / 100.0)))
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(self.bucket_value(index), self.max)
+
+
+class TickStats(object):
+    '''
+    Histograms of every stage of a tick and of the whole tick, with the number
+    of ticks that overran the deadline
+    '''
+
+    def __init__(self, stages=STAGES, deadline=0.010):
+        '''Constructor, deadline in seconds (the server waits 10 ms for a reply)'''
+        self.stages = list(stages)
+        self.histograms = dict((stage, Histogram()) for stage in self.stages)
+        self.total = Histogram()
+        self.deadline = int(deadline * 1e9)
+        self.misses = 0
+        self.open = False
+        self.start_time = 0
+        self.last = 0
+
+    def start(self, t=None):
+        '''Begin a tick at t (time.perf_counter_ns(), default now), e.g. when its datagram arrived'''
+        self.start_time = self.last = t if t is not None else time.perf_counter_ns()
+        self.open = True
+
+    def mark(self, stage):
+        '''The stage that just ended, timed from the previous mark; ignored outside a tick'''
+        if not self.open:
+            return
+        now = time.perf_counter_ns()
+        self.histograms[stage].record(now - self.last)
+        self.last = now
+
+    def finish(self):
+        '''End the tick and check it against the deadline'''
+        if not self.open:
+            return
+        self.open = False
+        elapsed = time.perf_counter_ns() - self.start_time
+        self.total.record(elapsed)
+        if elapsed > self.deadline:
+            self.misses += 1
+
+    def report(self):
+        '''Summary table, in milliseconds'''
+        lines = ['%-10s %8s %9s %9s %9s' % ('stage', 'count', 'p50 ms', 'p99 ms', 'max ms')]
+        for name, histogram in [(stage, self.histograms[stage]) for stage in self.stages] + [('total', self.total)]:
+            if histogram.count:
+                lines.append('%-10s %8d %9.3f %9.3f %9.3f' % (
+                    name, histogram.count, histogram.percentile(50) / 1e6,
+                    histogram.percentile(99) / 1e6, histogram.max / 1e6))
+        lines.append('Deadline misses (%g ms): %d of %d ticks' % (self.deadline / 1e6, self.misses, self.total.count))
+        return '\n'.join(lines)
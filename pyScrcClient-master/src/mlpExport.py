@@ -0,0 +1,267 @@
+'''
+Export the Dense layers of a trained model to a flat .npz for mlpModel.NumpyMLP,
+and check that the NumPy network gives the same outputs as the original.
+
+    python mlpExport.py ../models/model_driver.tflite ../models/model_driver.npz
+    python mlpExport.py ../models/torcs_driver_model.keras ../models/torcs_driver_model.npz
+
+The check runs on recorded features: test_data.npz next to the model (its columns
+matched by feature name when the model takes other inputs) and, with --logs,
+telemetry sessions, topped up with random inputs.
+
+With --fold-scaler the input scaling is folded into the first layer, so the
+exported model (.npz, and optionally .keras/.tflite) takes raw sensor values:
+
+    python mlpExport.py ../models/model_driver.tflite ../models/model_driver_raw.npz --fold-scaler
+'''
+import os
+import sys
+import argparse
+import numpy as np
+import mlpModel
+import modelRuntime
+import featureSchema
+import inferenceBackend
+import replayServer
+import telemetry
+
+# Default --tolerance for exports of float models and of TFLite (dynamic-range) models
+FLOAT_TOLERANCE = 1e-2
+QUANTIZED_TOLERANCE = 0.025
+
+
+def layers_from_keras(model):
+    '''(kernel, bias, activation) of every Dense layer of a Keras model'''
+    layers = []
+    for layer in model.layers:
+        kind = layer.__class__.__name__
+        if kind in ('InputLayer', 'Dropout'):
+            continue  # no weights, Dropout is the identity at inference time
+        if kind != 'Dense':
+            raise ValueError('Cannot export layer %s of type %s' % (layer.name, kind))
+        kernel, bias = layer.get_weights()
+        layers.append((kernel, bias, layer.get_config()['activation']))
+    return layers
+
+
+def layers_from_tflite(interpreter):
+    '''(kernel, bias, activation) of every FULLY_CONNECTED op of a TFLite model,
+    with dynamic-range int8 weights dequantized back to float32'''
+    details = {d['index']: d for d in interpreter.get_tensor_details()}
+    layers = []
+    for op in interpreter._get_ops_details():
+        if op['op_name'] == 'DELEGATE':
+            continue
+        if op['op_name'] != 'FULLY_CONNECTED':
+            raise ValueError('Cannot export TFLite op %s' % op['op_name'])
+        weights = details[op['inputs'][1]]
+        kernel = interpreter.get_tensor(weights['index']).astype(np.float32)
+        scales = weights['quantization_parameters']['scales']
+        if scales.size:
+            zero_points = weights['quantization_parameters']['zero_points']
+            shape = [1] * kernel.ndim
+            shape[weights['quantization_parameters']['quantized_dimension']] = -1
+            kernel = (kernel - zero_points.reshape(shape)) * scales.reshape(shape)
+        bias = interpreter.get_tensor(op['inputs'][2]).astype(np.float32)
+        # The converter fuses the activation into the op and names the output after it
+        output_name = details[op['outputs'][0]]['name'].lower()
+        activation = 'relu' if 'relu' in output_name else 'linear'
+        layers.append((kernel.T, bias, activation))
+    return layers
+
+
+def load_source(path):
+    '''Return (NumpyMLP, reference predict function) for a .keras/.h5 or .tflite model'''
+    if path.endswith('.tflite'):
+        interpreter = modelRuntime.tflite_interpreter(path)
+        inp = interpreter.get_input_details()[0]['index']
+        out = interpreter.get_output_details()[0]['index']
+
+        def reference(x):
+            rows = []
+            for row in x:
+                interpreter.set_tensor(inp, row.reshape(1, -1).astype(np.float32))
+                interpreter.invoke()
+                rows.append(interpreter.get_tensor(out)[0].copy())
+            return np.array(rows)
+        layers = layers_from_tflite(interpreter)
+    else:
+        model = modelRuntime.load_keras_model(path, compile=False)
+
+        def reference(x):
+            return model.predict(x, verbose=0)
+        layers = layers_from_keras(model)
+
+    kernels, biases, activations = zip(*layers)
+    return mlpModel.NumpyMLP(kernels, biases, activations), reference
+
+
+def recorded_rows(mlp, model_dir, test_data=None, log_paths=(), samples=256, seed=0):
+    '''(raw rows, FeatureSchema) of real driving laid out by feature name for the model's
+    inputs, through the FeatureSchema of model_dir: the test_data.npz sample (73 features,
+    model_driver takes 71) and up to samples rows of telemetry logs. None if model_dir has
+    no schema of the model's width or there are no rows.'''
+    try:
+        schema = featureSchema.FeatureSchema.load(model_dir)
+    except (OSError, ValueError):
+        return None
+    if len(schema) != mlp.input_width:
+        return None
+    rows = [np.empty((0, len(schema)), dtype=np.float32)]
+    if test_data is not None:
+        rows.append(inferenceBackend.test_data_rows(schema, os.path.dirname(os.path.abspath(test_data))))
+    if log_paths:
+        logged = telemetry.feature_matrix(replayServer.load_records(log_paths), schema)
+        logged = logged[np.isfinite(logged).all(axis=1)]
+        if len(logged) > samples:
+            logged = logged[np.random.default_rng(seed).choice(len(logged), samples, replace=False)]
+        rows.append(logged)
+    rows = np.concatenate(rows)
+    return (rows, schema) if len(rows) else None
+
+
+def verify(mlp, reference, test_data=None, model_dir=None, log_paths=(), samples=256, seed=0):
+    '''(max, mean, description of the inputs) absolute difference between the NumPy network
+    and the original model on recorded features, topped up with random scaled inputs to
+    samples rows when there are fewer. The test_data.npz sample is used as it is when its
+    width matches, otherwise it and the telemetry logs are remapped by feature name (see
+    recorded_rows()).'''
+    recorded = []
+    if test_data is not None:
+        with np.load(test_data) as data:
+            scaled = data['scaled_sample']
+        if scaled.shape[-1] == mlp.input_width:
+            recorded.append(scaled.reshape(-1, mlp.input_width).astype(np.float32))
+            test_data = None
+    remapped = None if model_dir is None else recorded_rows(mlp, model_dir, test_data, log_paths, samples, seed)
+    if remapped is not None:
+        rows, schema = remapped
+        recorded.append(((rows - schema.means) / schema.stds).astype(np.float32))
+    recorded = np.concatenate([np.empty((0, mlp.input_width), dtype=np.float32)] + recorded)
+    drawn = max(samples - len(recorded), 0)
+    x = np.concatenate([recorded, np.random.default_rng(seed).standard_normal((drawn, mlp.input_width)).astype(np.float32)])
+    inputs = '%d recorded rows and %d random inputs' % (len(recorded), drawn)
+    error = np.abs(mlp.predict(x) - reference(x))
+    return float(error.max()), float(error.mean()), inputs
+
+
+def load_scaling(args):
+    '''means/stds for --fold-scaler, from a joblib StandardScaler or from .npy files'''
+    if args.scaler:
+        scaler = modelRuntime.load_joblib(args.scaler)
+        return scaler.mean_, scaler.scale_
+    model_dir = os.path.dirname(os.path.abspath(args.model))
+    means = np.load(args.means or os.path.join(model_dir, 'means.npy'), allow_pickle=True)
+    stds = np.load(args.stds or os.path.join(model_dir, 'stds.npy'), allow_pickle=True)
+    return means, stds
+
+
+def verify_folded(folded, mlp, means, stds, test_data=None, model_dir=None, log_paths=(), samples=256, seed=0):
+    '''(max, mean) absolute difference between the folded network on raw inputs and
+    the original network on scaled inputs, on the recorded features of verify() and on
+    random raw inputs'''
+    means = np.asarray(means, dtype=np.float64).reshape(-1)
+    stds = np.asarray(stds, dtype=np.float64).reshape(-1)
+    raw = [np.random.default_rng(seed).standard_normal((samples, mlp.input_width)) * stds + means]
+    if test_data is not None:
+        with np.load(test_data) as data:
+            sample = data['sample_data']
+        if sample.shape[-1] == mlp.input_width:
+            raw.insert(0, sample.reshape(-1, mlp.input_width))
+            test_data = None
+    remapped = None if model_dir is None else recorded_rows(mlp, model_dir, test_data, log_paths, samples, seed)
+    if remapped is not None:
+        raw.insert(0, remapped[0])
+    raw = np.concatenate(raw)
+    error = np.abs(folded.predict(raw) - mlp.predict((raw - means) / stds))
+    return float(error.max()), float(error.mean())
+
+
+def to_keras(mlp):
+    '''Rebuild the network as a Keras Sequential model'''
+    import keras
+    model = keras.Sequential([keras.Input(shape=(mlp.input_width,))] +
+                             [keras.layers.Dense(k.shape[1], activation=a)
+                              for k, a in zip(mlp.kernels, mlp.activations)])
+    for layer, kernel, bias in zip(model.layers, mlp.kernels, mlp.biases):
+        layer.set_weights([kernel, bias])
+    return model
+
+
+def to_tflite(model, path, quantize=True):
+    '''Convert a Keras model the same way model_save.ipynb does'''
+    import tensorflow as tf
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    with open(path, 'wb') as f:
+        f.write(converter.convert())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export a Dense-only model to a NumPy .npz')
+    parser.add_argument('model', help='.keras, .h5 or .tflite model to export')
+    parser.add_argument('output', help='.npz file to write')
+    parser.add_argument('--test-data', dest='test_data', default=None,
+                        help='test_data.npz to check the export against (default: the one next to the model)')
+    parser.add_argument('--logs', nargs='*', dest='logs', default=[],
+                        help='Telemetry files (.tlm or .csv) or directories whose features to check the export on')
+    # TFLite dynamic-range models also quantize activations on the fly, so single outputs
+    # can differ by ~0.1 from the dequantized float weights and the mean on recorded
+    # features is ~0.013 (model_driver.tflite); parityCheck.py allows them 0.025 as well
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='Largest allowed mean absolute output difference '
+                             '(default: %g, %g for .tflite models)' % (FLOAT_TOLERANCE, QUANTIZED_TOLERANCE))
+    parser.add_argument('--fold-scaler', action='store_true', dest='fold_scaler',
+                        help='Fold the input scaling into the first layer')
+    parser.add_argument('--means', default=None, help='means.npy for --fold-scaler (default: next to the model)')
+    parser.add_argument('--stds', default=None, help='stds.npy for --fold-scaler (default: next to the model)')
+    parser.add_argument('--scaler', default=None, help='joblib StandardScaler to fold instead of means/stds')
+    parser.add_argument('--keras-output', dest='keras_output', default=None,
+                        help='Also save the exported network as a .keras model')
+    parser.add_argument('--tflite-output', dest='tflite_output', default=None,
+                        help='Also save the exported network as a .tflite model')
+    args = parser.parse_args(argv)
+
+    model_dir = os.path.dirname(os.path.abspath(args.model))
+    test_data = args.test_data
+    if test_data is None and os.path.exists(os.path.join(model_dir, 'test_data.npz')):
+        test_data = os.path.join(model_dir, 'test_data.npz')
+    mlp, reference = load_source(args.model)
+    tolerance = args.tolerance
+    if tolerance is None:
+        tolerance = QUANTIZED_TOLERANCE if args.model.endswith('.tflite') else FLOAT_TOLERANCE
+    max_error, mean_error, inputs = verify(mlp, reference, test_data, model_dir, args.logs)
+    print('Layers:', ' -> '.join([str(mlp.input_width)] + [str(k.shape[1]) for k in mlp.kernels]))
+    print('Abs difference to %s on %s: max %.6f, mean %.6f' % (args.model, inputs, max_error, mean_error))
+    if mean_error > tolerance:
+        print('Export does not match the original model within %g' % tolerance)
+        return 1
+
+    if args.fold_scaler:
+        means, stds = load_scaling(args)
+        folded = mlp.fold_scaler(means, stds)
+        max_error, mean_error = verify_folded(folded, mlp, means, stds, test_data, model_dir, args.logs)
+        print('Folded scaler, abs difference on raw inputs: max %.6f, mean %.6f' % (max_error, mean_error))
+        if mean_error > tolerance:
+            print('Folded model does not match the scaled model within %g' % tolerance)
+            return 1
+        mlp = folded
+
+    mlp.save(args.output)
+    print('NumPy weights saved to', args.output)
+    if args.keras_output or args.tflite_output:
+        model = to_keras(mlp)
+        if args.keras_output:
+            model.save(args.keras_output)
+            print('Keras model saved to', args.keras_output)
+        if args.tflite_output:
+            # A folded first layer mixes inputs of very different ranges, which per-channel
+            # int8 weights cannot represent (mean error ~0.16), so it stays float32
+            to_tflite(model, args.tflite_output, quantize=not mlp.raw_input)
+            print('TFLite model saved to', args.tflite_output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
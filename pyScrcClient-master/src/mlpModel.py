@@ -0,0 +1,288 @@
+import numpy as np
+
+ACTIVATIONS = ('relu', 'linear')
+
+# Like the TFLite converter, layers with fewer weights than this are left in float
+MIN_QUANTIZED_WEIGHTS = 1024
+
+
+class NumpyMLP(object):
+    '''
+    A stack of Dense layers evaluated with plain NumPy (matmul + maximum),
+    loaded from the flat .npz written by mlpExport.py
+    '''
+
+    def __init__(self, kernels, biases, activations, raw_input=False):
+        '''Constructor, raw_input means the input scaling is folded into the first layer'''
+        if not (len(kernels) == len(biases) == len(activations)) or not kernels:
+            raise ValueError('Need one kernel, bias and activation per layer')
+        self.kernels = [np.ascontiguousarray(k, dtype=np.float32) for k in kernels]
+        self.biases = [np.ascontiguousarray(b, dtype=np.float32).reshape(-1) for b in biases]
+        self.activations = [str(a) for a in activations]
+        self.raw_input = bool(raw_input)
+
+        width = self.kernels[0].shape[0]
+        for i, (kernel, bias, activation) in enumerate(zip(self.kernels, self.biases, self.activations)):
+            if kernel.ndim != 2 or kernel.shape[0] != width or bias.size != kernel.shape[1]:
+                raise ValueError('Layer %d has kernel %s and bias %s, expected %d inputs'
+                                 % (i, kernel.shape, bias.shape, width))
+            if activation not in ACTIVATIONS:
+                raise ValueError('Layer %d has unsupported activation %s' % (i, activation))
+            width = kernel.shape[1]
+
+        self.input_width = self.kernels[0].shape[0]
+        self.output_width = width
+        # Batch-1 activations are preallocated so a racing tick does not allocate
+        self.buffers = [np.empty((1, k.shape[1]), dtype=np.float32) for k in self.kernels]
+
+    @classmethod
+    def load(cls, path):
+        '''Load the weights written by save()'''
+        with np.load(path) as data:
+            layers = int(data['layers'])
+            kernels = [data['kernel_%d' % i] for i in range(layers)]
+            biases = [data['bias_%d' % i] for i in range(layers)]
+            activations = [str(a) for a in data['activations']]
+            raw_input = bool(data['raw_input']) if 'raw_input' in data.files else False
+        return cls(kernels, biases, activations, raw_input)
+
+    def save(self, path):
+        '''Write the weights as a flat .npz (kernel_0, bias_0, ..., activations)'''
+        arrays = {'layers': np.array(len(self.kernels)),
+                  'activations': np.array(self.activations),
+                  'raw_input': np.array(self.raw_input)}
+        for i, (kernel, bias) in enumerate(zip(self.kernels, self.biases)):
+            arrays['kernel_%d' % i] = kernel
+            arrays['bias_%d' % i] = bias
+        np.savez_compressed(path, **arrays)
+
+    def fold_scaler(self, means, stds):
+        '''A copy of this network that takes raw sensor values: (x - means) / stds
+        is folded into the first layer's kernel and bias'''
+        if self.raw_input:
+            raise ValueError('Scaling is already folded into this network')
+        means = np.asarray(means, dtype=np.float64).reshape(-1)
+        stds = np.asarray(stds, dtype=np.float64).reshape(-1)
+        if means.size != self.input_width or stds.size != self.input_width:
+            raise ValueError('Network takes %d inputs but means/stds have %d/%d values'
+                             % (self.input_width, means.size, stds.size))
+        # (x - m) / s @ W + b  ==  x @ (W / s) + (b - (m / s) @ W)
+        kernel = self.kernels[0].astype(np.float64)
+        kernels = [kernel / stds[:, None]] + self.kernels[1:]
+        biases = [self.biases[0] - (means / stds) @ kernel] + self.biases[1:]
+        return NumpyMLP(kernels, biases, self.activations, raw_input=True)
+
+    def predict(self, x):
+        '''Run a (batch, inputs) or (inputs,) array through the network.
+        For a single row the returned array is reused by the next call.'''
+        x = np.asarray(x, dtype=np.float32)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        if x.shape[1] != self.input_width:
+            raise ValueError('Model expects %d inputs, got %d' % (self.input_width, x.shape[1]))
+
+        h = x
+        for i, (kernel, bias, activation) in enumerate(zip(self.kernels, self.biases, self.activations)):
+            out = self.buffers[i] if x.shape[0] == 1 else np.empty((x.shape[0], kernel.shape[1]), dtype=np.float32)
+            np.matmul(h, kernel, out=out)
+            out += bias
+            if activation == 'relu':
+                np.maximum(out, 0.0, out=out)
+            h = out
+        return h
+
+
+class QuantizedMLP(object):
+    '''
+    A NumpyMLP with int8 weights (one scale per output channel) whose inputs are
+    quantized to int8 per row on the fly, the scheme of TFLite's dynamic-range
+    models. The int8 products are summed in float32, which is exact while a sum
+    stays below 2**24, so BLAS does the integer arithmetic.
+    '''
+
+    def __init__(self, mlp):
+        '''Constructor, quantizes the weights of a NumpyMLP. Small layers stay float, and so
+        does the first layer of a raw_input network: its inputs differ in range by orders
+        of magnitude.'''
+        self.input_width = mlp.input_width
+        self.output_width = mlp.output_width
+        self.raw_input = mlp.raw_input
+        self.activations = list(mlp.activations)
+        self.biases = list(mlp.biases)
+        self.kernels = []
+        self.scales = []  # per output channel, None for a float layer
+        for i, kernel in enumerate(mlp.kernels):
+            if (i == 0 and mlp.raw_input) or kernel.size < MIN_QUANTIZED_WEIGHTS:
+                self.kernels.append(kernel)
+                self.scales.append(None)
+                continue
+            if kernel.shape[0] * 127 * 127 >= 2 ** 24:
+                raise ValueError('Layer %d has %d inputs, too many for exact float32 sums'
+                                 % (i, kernel.shape[0]))
+            scale = np.abs(kernel).max(axis=0) / 127.0
+            scale[scale == 0] = 1.0
+            self.kernels.append(np.rint(kernel / scale).astype(np.float32))
+            self.scales.append(scale.astype(np.float32))
+        self.buffers = [np.empty((1, k.shape[1]), dtype=np.float32) for k in self.kernels]
+        self.quantized = [np.empty((1, k.shape[0]), dtype=np.float32) for k in self.kernels]
+
+    @classmethod
+    def load(cls, path):
+        '''Quantize the float weights written by NumpyMLP.save()'''
+        return cls(NumpyMLP.load(path))
+
+    def predict(self, x):
+        '''NumpyMLP.predict with int8 weights and activations'''
+        x = np.asarray(x, dtype=np.float32)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        if x.shape[1] != self.input_width:
+            raise ValueError('Model expects %d inputs, got %d' % (self.input_width, x.shape[1]))
+
+        h = x
+        single = x.shape[0] == 1
+        for i, (kernel, scale, bias, activation) in enumerate(
+                zip(self.kernels, self.scales, self.biases, self.activations)):
+            out = self.buffers[i] if single else np.empty((x.shape[0], kernel.shape[1]), dtype=np.float32)
+            if scale is None:
+                np.matmul(h, kernel, out=out)
+            else:
+                row_scale = np.abs(h).max(axis=1, keepdims=True) / np.float32(127.0)
+                row_scale[row_scale == 0] = 1.0
+                q = self.quantized[i] if single else np.empty(h.shape, dtype=np.float32)
+                np.divide(h, row_scale, out=q)
+                np.rint(q, out=q)
+                np.matmul(q, kernel, out=out)
+                out *= row_scale
+                out *= scale
+            out += bias
+            if activation == 'relu':
+                np.maximum(out, 0.0, out=out)
+            h = out
+        return h
+
+
+def quantization_params(low, high):
+    '''(scale, zero point) mapping [low, high] (widened to include 0) onto int8'''
+    low, high = min(float(low), 0.0), max(float(high), 0.0)
+    scale = (high - low) / 255.0 or 1.0
+    zero_point = int(np.clip(np.rint(-128 - low / scale), -128, 127))
+    return scale, zero_point
+
+
+class Int8MLP(object):
+    '''
+    Full-integer version of a NumpyMLP, with the arithmetic of a TFLite int8
+    model: every activation is int8 with one fixed (scale, zero point) found by
+    calibrate() on representative inputs, weights are int8 per output channel
+    and biases int32. Only the network input and output are float.
+
+    NumPy has no int8 matmul, so the int8 products are summed in float32 (exact
+    below 2**24, like QuantizedMLP) and requantized in float64.
+    '''
+
+    def __init__(self, kernels, kernel_scales, biases, activations, scales, zero_points):
+        '''Constructor, kernels int8 (inputs, units), biases int32, and scales/zero_points
+        of the network input and of every layer output'''
+        if not (len(kernels) == len(kernel_scales) == len(biases) == len(activations) == len(scales) - 1
+                == len(zero_points) - 1) or not kernels:
+            raise ValueError('Need one kernel, kernel scale, bias and activation per layer, and one '
+                             'scale and zero point more')
+        self.kernels = [np.asarray(k, dtype=np.int8) for k in kernels]
+        self.kernel_scales = [np.asarray(s, dtype=np.float64).reshape(-1) for s in kernel_scales]
+        self.biases = [np.asarray(b, dtype=np.int32).reshape(-1) for b in biases]
+        self.activations = [str(a) for a in activations]
+        self.scales = [float(s) for s in scales]
+        self.zero_points = [int(z) for z in zero_points]
+        self.raw_input = False
+        self.input_width = self.kernels[0].shape[0]
+        self.output_width = self.kernels[-1].shape[1]
+
+        # Per layer: the kernel as float32 for BLAS, the constant part of the accumulator
+        # (bias - input zero point * column sums) and the requantization multiplier
+        self.matmul_kernels, self.offsets, self.multipliers = [], [], []
+        for i, (kernel, kernel_scale, bias) in enumerate(zip(self.kernels, self.kernel_scales, self.biases)):
+            if kernel.shape[0] * 128 * 127 >= 2 ** 24:
+                raise ValueError('Layer %d has %d inputs, too many for exact float32 sums'
+                                 % (i, kernel.shape[0]))
+            self.matmul_kernels.append(kernel.astype(np.float32))
+            self.offsets.append(bias - self.zero_points[i] * kernel.sum(axis=0, dtype=np.int64))
+            self.multipliers.append(self.scales[i] * kernel_scale / self.scales[i + 1])
+
+    @classmethod
+    def calibrate(cls, mlp, x):
+        '''Quantize a float NumpyMLP, with activation ranges taken from running the
+        representative (samples, inputs) rows x through it'''
+        if mlp.raw_input:
+            raise ValueError('Raw sensor inputs differ in range by orders of magnitude and '
+                             'cannot share one int8 scale, quantize the scaled model')
+        h = np.asarray(x, dtype=np.float32)
+        params = [quantization_params(h.min(), h.max())]
+        for kernel, bias, activation in zip(mlp.kernels, mlp.biases, mlp.activations):
+            h = h @ kernel + bias
+            if activation == 'relu':
+                h = np.maximum(h, 0.0)
+            params.append(quantization_params(h.min(), h.max()))
+        kernels, kernel_scales, biases = [], [], []
+        for i, (kernel, bias) in enumerate(zip(mlp.kernels, mlp.biases)):
+            kernel_scale = np.abs(kernel).max(axis=0).astype(np.float64) / 127.0
+            kernel_scale[kernel_scale == 0] = 1.0
+            kernels.append(np.rint(kernel / kernel_scale).astype(np.int8))
+            kernel_scales.append(kernel_scale)
+            biases.append(np.rint(bias / (params[i][0] * kernel_scale)).astype(np.int32))
+        scales, zero_points = zip(*params)
+        return cls(kernels, kernel_scales, biases, mlp.activations, scales, zero_points)
+
+    @classmethod
+    def load(cls, path):
+        '''Load the arrays written by save()'''
+        with np.load(path) as data:
+            layers = int(data['layers'])
+            return cls([data['kernel_%d' % i] for i in range(layers)],
+                       [data['kernel_scale_%d' % i] for i in range(layers)],
+                       [data['bias_%d' % i] for i in range(layers)],
+                       [str(a) for a in data['activations']], data['scales'], data['zero_points'])
+
+    def save(self, path):
+        '''Write the int8 model as a flat .npz, a quarter of the float weights'''
+        arrays = {'layers': np.array(len(self.kernels)),
+                  'activations': np.array(self.activations),
+                  'scales': np.array(self.scales),
+                  'zero_points': np.array(self.zero_points)}
+        for i, (kernel, kernel_scale, bias) in enumerate(zip(self.kernels, self.kernel_scales, self.biases)):
+            arrays['kernel_%d' % i] = kernel
+            arrays['kernel_scale_%d' % i] = kernel_scale
+            arrays['bias_%d' % i] = bias
+        np.savez_compressed(path, **arrays)
+
+    def quantize_input(self, x):
+        '''int8 values (as float32) of a float (batch, inputs) array'''
+        q = np.rint(x / np.float32(self.scales[0]))
+        q += self.zero_points[0]
+        return np.clip(q, -128, 127, out=q)
+
+    def predict(self, x):
+        '''Run a (batch, inputs) or (inputs,) float array through the int8 network'''
+        x = np.asarray(x, dtype=np.float32)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        if x.shape[1] != self.input_width:
+            raise ValueError('Model expects %d inputs, got %d' % (self.input_width, x.shape[1]))
+
+        q = self.quantize_input(x)
+        for i, activation in enumerate(self.activations):
+            accumulator = np.matmul(q, self.matmul_kernels[i]).astype(np.float64)
+            accumulator += self.offsets[i]
+            accumulator *= self.multipliers[i]
+            zero_point = self.zero_points[i + 1]
+            # A fused ReLU clamps at the zero point, i.e. at 0.0
+            low = zero_point if activation == 'relu' else -128
+            q = np.clip(np.rint(accumulator) + zero_point, low, 127).astype(np.float32)
+        return (q - self.zero_points[-1]) * np.float32(self.scales[-1])
+
+
+def load(path):
+    '''NumpyMLP or Int8MLP, whichever an .npz holds'''
+    with np.load(path) as data:
+        int8 = 'zero_points' in data.files
+    return Int8MLP.load(path) if int8 else NumpyMLP.load(path)
@@ -0,0 +1,169 @@
+'''
+Hot model replacement for a running driver. A background thread loads new
+model files, checks them and warms them up; the driver swaps the new model in
+at the start of a tick (Driver.swap_model), so the swap itself is a few
+attribute assignments and no tick ever waits on a load.
+
+New files come from:
+  - a watched directory: the file the driver's backend loads there (e.g.
+    model_driver.tflite) is reloaded when it changes. Write the new export under
+    another name and rename it over the old one, so it is never read half-written.
+  - control messages: a UDP datagram "load <path>" to 127.0.0.1:<control port>
+    loads any model file (see inferenceBackend.load_file); the reply is "queued".
+
+    python pyclient.py --watch-models ../models --control-port 3101
+    echo -n "load ../models/model_driver.npz" > /dev/udp/127.0.0.1/3101
+'''
+import os
+import time
+import queue
+import socket
+import threading
+import numpy as np
+import clientLog
+import inferenceBackend
+import actionChunk
+
+log = clientLog.get_logger('modelRegistry')
+
+
+class ModelRegistry(object):
+    '''
+    Loads and validates replacement models on a background thread; take() hands
+    over the newest one that passed
+    '''
+
+    def __init__(self, schema, raw_input=False, num_threads=None, watch_path=None, control_port=None,
+                 poll_interval=0.5, test_dir=None, check_outputs=None):
+        '''Constructor, watch_path is the model file to reload when it changes, control_port
+        a local UDP port for "load <path>" messages and test_dir where test_data.npz is.
+        check_outputs raises for an output width the driver cannot use (in action chunk
+        mode ChunkScheduler.check); by default a model needs at least one action.'''
+        self.schema = schema
+        self.raw_input = raw_input
+        self.num_threads = num_threads
+        self.watch_path = watch_path
+        self.poll_interval = poll_interval
+        self.check_outputs = check_outputs or self.check_action
+        self.test_inputs = inferenceBackend.test_inputs(schema, test_dir or os.path.dirname(watch_path or '.'),
+                                                        raw_input)
+        self.batch_capacity = None  # set by Driver.setup_batch, new models are resized to match
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.ready = None           # validated model waiting for the next tick, under lock
+        self.retired = queue.Queue()  # swapped-out models, freed here rather than on the tick thread
+        self.loaded = 0
+        self.rejected = 0
+        self.watched = self.file_state(watch_path)
+        self.sock = None
+        if control_port is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind(('127.0.0.1', control_port))
+            self.sock.settimeout(poll_interval)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='model-registry', daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def check_action(outputs):
+        if outputs < actionChunk.ACTION_WIDTH:
+            raise ValueError('A model with %d outputs does not give an action of %d'
+                             % (outputs, actionChunk.ACTION_WIDTH))
+
+    @staticmethod
+    def file_state(path):
+        '''(mtime, size) of a file, None if it does not exist'''
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError):
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def request(self, path):
+        '''Queue a model file to load'''
+        self.requests.put(path)
+
+    def take(self):
+        '''The newest validated model, once; None if there is none'''
+        if self.ready is None:
+            return None  # no lock on the common path, a model set meanwhile is taken next tick
+        with self.lock:
+            model, self.ready = self.ready, None
+        return model
+
+    def retire(self, model):
+        '''Hand over a swapped-out model to be freed on the registry thread'''
+        self.retired.put(model)
+
+    def run(self):
+        pending = None  # watched file state seen once, loaded when it is the same on the next poll
+        while self.running:
+            if self.sock is not None:
+                self.receive_control()
+            else:
+                time.sleep(self.poll_interval)
+            if self.watch_path is not None:
+                state = self.file_state(self.watch_path)
+                if state is not None and state != self.watched:
+                    if state == pending:
+                        self.watched = state
+                        self.request(self.watch_path)
+                    pending = state
+            while not self.retired.empty():
+                self.retired.get()
+            while not self.requests.empty():
+                self.load(self.requests.get())
+
+    def receive_control(self):
+        try:
+            data, addr = self.sock.recvfrom(4096)
+        except (socket.timeout, OSError):
+            return
+        command, _, argument = data.decode('utf-8', 'replace').strip().partition(' ')
+        if command == 'load' and argument:
+            self.request(argument.strip())
+            self.sock.sendto(b'queued', addr)
+        else:
+            self.sock.sendto(b'unknown command, expected: load <path>', addr)
+
+    def load(self, path):
+        '''Load, check and warm up one model file; it becomes ready if it passes'''
+        start = time.perf_counter()
+        try:
+            model = inferenceBackend.load_file(path, self.num_threads)
+            self.validate(model)
+            if self.batch_capacity is not None:
+                model.setup_batch(self.batch_capacity)
+            for _ in range(10):
+                model.predict(self.test_inputs[:1])
+        except Exception as e:
+            self.rejected += 1
+            log.warning("Model %s rejected: %s", path, e)
+            return
+        with self.lock:
+            superseded, self.ready = self.ready, model
+        if superseded is not None:
+            self.retire(superseded)  # never taken, a newer one replaced it
+        self.loaded += 1
+        log.info("Model %s (%s) ready to swap in, loaded in %.1f ms", path, model.name,
+                 (time.perf_counter() - start) * 1000)
+
+    def validate(self, model):
+        '''Raise if a model does not fit the driver: input width, raw or scaled inputs,
+        output width for the driver's mode and finite outputs for the test vector'''
+        self.schema.check_width(model.input_width, model.path)
+        if model.raw_input != self.raw_input:
+            raise ValueError(f"{model.path} takes {'raw' if model.raw_input else 'scaled'} inputs, "
+                             f"the driver feeds {'raw' if self.raw_input else 'scaled'} ones")
+        outputs = np.asarray(model.predict_rows(self.test_inputs))
+        if outputs.ndim != 2 or outputs.shape[0] != len(self.test_inputs):
+            raise ValueError(f"{model.path} gives outputs of shape {outputs.shape} for {len(self.test_inputs)} rows")
+        self.check_outputs(outputs.shape[1])
+        if not np.isfinite(outputs).all():
+            raise ValueError(f"{model.path} gives non-finite outputs for the test vector")
+
+    def close(self):
+        self.running = False
+        self.thread.join(timeout=2 * self.poll_interval + 1.0)
+        if self.sock is not None:
+            self.sock.close()
@@ -0,0 +1,31 @@
+'''
+Lazy loaders for the inference frameworks. Nothing heavy is imported until a
+backend actually asks for it, so a NumPy-only client never loads TensorFlow.
+'''
+
+
+def tflite_interpreter(path, num_threads=None):
+    '''Create a TFLite interpreter, preferring the standalone runtimes over full TensorFlow'''
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    interpreter = Interpreter(model_path=path, num_threads=num_threads)
+    interpreter.allocate_tensors()
+    return interpreter
+
+
+def load_keras_model(path, compile=True):
+    '''Load a .keras/.h5 model, importing Keras on first use'''
+    from keras.models import load_model
+    return load_model(path, compile=compile)
+
+
+def load_joblib(path):
+    '''Load a joblib pickle such as torcs_scaler.joblib'''
+    import joblib
+    return joblib.load(path)
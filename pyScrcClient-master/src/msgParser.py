@@ -35,7 +35,7 @@ class MsgParser(object):
         msg = ''
         
         for key, value in dictionary.items():
-            if value != None and value[0] != None:
+            if value is not None and len(value) > 0 and value[0] is not None:
                 msg += '(' + key
                 for val in value:
                     msg += ' ' + str(val)
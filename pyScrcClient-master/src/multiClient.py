@@ -0,0 +1,252 @@
+'''
+Drive several SCR bots (one server port each, 3001-3010) from one process.
+The model is loaded once, and every car whose sensor message arrives within the
+same tick goes through it in a single batched forward pass.
+
+    python multiClient.py --cars 10 --port 3001 --backend numpy
+'''
+import sys
+import time
+import select
+import socket
+import argparse
+import udpLink
+import clientLog
+import clientOptions
+
+
+class Car(object):
+    '''
+    One bot: its socket and receive buffer, and a Driver with its own
+    CarState/CarControl
+    '''
+
+    def __init__(self, index, driver, host, port, bot_id, bufsize=udpLink.DEFAULT_BUFSIZE, rcvbuf=None):
+        '''Constructor'''
+        self.index = index
+        self.driver = driver
+        self.address = (host, port)
+        self.bot_id = bot_id
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(1.0)
+        self.receiver = udpLink.DatagramReceiver(self.sock, bufsize, rcvbuf)
+        self.identified = False
+        self.finished = False
+        self.last_init = 0.0
+        self.steps = 0
+        self.episodes = 0
+        self.skipped = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, msg):
+        try:
+            self.sock.sendto(msg.encode('utf-8'), self.address)
+        except socket.error as msg:
+            print(f"Car {self.index}: failed to send data:", msg)
+
+    def identify(self):
+        print(f"Car {self.index}: sending id to server on port {self.address[1]}")
+        self.send(self.bot_id + self.driver.init())
+        self.last_init = time.perf_counter()
+
+    def close(self):
+        self.sock.close()
+
+
+class MultiClient(object):
+    '''
+    Runs the cars on one select() loop and batches their inference
+    '''
+
+    def __init__(self, cars, max_steps=0, max_episodes=1, gather_window=0.001):
+        '''Constructor, gather_window is how long to wait for the other cars once one is ready'''
+        self.cars = cars
+        self.model = cars[0].driver  # owns the shared model
+        self.max_steps = max_steps or 1000000
+        self.max_episodes = max_episodes
+        self.gather_window = gather_window
+
+        self.ticks = 0          # sensor messages answered
+        self.batches = 0        # batched forward passes
+        self.batched_rows = 0   # rows over all batches
+        self.inference_time = 0.0
+
+    def active(self):
+        return [car for car in self.cars if not car.finished]
+
+    def wait_ready(self, cars):
+        '''Cars with a datagram waiting, gathering stragglers for up to gather_window'''
+        ready = select.select(cars, [], [], 1.0)[0]
+        if not ready:
+            return ready
+        deadline = time.perf_counter() + self.gather_window
+        while len(ready) < len(cars):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            more = select.select([car for car in cars if car not in ready], [], [], remaining)[0]
+            ready.extend(more)
+        return ready
+
+    def end_episode(self, car):
+        car.episodes += 1
+        car.steps = 0
+        car.identified = False
+        if car.episodes == self.max_episodes:
+            car.finished = True
+
+    def receive(self, car):
+        '''Read the newest datagram of a car; returns it if the car has to be driven'''
+        try:
+            if not car.identified:
+                # Read one at a time, draining could skip the ***identified*** reply
+                if car.receiver.recv() is not None and car.receiver.contains(b'***identified***'):
+                    car.identified = True
+                return None
+            data, skipped = car.receiver.receive_latest()
+        except socket.error as msg:
+            print(f"Car {car.index}: didn't get response from server:", msg)
+            return None
+        car.skipped += skipped
+        if data is None:
+            return None
+
+        if car.receiver.contains(b'***shutdown***'):
+            car.driver.onShutDown()
+            car.finished = True
+            print(f"Car {car.index}: shutdown")
+            return None
+
+        if car.receiver.contains(b'***restart***'):
+            car.driver.onRestart()
+            print(f"Car {car.index}: restart")
+            self.end_episode(car)
+            return None
+        return data
+
+    def tick(self, ready):
+        '''Drive every ready car, with one forward pass for all cars in AI mode'''
+        batch = []
+        rows = []
+        for car in ready:
+            data = self.receive(car)
+            if data is None:
+                continue
+            d = car.driver
+            self.ticks += 1
+            car.steps += 1
+            d.stats.start(car.receiver.received_at)
+            d.stats.mark('receive')
+            hold = d.read_state(data)
+            if hold is not None:
+                self.respond(car, hold)
+                continue
+            if d.ai_mode and d.model_loaded:
+                try:
+                    row = d.prepare_ai_control()
+                    prediction = d.cache.lookup(row) if d.cache is not None else None
+                    if prediction is None:
+                        rows.append(row)
+                        batch.append(car)
+                        continue
+                    # Same state as before: no place in the batch
+                    d.apply_predictions(prediction)
+                    d.stats.mark('inference')
+                except Exception as e:
+                    d.ai_control_failed(e)
+            else:
+                d.handle_keyboard_input()
+            self.respond(car)
+
+        if batch:
+            start_time = time.perf_counter()
+            try:
+                predictions = self.model.predict_batch(rows)
+            except Exception as e:
+                for car in batch:
+                    car.driver.ai_control_failed(e)
+            else:
+                self.inference_time += time.perf_counter() - start_time
+                self.batches += 1
+                self.batched_rows += len(batch)
+                for car, prediction in zip(batch, predictions):
+                    if car.driver.cache is not None:
+                        car.driver.cache.store(prediction)
+                    car.driver.apply_predictions(prediction)
+                    car.driver.stats.mark('inference')
+            for car in batch:
+                self.respond(car)
+
+    def respond(self, car, msg=None):
+        car.send(msg or car.driver.finish_tick())
+        car.driver.stats.mark('send')
+        car.driver.stats.finish()
+        if car.steps >= self.max_steps:
+            car.send('(meta 1)')
+            self.end_episode(car)
+
+    def run(self):
+        try:
+            while True:
+                cars = self.active()
+                if not cars:
+                    break
+                now = time.perf_counter()
+                for car in cars:
+                    if not car.identified and now - car.last_init >= 1.0:
+                        car.identify()
+                ready = self.wait_ready(cars)
+                if ready:
+                    self.tick(ready)
+        finally:
+            for car in self.cars:
+                car.close()
+        self.print_report()
+
+    def print_report(self):
+        print('Ticks answered:', self.ticks)
+        if self.batches:
+            print(f'Batched forward passes: {self.batches}, '
+                  f'mean batch {self.batched_rows / self.batches:.2f} cars, '
+                  f'mean {self.inference_time / self.batches * 1000:.3f} ms per pass')
+        for car in self.cars:
+            print(f'Car {car.index}: {car.skipped} stale sensor frames skipped, '
+                  f'{car.receiver.truncated} truncated datagrams')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Drive several bots on the TORCS SCRC server from one process.')
+    clientOptions.add_session_options(parser, 'Port of the first car, car i uses port + i (default: 3001)')
+    clientOptions.add_model_options(parser)
+    clientOptions.add_receive_options(parser)
+    parser.add_argument('--cars', action='store', type=int, dest='cars', default=2,
+                        help='Number of cars (default: 2, at most 10)')
+    parser.add_argument('--gather-window', action='store', type=float, dest='gather_window', default=1.0,
+                        help='Milliseconds to wait for the other cars once one is ready (default: 1)')
+    arguments = parser.parse_args(argv)
+    clientLog.setup(arguments.log_level)
+    if not 1 <= arguments.cars <= 10:
+        parser.error('--cars must be between 1 and 10')
+
+    # The first driver loads the model, the others share it. Multi-car runs are
+    # unattended, so no keyboard input.
+    drivers = []
+    for i in range(arguments.cars):
+        drivers.append(clientOptions.create_driver(arguments, headless=True,
+                                                   model_source=drivers[0] if drivers else None, car=i))
+        if i == 0:
+            drivers[0].setup_batch(arguments.cars)
+
+    cars = [Car(i, d, arguments.host_ip, arguments.host_port + i, arguments.id,
+                arguments.recv_buffer, arguments.rcvbuf)
+            for i, d in enumerate(drivers)]
+    client = MultiClient(cars, arguments.max_steps, arguments.max_episodes,
+                         gather_window=arguments.gather_window / 1000.0)
+    client.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,323 @@
+'''
+Parity and latency check of every model artifact (.keras, .h5, .tflite and
+NumPy .npz exports) in the models directories. Artifacts with the same input
+layout are supposed to be the same network, so each one gets the same inputs
+(the test_data.npz sample and random rows, through its matching scaler) and is
+compared with the family's reference: the Keras model if this host can load
+it, else the float NumPy export, else the first TFLite file. A family whose
+reference is a TFLite file has nothing independent of the conversion to compare
+with, and byte-identical copies (the two models/ directories share files) only
+show that they are copies; both are reported.
+
+    python parityCheck.py                      # compare with ../models/parity_baseline.json
+    python parityCheck.py --update-baseline    # record the current results
+
+The exit status is 1 when an artifact differs from its reference by more than
+the absolute bounds, is less accurate or slower than in the baselines (beyond
+the tolerances), or no longer loads. The committed baseline holds the errors
+only; latencies depend on the host and go to parity_latency_<host>.json.
+'''
+import os
+import sys
+import time
+import glob
+import json
+import hashlib
+import platform
+import argparse
+import numpy as np
+import featureSchema
+import inferenceBackend
+import modelRuntime
+
+OUTPUTS = ('accel', 'brake', 'clutch', 'steer')
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(SRC_DIR))
+MODEL_DIRS = (os.path.join(os.path.dirname(SRC_DIR), 'models'), os.path.join(REPO_ROOT, 'models'))
+BASELINE = os.path.join(os.path.dirname(SRC_DIR), 'models', 'parity_baseline.json')
+LATENCY_BASELINE = os.path.join(os.path.dirname(SRC_DIR), 'models', 'parity_latency_%s.json' % platform.node())
+
+# Reference preference within a family, by extension
+REFERENCE_ORDER = ('.keras', '.h5', '.npz', '.tflite')
+# References that do not go through the TFLite conversion
+FLOAT_EXTENSIONS = ('.keras', '.h5', '.npz')
+# Error increases below this are noise, whatever the relative tolerance
+ERROR_FLOOR = 1e-4
+# Reason prefix of an artifact this host lacks the runtime for (Keras without TensorFlow)
+MISSING_RUNTIME = 'no runtime: '
+
+
+def find_artifacts(model_dirs):
+    '''Model files of the given directories (.npz only when it holds NumPy weights)'''
+    paths = []
+    for model_dir in model_dirs:
+        for extension in REFERENCE_ORDER:
+            for path in sorted(glob.glob(os.path.join(model_dir, '*' + extension))):
+                if extension == '.npz':
+                    with np.load(path) as data:
+                        if 'layers' not in data.files:
+                            continue  # test_data.npz
+                paths.append(path)
+    return paths
+
+
+def load_schemas(model_dir):
+    '''Feature schemas of a models directory with the scaling that goes with them:
+    the driver's names with means/stds, and the notebook's names with torcs_scaler.joblib'''
+    schemas = []
+    if os.path.exists(os.path.join(model_dir, featureSchema.DRIVER_FEATURE_NAMES)):
+        schemas.append(featureSchema.FeatureSchema.load(model_dir))
+    scaler_path = os.path.join(model_dir, 'torcs_scaler.joblib')
+    if os.path.exists(os.path.join(model_dir, 'feature_names.pkl')) and os.path.exists(scaler_path):
+        scaler = modelRuntime.load_joblib(scaler_path)
+        names = featureSchema.FeatureSchema.load(model_dir, 'feature_names.pkl', None, None).names
+        schemas.append(featureSchema.FeatureSchema(names, scaler.mean_, scaler.scale_))
+    return schemas
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def time_batch(model, x, batch_size, calls=50):
+    '''Median seconds of a predict_batch() call on batch_size rows'''
+    rows = [x[i % len(x)][None] for i in range(batch_size)]
+    model.setup_batch(batch_size)
+    for _ in range(5):
+        model.predict_batch(rows)
+    elapsed = np.empty(calls)
+    for i in range(calls):
+        t = time.perf_counter()
+        model.predict_batch(rows)
+        elapsed[i] = time.perf_counter() - t
+    return float(np.median(elapsed))
+
+
+def check_artifacts(paths, calls=300, batch_size=64, num_threads=None):
+    '''Results and latencies per artifact (keyed by path relative to the repository),
+    the artifacts that could not be loaded with the reason, and notes on what was
+    not really compared'''
+    families = {}   # (feature names, outputs) -> [(path, model, schema)]
+    failed = {}
+    for path in paths:
+        key = os.path.relpath(path, REPO_ROOT)
+        try:
+            model = inferenceBackend.load_file(path, num_threads)
+            schemas = [s for s in load_schemas(os.path.dirname(path)) if len(s) == model.input_width]
+            if not schemas:
+                raise ValueError('no feature names/scaler with %d inputs next to it' % model.input_width)
+        except Exception as e:
+            reason = str(e).splitlines()[0] if str(e) else e.__class__.__name__
+            failed[key] = (MISSING_RUNTIME if isinstance(e, ImportError) else '') + reason
+            continue
+        # Same inputs but another output layer is another network (e.g. a 3-output head)
+        outputs = len(model.predict(np.zeros((1, model.input_width), dtype=np.float32)))
+        families.setdefault((tuple(schemas[0].names), outputs), []).append((path, model, schemas[0]))
+
+    results, latency, notes = {}, {}, []
+    for members in families.values():
+        members.sort(key=lambda m: REFERENCE_ORDER.index(os.path.splitext(m[0])[1]))
+        if len(members) == 1:
+            notes.append('%s: no other artifact of this network, nothing to compare with'
+                         % os.path.relpath(members[0][0], REPO_ROOT))
+        # Raw sensor values, scaled for each member that does not have the scaler folded in
+        raw = inferenceBackend.test_inputs(members[0][2], os.path.dirname(members[0][0]), raw_input=True)
+        expected = None
+        for path, model, schema in members:
+            key = os.path.relpath(path, REPO_ROOT)
+            x = raw if model.raw_input else ((raw - schema.means) / schema.stds).astype(np.float32)
+            outputs = np.array(model.predict_rows(x), dtype=np.float64)
+            digest = file_digest(path)
+            if expected is None:
+                expected = (key, outputs, digest)
+                if os.path.splitext(path)[1] not in FLOAT_EXTENSIONS:
+                    notes.append('%s: no Keras, .h5 or NumPy reference loaded, the family\'s TFLite files '
+                                 'are only compared with each other' % key)
+            elif digest == expected[2]:
+                notes.append('%s: byte-identical to %s, the comparison is trivial' % (key, expected[0]))
+            error = np.abs(outputs - expected[1])
+            results[key] = {
+                'reference': expected[0],
+                'sha256': digest,
+                'max_error': [float(v) for v in error.max(axis=0)],
+                'mean_error': [float(v) for v in error.mean(axis=0)],
+            }
+            latency[key] = {
+                'batch1_us': inferenceBackend.time_calls(model, x, calls) * 1e6,
+                'batchN_us': time_batch(model, x, batch_size) * 1e6,  # after batch-1: resizes the model
+                'batch_size': batch_size,
+            }
+    return results, latency, failed, notes
+
+
+def print_results(results, latency, failed, notes):
+    print('%-54s %-8s %10s %10s  %s' % ('artifact', 'output', 'max err', 'mean err', 'reference'))
+    for key, result in sorted(results.items()):
+        for i, output in enumerate(OUTPUTS[:len(result['max_error'])]):
+            print('%-54s %-8s %10.6f %10.6f  %s' % (key if i == 0 else '', output, result['max_error'][i],
+                                                   result['mean_error'][i], result['reference'] if i == 0 else ''))
+    print()
+    print('%-54s %12s %12s' % ('artifact', 'batch-1 us', 'batch-N us'))
+    for key, result in sorted(latency.items()):
+        print('%-54s %12.1f %12.1f  (N=%d)' % (key, result['batch1_us'], result['batchN_us'], result['batch_size']))
+    for key, reason in sorted(failed.items()):
+        print('%-54s not loaded: %s' % (key, reason))
+    if notes:
+        print()
+    for line in notes:
+        print('NOTE', line)
+
+
+def out_of_bounds(results, float_bounds, quantized_bounds):
+    '''Descriptions of every artifact further from its reference than the absolute
+    (max error, mean error) bounds: float_bounds for Keras and NumPy exports, which
+    compute the same thing, quantized_bounds for the dynamic-range TFLite files'''
+    found = []
+    for key, result in sorted(results.items()):
+        max_error, max_mean_error = quantized_bounds if key.endswith('.tflite') else float_bounds
+        for kind, bound in (('max_error', max_error), ('mean_error', max_mean_error)):
+            for output, value in zip(OUTPUTS, result[kind]):
+                if value > bound:
+                    found.append('%s: %s %s %.6f > %.6f against %s' % (key, output, kind, value, bound,
+                                                                       result['reference']))
+    return found
+
+
+def regressions(results, failed, baseline, error_tolerance=0.1):
+    '''Descriptions of every result that is less accurate than the baseline. Errors are
+    only compared against the same reference: a host that loads the Keras models measures
+    the TFLite files against those, not against the NumPy or TFLite reference of the baseline.'''
+    found = []
+    for key, base in sorted(baseline['artifacts'].items()):
+        if key not in results:
+            if not failed.get(key, '').startswith(MISSING_RUNTIME):  # else see reference_changes()
+                found.append('%s: loaded in the baseline, now %s' % (key, failed.get(key, 'missing')))
+            continue
+        result = results[key]
+        if result['reference'] != base['reference']:
+            continue  # see reference_changes()
+        for kind in ('max_error', 'mean_error'):
+            for output, value, allowed in zip(OUTPUTS, result[kind], base[kind]):
+                limit = allowed + max(ERROR_FLOOR, error_tolerance * allowed)
+                if value > limit:
+                    found.append('%s: %s %s %.6f > %.6f' % (key, output, kind, value, limit))
+    return found
+
+
+def reference_changes(results, failed, baseline):
+    '''Descriptions of the artifacts whose errors cannot be compared with the baseline:
+    measured against another reference, not in the baseline at all, or in the baseline
+    but this host cannot load them'''
+    found = []
+    for key, reason in sorted(failed.items()):
+        if key in baseline['artifacts'] and reason.startswith(MISSING_RUNTIME):
+            found.append('%s: not loaded on this host (%s)' % (key, reason[len(MISSING_RUNTIME):]))
+    for key, result in sorted(results.items()):
+        base = baseline['artifacts'].get(key)
+        if base is None:
+            found.append('%s: not in the baseline, run with --update-baseline to add it' % key)
+        elif result['reference'] != base['reference']:
+            found.append('%s: compared with %s, the baseline with %s; errors not compared'
+                         % (key, result['reference'], base['reference']))
+    return found
+
+
+def slowdowns(latency, baseline, latency_tolerance=0.5):
+    '''Descriptions of every latency that is worse than this host's baseline'''
+    found = []
+    for key, base in sorted(baseline['artifacts'].items()):
+        if key not in latency:
+            continue  # reported by regressions()
+        for kind in ('batch1_us', 'batchN_us'):
+            limit = base[kind] * (1.0 + latency_tolerance)
+            if latency[key][kind] > limit:
+                found.append('%s: %s %.1f > %.1f' % (key, kind, latency[key][kind], limit))
+    return found
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print('Baseline written to', path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that all model artifacts agree and have not regressed.')
+    parser.add_argument('model_dirs', nargs='*', default=list(MODEL_DIRS),
+                        help='Models directories (default: both models/ directories of the repository)')
+    parser.add_argument('--baseline', action='store', dest='baseline', default=BASELINE,
+                        help='Baseline errors file (default: ../models/parity_baseline.json)')
+    parser.add_argument('--latency-baseline', action='store', dest='latency_baseline', default=LATENCY_BASELINE,
+                        help='Baseline latencies of this host (default: ../models/parity_latency_<host>.json)')
+    parser.add_argument('--update-baseline', action='store_true', dest='update_baseline',
+                        help='Write the current results as the new baseline')
+    parser.add_argument('--calls', action='store', type=int, dest='calls', default=300,
+                        help='Timed batch-1 calls per artifact (default: 300)')
+    parser.add_argument('--batch-size', action='store', type=int, dest='batch_size', default=64,
+                        help='Rows in the batch-N timing (default: 64)')
+    parser.add_argument('--threads', action='store', type=int, dest='threads', default=None,
+                        help='TFLite interpreter threads (default: the runtime\'s choice)')
+    parser.add_argument('--max-error', action='store', type=float, dest='max_error', default=1e-3,
+                        help='Largest allowed absolute output difference of a Keras or NumPy export '
+                             'from the reference (default: 1e-3)')
+    parser.add_argument('--max-mean-error', action='store', type=float, dest='max_mean_error', default=1e-4,
+                        help='Largest allowed mean absolute output difference of a Keras or NumPy export '
+                             '(default: 1e-4)')
+    # Dynamic-range TFLite exports differ by up to ~0.13 on single outputs, and
+    # torcs_driver_model.tflite's clutch by 0.02 on average from the Keras model
+    parser.add_argument('--max-quantized-error', action='store', type=float, dest='max_quantized_error',
+                        default=0.15,
+                        help='Largest allowed absolute output difference of a TFLite file (default: 0.15)')
+    parser.add_argument('--max-quantized-mean-error', action='store', type=float, dest='max_quantized_mean_error',
+                        default=0.025,
+                        help='Largest allowed mean absolute output difference of a TFLite file (default: 0.025)')
+    parser.add_argument('--error-tolerance', action='store', type=float, dest='error_tolerance', default=0.1,
+                        help='Allowed relative increase of an error over the baseline (default: 0.1)')
+    # Latency depends on the host and its load, so the default only catches large slowdowns
+    parser.add_argument('--latency-tolerance', action='store', type=float, dest='latency_tolerance', default=0.5,
+                        help='Allowed relative increase of a latency over the baseline (default: 0.5)')
+    arguments = parser.parse_args(argv)
+
+    results, latency, failed, notes = check_artifacts(find_artifacts(arguments.model_dirs), arguments.calls,
+                                                      arguments.batch_size, arguments.threads)
+    print_results(results, latency, failed, notes)
+    print()
+    bounds = out_of_bounds(results, (arguments.max_error, arguments.max_mean_error),
+                           (arguments.max_quantized_error, arguments.max_quantized_mean_error))
+    for line in bounds:
+        print('OUT OF BOUNDS', line)
+
+    if arguments.update_baseline:
+        if bounds:
+            print('Not recording a baseline with artifacts out of bounds')
+            return 1
+        write_json(arguments.baseline, {'artifacts': results, 'not_loaded': failed})
+        write_json(arguments.latency_baseline, {'host': platform.node(), 'artifacts': latency})
+        return 0
+    if not os.path.exists(arguments.baseline):
+        print('No baseline at %s, run with --update-baseline first' % arguments.baseline)
+        return 1
+    baseline = read_json(arguments.baseline)
+    for line in reference_changes(results, failed, baseline):
+        print('UNCOMPARED', line)
+    found = regressions(results, failed, baseline, arguments.error_tolerance)
+    if os.path.exists(arguments.latency_baseline):
+        found += slowdowns(latency, read_json(arguments.latency_baseline), arguments.latency_tolerance)
+    else:
+        print('No latency baseline for this host at %s, latencies are not compared' % arguments.latency_baseline)
+    for line in found:
+        print('REGRESSION', line)
+    print('%d out of bounds, %d regressions against %s' % (len(bounds), len(found), arguments.baseline))
+    return 1 if bounds or found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,26 +1,31 @@
+import time
+start_time = time.perf_counter()
 import sys
 import argparse
 import socket
-import driver  # Ensure this module exists and works with Python 3
+import udpLink
+import udpCapture
+import clientLog
+import clientOptions
+import_time = time.perf_counter() - start_time
+
+
+def print_startup_report(times):
+    '''Print how long each startup stage took'''
+    print('Startup times (handshake and first_command count from process start):')
+    for name in ('imports', 'driver_init', 'model_load', 'warm_up', 'handshake', 'first_inference', 'first_command'):
+        if name in times:
+            print(f'  {name}: {times[name] * 1000:.1f} ms')
 
 # Configure the argument parser
 parser = argparse.ArgumentParser(description='Python client to connect to the TORCS SCRC server.')
-parser.add_argument('--host', action='store', dest='host_ip', default='localhost',
-                    help='Host IP address (default: localhost)')
-parser.add_argument('--port', action='store', type=int, dest='host_port', default=3001,
-                    help='Host port number (default: 3001)')
-parser.add_argument('--id', action='store', dest='id', default='SCR',
-                    help='Bot ID (default: SCR)')
-parser.add_argument('--maxEpisodes', action='store', dest='max_episodes', type=int, default=1,
-                    help='Maximum number of learning episodes (default: 1)')
-parser.add_argument('--maxSteps', action='store', dest='max_steps', type=int, default=0,
-                    help='Maximum number of steps (default: 0)')
-parser.add_argument('--track', action='store', dest='track', default=None,
-                    help='Name of the track')
-parser.add_argument('--stage', action='store', dest='stage', type=int, default=3,
-                    help='Stage (0 - Warm-Up, 1 - Qualifying, 2 - Race, 3 - Unknown)')
+clientOptions.add_session_options(parser)
+clientOptions.add_model_options(parser)
+clientOptions.add_single_car_options(parser)
+clientOptions.add_receive_options(parser)
 
 arguments = parser.parse_args()
+clientLog.setup(arguments.log_level)
 
 # Print summary
 print('Connecting to server host ip:', arguments.host_ip, '@ port:', arguments.host_port)
@@ -29,6 +34,7 @@ print('Maximum episodes:', arguments.max_episodes)
 print('Maximum steps:', arguments.max_steps)
 print('Track:', arguments.track)
 print('Stage:', arguments.stage)
+print('Backend:', arguments.backend)
 print('*********************************************')
 
 try:
@@ -39,12 +45,22 @@ except socket.error as msg:
 
 # One-second timeout
 sock.settimeout(1.0)
+receiver = udpLink.DatagramReceiver(sock, arguments.recv_buffer, arguments.rcvbuf)
+capture = None
+if arguments.capture:
+    capture = udpCapture.CaptureWriter(arguments.capture)
+    receiver.capture = capture
 
 shutdownClient = False
 curEpisode = 0
 verbose = False
+skippedFrames = 0  # stale sensor frames dropped because a newer one was already waiting
 
-d = driver.Driver(arguments.stage)  # Ensure driver.Driver is compatible
+driver_start = time.perf_counter()
+d = clientOptions.create_driver(arguments)
+d.startup_times['imports'] = import_time
+d.startup_times['driver_init'] = time.perf_counter() - driver_start
+startup_reported = False
 
 while not shutdownClient:
     while True:
@@ -52,14 +68,17 @@ while not shutdownClient:
         buf = arguments.id + d.init()
         try:
             sock.sendto(buf.encode('utf-8'), (arguments.host_ip, arguments.host_port))
+            if capture:
+                capture.write(udpCapture.INIT, buf)
         except socket.error as msg:
             sys.exit(-1)
         try:
-            buf, addr = sock.recvfrom(1000)
-            buf = buf.decode('utf-8')
+            receiver.recv()
         except socket.error as msg:
             continue
-        if buf.find('***identified***') >= 0:
+        if receiver.contains(b'***identified***'):
+            if 'handshake' not in d.startup_times:
+                d.startup_times['handshake'] = time.perf_counter() - start_time
             break
 
     # --- Step-based main loop ---
@@ -67,41 +86,60 @@ while not shutdownClient:
         arguments.max_steps = 1000000
     for step in range(arguments.max_steps, 0, -1):
         try:
-            buf, addr = sock.recvfrom(1000)
-            buf = buf.decode('utf-8')
+            # Sensor messages are read into one reusable buffer and stay undecoded.
+            # Only the newest frame is used, older ones are already out of date.
+            buf, skipped = receiver.receive_latest()
+            skippedFrames += skipped
         except socket.error as msg:
             print("Didn't get response from server:", msg)
             continue
 
         if verbose and buf is not None:
-            print('Received: ', buf)
+            print('Received: ', bytes(buf))
 
-        if buf and '***shutdown***' in buf:
+        if buf and receiver.contains(b'***shutdown***'):
             d.onShutDown()
+            print('Stale sensor frames skipped:', skippedFrames)
+            if receiver.truncated:
+                print('Datagrams dropped as truncated:', receiver.truncated)
             shutdownClient = True
             print('Client Shutdown')
             break
 
-        if buf and '***restart***' in buf:
+        if buf and receiver.contains(b'***restart***'):
             d.onRestart()
             print('Client Restart')
             break
 
-        # Only drive and send every 3rd step
-        if step % 3 == 0 and buf:
+        # Only drive and send every 3rd step, or every step with action chunks,
+        # which run the model every chunk_stride steps
+        if (step % 3 == 0 or arguments.action_chunk) and buf:
+            # The tick is timed from the moment its datagram was read
+            d.stats.start(receiver.received_at)
+            d.stats.mark('receive')
             outmsg = d.drive(buf)
             if verbose and outmsg:
                 print('Sending: ', outmsg)
             if outmsg:
                 try:
                     sock.sendto(outmsg.encode('utf-8'), (arguments.host_ip, arguments.host_port))
+                    if capture:
+                        capture.write(udpCapture.OUTBOUND, outmsg)
                 except socket.error as msg:
                     print("Failed to send data:", msg)
                     sys.exit(-1)
+            d.stats.mark('send')
+            d.stats.finish()
+            if outmsg and not startup_reported and d.model_ready.is_set():
+                d.startup_times['first_command'] = time.perf_counter() - start_time
+                print_startup_report(d.startup_times)
+                startup_reported = True
         # End episode if steps run out
         if step == 1:
             try:
                 sock.sendto('(meta 1)'.encode('utf-8'), (arguments.host_ip, arguments.host_port))
+                if capture:
+                    capture.write(udpCapture.OUTBOUND, '(meta 1)')
             except socket.error as msg:
                 print("Failed to send data:", msg)
                 sys.exit(-1)
@@ -110,4 +148,7 @@ while not shutdownClient:
     if curEpisode == arguments.max_episodes:
         shutdownClient = True
 
-sock.close()
\ No newline at end of file
+sock.close()
+if capture:
+    capture.close()
+    print(f'Captured {capture.count} datagrams to {capture.filename}')
\ No newline at end of file
@@ -0,0 +1,122 @@
+'''
+Full-integer (int8) quantization of the driver's model, calibrated on a
+representative dataset: recorded telemetry (.tlm/.csv) and the test_data.npz
+sample, laid out and scaled with the feature schema. Writes an mlpModel.Int8MLP
+.npz (backend numpy_full_int8) and, with TensorFlow installed, an int8 .tflite
+(backend tflite_int8), then reports their error against the float model on
+held-out rows.
+
+    python quantizeExport.py ../models/model_driver.npz ../models/model_driver_int8.npz \\
+        --logs ../logs --tflite-output ../models/model_driver_int8.tflite
+
+model_save.ipynb converts with Optimize.DEFAULT only: int8 weights, float
+activations. Here the activations are int8 too, with ranges from the data.
+'''
+import os
+import sys
+import argparse
+import numpy as np
+import featureSchema
+import inferenceBackend
+import mlpExport
+import mlpModel
+import replayServer
+import telemetry
+
+OUTPUTS = ('accel', 'brake', 'clutch', 'steer')
+
+
+def representative_rows(schema, model_dir, log_paths=(), samples=2000, max_sigma=10.0, seed=0):
+    '''(rows, recorded rows, outliers): up to samples raw feature rows from the telemetry
+    logs and the test_data.npz sample, topped up with rows around the means when there are fewer.
+    Rows with a value more than max_sigma standard deviations from its mean are left
+    out: the input shares one int8 scale, and a single outlier would set it.'''
+    rng = np.random.default_rng(seed)
+    rows = [inferenceBackend.test_data_rows(schema, model_dir)]
+    if log_paths:
+        rows.append(telemetry.feature_matrix(replayServer.load_records(log_paths), schema))
+    x = np.concatenate(rows)
+    total = len(x)
+    x = x[np.isfinite(x).all(axis=1) & (np.abs(x - schema.means) <= max_sigma * schema.stds).all(axis=1)]
+    outliers = total - len(x)
+    if len(x) > samples:
+        x = x[rng.choice(len(x), samples, replace=False)]
+    recorded = len(x)
+    if recorded < samples:
+        x = np.concatenate([x, schema.means + schema.stds * rng.standard_normal((samples - recorded, len(schema)))])
+    return x.astype(np.float32), recorded, outliers
+
+
+def to_int8_tflite(mlp, representative, path):
+    '''Convert the float network with int8 weights and activations, calibrated on the
+    representative (scaled) rows; input and output stay float for the client'''
+    import tensorflow as tf
+    converter = tf.lite.TFLiteConverter.from_keras_model(mlpExport.to_keras(mlp))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = lambda: ([row[None]] for row in representative)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with open(path, 'wb') as f:
+        f.write(converter.convert())
+
+
+def print_error(name, outputs, expected):
+    error = np.abs(outputs - expected)
+    print(f'{name}:')
+    for i, output in enumerate(OUTPUTS):
+        print(f'  {output:6s} max {error[:, i].max():.6f}  mean {error[:, i].mean():.6f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Quantize the driver model to int8 with calibration.')
+    parser.add_argument('model', help='Float model (.npz, .tflite, .keras or .h5) taking scaled inputs')
+    parser.add_argument('output', help='Int8 .npz to write')
+    parser.add_argument('--tflite-output', dest='tflite_output', default=None,
+                        help='Also write an int8 .tflite model (needs TensorFlow)')
+    parser.add_argument('--logs', nargs='*', dest='logs', default=[],
+                        help='Telemetry files (.tlm or .csv) or directories for the representative dataset')
+    parser.add_argument('--model-dir', dest='model_dir', default=None,
+                        help='Directory with the feature schema and test_data.npz (default: next to the model)')
+    parser.add_argument('--samples', type=int, default=2000,
+                        help='Representative rows, 20%% of them held out for the report (default: 2000)')
+    parser.add_argument('--max-sigma', type=float, dest='max_sigma', default=10.0,
+                        help='Leave out recorded rows with a value this many stds from its mean (default: 10)')
+    args = parser.parse_args(argv)
+
+    model_dir = args.model_dir or os.path.dirname(os.path.abspath(args.model))
+    schema = featureSchema.FeatureSchema.load(model_dir)
+    if args.model.endswith('.npz'):
+        mlp = mlpModel.NumpyMLP.load(args.model)
+    else:
+        mlp = mlpExport.load_source(args.model)[0]
+    schema.check_width(mlp.input_width, args.model)
+
+    raw, recorded, outliers = representative_rows(schema, model_dir, args.logs, args.samples, args.max_sigma)
+    print(f'Representative rows: {recorded} recorded ({outliers} outliers left out), '
+          f'{len(raw) - recorded} drawn around the means')
+    x = ((raw - schema.means) / schema.stds).astype(np.float32)
+    x = x[np.random.default_rng(1).permutation(len(x))]
+    held_out = max(1, len(x) // 5)
+    calibration, evaluation = x[held_out:], x[:held_out]
+
+    int8 = mlpModel.Int8MLP.calibrate(mlp, calibration)
+    int8.save(args.output)
+    print('Int8 NumPy model saved to', args.output)
+    expected = mlp.predict(evaluation)
+    models = [('float NumPy', mlp), ('int8 NumPy', int8)]
+    print_error(f'int8 NumPy vs float ({len(evaluation)} held-out rows)', int8.predict(evaluation), expected)
+
+    if args.tflite_output:
+        to_int8_tflite(mlp, calibration, args.tflite_output)
+        print('Int8 TFLite model saved to', args.tflite_output)
+        tflite = inferenceBackend.TFLiteInt8Backend(args.tflite_output)
+        print_error('int8 TFLite vs float', tflite.predict_rows(evaluation), expected)
+        models.append(('int8 TFLite', tflite))
+
+    for name, model in models:
+        seconds = inferenceBackend.time_calls(model, evaluation)
+        print(f'{name:12s} batch-1 {seconds * 1e6:8.1f} us')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+'''
+Stand-in for the TORCS SCR server: answers the init handshake with
+***identified*** and replays sensor messages rebuilt from telemetry logs
+(.csv or .tlm), so clients can be load-tested without the simulator.
+
+    python replayServer.py ../logs/telemetry_20250101_120000_000000.tlm --port 3001 --rate 50
+    python pyclient.py --port 3001 --backend numpy --headless
+
+Every tick the server sends one sensor message and waits for the reply up to
+the deadline, like the real server. Replies are recorded (--replies) and the
+per-tick response latency and missed deadlines are reported at the end.
+'''
+import os
+import sys
+import csv
+import time
+import glob
+import socket
+import argparse
+import numpy as np
+import telemetry
+
+# Sensor groups in the order the SCR server sends them
+SERVER_TAGS = (
+    'angle', 'curLapTime', 'damage', 'distFromStart', 'distRaced', 'fuel', 'gear',
+    'lastLapTime', 'opponents', 'racePos', 'rpm', 'speedX', 'speedY', 'speedZ',
+    'track', 'trackPos', 'wheelSpinVel', 'z', 'focus',
+)
+# Every control reply of the client has it, init and identification strings do not
+CONTROL_TAG = b'(accel'
+
+
+def load_records(paths):
+    '''RECORD_DTYPE records of telemetry files or directories (.tlm and .csv), in order'''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.tlm')) + glob.glob(os.path.join(path, '*.csv'))))
+        else:
+            files.append(path)
+    sessions = []
+    for path in files:
+        if path.endswith('.tlm'):
+            sessions.append(telemetry.read_session(path)[1])
+        else:
+            sessions.append(telemetry.read_csv_session(path))
+    if not sessions:
+        raise ValueError('No telemetry files in %s' % ', '.join(paths))
+    return np.concatenate(sessions)
+
+
+def format_number(value):
+    return '%d' % value if float(value).is_integer() else '%.7g' % value
+
+
+def sensor_message(record):
+    '''The server's sensor string for one telemetry record, NUL-terminated like the original'''
+    groups = []
+    for tag in SERVER_TAGS:
+        value = record[tag]
+        if np.ndim(value):
+            text = ' '.join(format_number(v) for v in np.nan_to_num(value))
+        else:
+            text = format_number(np.nan_to_num(value))
+        groups.append('(%s %s)' % (tag, text))
+    return (''.join(groups) + '\x00').encode('ascii')
+
+
+class ReplayServer(object):
+    '''
+    Replays sensor messages to one client on a UDP port and measures how fast
+    it answers
+    '''
+
+    def __init__(self, messages, port=3001, rate=50.0, deadline=0.010, restart_at=(), shutdown_at=None,
+                 replies=None):
+        '''Constructor, rate is ticks per second (0 runs as fast as the client answers),
+        restart_at are ticks to send ***restart*** at and replies a CSV file to record to'''
+        self.messages = messages
+        self.port = port
+        self.rate = rate
+        self.deadline = deadline
+        self.restart_at = set(restart_at)
+        self.shutdown_at = shutdown_at if shutdown_at is not None else len(messages)
+        self.replies = replies
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', port))
+        self.client = None
+        self.latencies = []   # seconds from send to reply, for ticks answered in time
+        self.missed = 0       # ticks without a reply before the deadline
+        self.late = 0         # replies that arrived after their deadline
+        self.restarts = 0
+
+    def wait_for_client(self, timeout=None):
+        '''Wait for an init message and answer ***identified***; False on timeout'''
+        self.sock.settimeout(timeout)
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except socket.timeout:
+                return False
+            if b'(init' in data:
+                self.client = addr
+                self.sock.sendto(b'***identified***', addr)
+                print('Client identified:', data.split(b'(init')[0].decode('ascii', 'replace'), addr)
+                return True
+
+    def restart(self, reason):
+        print('Restart at tick', reason)
+        self.restarts += 1
+        self.sock.sendto(b'***restart***', self.client)
+        if not self.wait_for_client(timeout=5.0):
+            print('Client did not come back after the restart')
+            return False
+        return True
+
+    def drain_late(self):
+        '''Count control replies that arrived after their tick's deadline; an init message
+        (the client restarted on its own) is answered, anything else is ignored'''
+        self.sock.settimeout(0.0)
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except (BlockingIOError, socket.timeout):
+                return
+            if b'(init' in data:
+                self.client = addr
+                self.sock.sendto(b'***identified***', addr)
+            elif CONTROL_TAG in data:
+                self.late += 1
+
+    def tick(self, index, writer):
+        '''Send one sensor message and wait up to the deadline for the reply.
+        Returns the reply, or None if the deadline passed.'''
+        self.drain_late()
+        sent = time.perf_counter()
+        self.sock.sendto(self.messages[index], self.client)
+        reply = None
+        while reply is None:
+            remaining = sent + self.deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            self.sock.settimeout(remaining)
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except socket.timeout:
+                break
+            if b'(init' in data:
+                # The client restarted on its own, identify it again
+                self.client = addr
+                self.sock.sendto(b'***identified***', addr)
+                continue
+            if CONTROL_TAG in data:
+                reply = data
+        latency = time.perf_counter() - sent
+        if reply is None:
+            self.missed += 1
+        else:
+            self.latencies.append(latency)
+        if writer is not None:
+            writer.writerow([index, f'{latency * 1000:.3f}' if reply is not None else '',
+                             reply.decode('ascii', 'replace') if reply is not None else ''])
+        return reply
+
+    def run(self):
+        print(f'Replay server on port {self.port}: {self.shutdown_at} ticks at '
+              + (f'{self.rate:g} Hz' if self.rate else 'full speed'))
+        self.wait_for_client()
+        f = open(self.replies, 'w', newline='') if self.replies else None
+        writer = csv.writer(f) if f else None
+        if writer:
+            writer.writerow(['tick', 'latency_ms', 'reply'])
+        try:
+            start = time.perf_counter()
+            for index in range(self.shutdown_at):
+                if self.rate:
+                    # Fixed schedule from the start, a slow tick does not shift the later ones
+                    delay = start + index / self.rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                reply = self.tick(index % len(self.messages), writer)
+                if index in self.restart_at or (reply is not None and b'(meta 1)' in reply):
+                    if not self.restart(index):
+                        break
+                    start = time.perf_counter() - (index + 1) / self.rate if self.rate else start
+            else:
+                self.sock.sendto(b'***shutdown***', self.client)
+        finally:
+            if f:
+                f.close()
+            self.sock.close()
+        self.print_report()
+
+    def print_report(self):
+        ticks = len(self.latencies) + self.missed
+        print('Ticks sent:', ticks, '| restarts:', self.restarts)
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000
+            print(f'Response latency: p50 {np.percentile(latencies, 50):.3f} ms, '
+                  f'p99 {np.percentile(latencies, 99):.3f} ms, max {latencies.max():.3f} ms')
+        print(f'Missed deadlines ({self.deadline * 1000:g} ms): {self.missed} of {ticks}, '
+              f'late replies: {self.late}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay telemetry logs as a stand-in SCR server.')
+    parser.add_argument('logs', nargs='+', help='Telemetry files (.tlm or .csv) or directories')
+    parser.add_argument('--port', action='store', type=int, dest='port', default=3001,
+                        help='UDP port to listen on (default: 3001)')
+    parser.add_argument('--rate', action='store', type=float, dest='rate', default=50.0,
+                        help='Ticks per second, 0 for as fast as the client answers (default: 50)')
+    parser.add_argument('--deadline', action='store', type=float, dest='deadline', default=10.0,
+                        help='Milliseconds to wait for each reply (default: 10)')
+    parser.add_argument('--ticks', action='store', type=int, dest='ticks', default=None,
+                        help='Ticks before ***shutdown***, the log repeats if needed (default: the log length)')
+    parser.add_argument('--restart-at', action='store', type=int, nargs='*', dest='restart_at', default=[],
+                        help='Ticks after which to send ***restart***')
+    parser.add_argument('--replies', action='store', dest='replies', default=None,
+                        help='CSV file to record every tick\'s latency and reply to')
+    arguments = parser.parse_args(argv)
+
+    records = load_records(arguments.logs)
+    messages = [sensor_message(record) for record in records]
+    server = ReplayServer(messages, arguments.port, arguments.rate, arguments.deadline / 1000.0,
+                          arguments.restart_at, arguments.ticks, arguments.replies)
+    server.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
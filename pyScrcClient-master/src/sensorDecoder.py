@@ -0,0 +1,124 @@
+import re
+import numpy as np
+
+# Model input layout used by the drivers: (sensor tag, number of values) in input order
+DRIVER_LAYOUT = (
+    ('angle', 1),
+    ('distFromStart', 1),
+    ('distRaced', 1),
+    ('fuel', 1),
+    ('gear', 1),
+    ('opponents', 36),
+    ('racePos', 1),
+    ('rpm', 1),
+    ('speedX', 1),
+    ('speedY', 1),
+    ('speedZ', 1),
+    ('track', 19),
+    ('trackPos', 1),
+    ('wheelSpinVel', 4),
+    ('z', 1),
+)
+
+_TAG = re.compile(rb'\(([A-Za-z]+)')
+_CLOSE = bytes.maketrans(b')', b' ')
+
+
+def expand_layout(layout):
+    '''Turn (tag, count) pairs into one (tag, element) pair per model input'''
+    slots = []
+    for tag, count in layout:
+        for i in range(count):
+            slots.append((tag, i))
+    return slots
+
+
+class SensorDecoder(object):
+    '''
+    Decodes a raw UDP sensor message in one pass into a reusable float32
+    feature vector laid out in model input order
+    '''
+
+    def __init__(self, layout=DRIVER_LAYOUT, slots=None):
+        '''Constructor, slots is an explicit (tag, element) list that overrides layout'''
+        self.slots = list(slots) if slots is not None else expand_layout(layout)
+        self.features = np.zeros(len(self.slots), dtype=np.float32)
+        self.values = None      # every number of the last message, in wire order
+        self.offsets = {}       # tag -> (start, stop) into self.values
+        self.signature = None   # (tag count, value count) the gather plan was built for
+        self.gather = None      # self.values index of every feature slot
+
+    def decode(self, data):
+        '''Decode a sensor message (bytes, bytearray, memoryview or str) into self.features'''
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        # Drop the '(tag' prefixes and closing brackets so the numbers can be read in one C call
+        text, tags = _TAG.subn(b' ', data)
+        if tags == 0:
+            raise ValueError('No sensor values in message')
+        self.values = np.fromstring(text.translate(_CLOSE, b'\x00'), dtype=np.float64, sep=' ')
+
+        # The server always sends the same tags in the same order, so the plan only
+        # needs rebuilding when the shape of the message changes
+        if self.signature != (tags, self.values.size):
+            self.build_plan(data)
+            self.signature = (tags, self.values.size)
+
+        np.take(self.values, self.gather, out=self.features)
+        return self.features
+
+    def build_plan(self, data):
+        '''Work out where every tag's values sit in the message and map them to feature slots'''
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self.offsets = {}
+        start = 0
+        for match in _TAG.finditer(data):
+            close = data.find(b')', match.end())
+            if close < 0:
+                raise ValueError('Unterminated sensor group: %r' % data[match.start():])
+            count = len(data[match.end():close].split())
+            self.offsets[match.group(1).decode('ascii')] = (start, start + count)
+            start += count
+        if start != self.values.size:
+            raise ValueError('Could not read every sensor value in message')
+
+        gather = np.empty(len(self.slots), dtype=np.intp)
+        for i, (tag, element) in enumerate(self.slots):
+            if tag not in self.offsets:
+                raise ValueError('Sensor %s missing from message' % tag)
+            first, stop = self.offsets[tag]
+            if first + element >= stop:
+                raise ValueError('Sensor %s has %d values, expected at least %d'
+                                 % (tag, stop - first, element + 1))
+            gather[i] = first + element
+        self.gather = gather
+
+    def slot(self, tag, element=0):
+        '''Feature index of a sensor value, or None if the layout does not use it'''
+        try:
+            return self.slots.index((tag, element))
+        except ValueError:
+            return None
+
+    def getList(self, tag):
+        '''View of a sensor's values from the last message (no copy)'''
+        try:
+            start, stop = self.offsets[tag]
+        except KeyError:
+            return None
+        return self.values[start:stop]
+
+    def getFloat(self, tag):
+        try:
+            start, stop = self.offsets[tag]
+        except KeyError:
+            return None
+        return float(self.values[start])
+
+    def getInt(self, tag):
+        try:
+            start, stop = self.offsets[tag]
+        except KeyError:
+            return None
+        return int(self.values[start])
@@ -0,0 +1,315 @@
+import os
+import csv
+import json
+import glob
+import queue
+import atexit
+import threading
+import numpy as np
+
+# Column order of the telemetry CSV files
+CSV_FIELDS = [
+    'timestamp', 'angle', 'curLapTime', 'damage', 'distFromStart',
+    'distRaced', 'fuel', 'gear', 'lastLapTime', 'racePos', 'rpm',
+    'speedX', 'speedY', 'speedZ', 'trackPos', 'z', 'opponents', 'wheelSpinVel', 'focus', 'track',
+    'accel_input', 'brake_input', 'clutch_input', 'steer_input', 'gear_input',
+    'key_w', 'key_s', 'key_a', 'key_d'
+]
+
+# Header of the CSV files written before clutch was logged
+LEGACY_CSV_FIELDS = [name for name in CSV_FIELDS if name != 'clutch_input']
+
+# Row order of the CSV files written before the columns were fixed: the legacy
+# header, but each row had z after track
+LEGACY_CSV_ROW_FIELDS = [name for name in LEGACY_CSV_FIELDS if name != 'z']
+LEGACY_CSV_ROW_FIELDS.insert(LEGACY_CSV_ROW_FIELDS.index('track') + 1, 'z')
+
+# One binary telemetry record per tick, same fields as the CSV
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('angle', '<f4'),
+    ('curLapTime', '<f8'),
+    ('damage', '<f4'),
+    ('distFromStart', '<f8'),
+    ('distRaced', '<f8'),
+    ('fuel', '<f4'),
+    ('gear', '<i1'),
+    ('lastLapTime', '<f8'),
+    ('racePos', '<i2'),
+    ('rpm', '<f4'),
+    ('speedX', '<f4'),
+    ('speedY', '<f4'),
+    ('speedZ', '<f4'),
+    ('trackPos', '<f4'),
+    ('z', '<f4'),
+    ('opponents', '<f4', (36,)),
+    ('wheelSpinVel', '<f4', (4,)),
+    ('focus', '<f4', (5,)),
+    ('track', '<f4', (19,)),
+    ('accel_input', '<f4'),
+    ('brake_input', '<f4'),
+    ('clutch_input', '<f4'),
+    ('steer_input', '<f4'),
+    ('gear_input', '<i1'),
+    ('key_w', 'u1'),
+    ('key_s', 'u1'),
+    ('key_a', 'u1'),
+    ('key_d', 'u1'),
+])
+
+# Binary file layout: MAGIC, uint32 header length, JSON header padded so the
+# records start on a HEADER_ALIGN boundary, then packed RECORD_DTYPE records
+MAGIC = b'TORCSTLM'
+HEADER_ALIGN = 64
+BINARY_VERSION = 2  # 1 had no clutch_input, read_session() fills it with NaN
+
+
+class TelemetryWriter(object):
+    '''
+    Appends telemetry rows to a CSV file from a background thread, so the
+    control loop only puts a tuple on a bounded queue and never touches the disk
+    '''
+
+    file_mode = 'a'
+
+    def __init__(self, filename, fieldnames=CSV_FIELDS, max_queue=4096, batch_size=256, flush_interval=0.5):
+        '''Constructor, writes the header straight away'''
+        self.filename = filename
+        self.fieldnames = list(fieldnames)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0   # rows lost because the queue was full
+        self.written = 0   # rows written to the file
+        self.closed = False
+
+        self.write_header()
+
+        self.thread = threading.Thread(target=self.run, name='telemetry-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write_header(self):
+        with open(self.filename, 'w', newline='') as csvfile:
+            csv.writer(csvfile).writerow(self.fieldnames)
+
+    def write_rows(self, f, rows):
+        '''Append a batch of rows, called on the writer thread'''
+        csv.writer(f).writerows([format_value(v) for v in row] for row in rows)
+
+    def write(self, row):
+        '''Queue one row (a tuple in fieldnames order), dropping it if the writer is behind'''
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=5.0):
+        '''Block until every row queued so far is on disk'''
+        if self.closed:
+            return True
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=5.0):
+        '''Write out the remaining rows and stop the writer thread'''
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def run(self):
+        '''Writer thread: collect rows into batches and append them to the file'''
+        newline = '' if 'b' not in self.file_mode else None
+        with open(self.filename, self.file_mode, newline=newline) as f:
+            running = True
+            while running:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    continue
+                rows = []
+                waiting = []
+                while True:
+                    if item is None:
+                        running = False
+                    elif isinstance(item, threading.Event):
+                        waiting.append(item)
+                    else:
+                        rows.append(item)
+                    if not running or len(rows) >= self.batch_size:
+                        break
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if rows:
+                    self.write_rows(f, rows)
+                    self.written += len(rows)
+                f.flush()
+                if waiting:
+                    os.fsync(f.fileno())
+                    for done in waiting:
+                        done.set()
+
+
+class BinaryTelemetryWriter(TelemetryWriter):
+    '''
+    Same queue and writer thread as TelemetryWriter, but appends fixed-size
+    RECORD_DTYPE records to a binary file that read_session() can memory-map
+    '''
+
+    file_mode = 'ab'
+
+    def __init__(self, filename, angles=None, max_queue=4096, batch_size=256, flush_interval=0.5):
+        '''Constructor, angles are the rangefinder angles sent in the init message'''
+        self.angles = list(angles) if angles is not None else None
+        self.chunk = np.zeros(batch_size, dtype=RECORD_DTYPE)
+        TelemetryWriter.__init__(self, filename, RECORD_DTYPE.names, max_queue, batch_size, flush_interval)
+
+    def write_header(self):
+        write_binary_header(self.filename, self.angles)
+
+    def write_rows(self, f, rows):
+        chunk = self.chunk[:len(rows)]
+        for i, row in enumerate(rows):
+            try:
+                chunk[i] = row
+            except (TypeError, ValueError):
+                # Missing or malformed sensors are stored as NaN (0 for integer fields)
+                for name, value in zip(RECORD_DTYPE.names, row):
+                    try:
+                        chunk[name][i] = value
+                    except (TypeError, ValueError):
+                        chunk[name][i] = np.nan if RECORD_DTYPE[name].base.kind == 'f' else 0
+        f.write(chunk.tobytes())
+
+
+def format_value(value):
+    '''Sensor arrays are written as plain lists so the CSV format stays the same'''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+def write_binary_header(path, angles=None):
+    '''Start a binary telemetry file: magic, header length and the JSON schema header'''
+    header = json.dumps({
+        'version': BINARY_VERSION,
+        'dtype': [list(field) for field in RECORD_DTYPE.descr],
+        'angles': angles,
+    }).encode('utf-8')
+    size = len(MAGIC) + 4 + len(header)
+    header += b' ' * (-size % HEADER_ALIGN)
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint32(len(header)).tobytes())
+        f.write(header)
+
+
+def write_session(path, records, angles=None):
+    '''Write a record array (e.g. from load_sessions) as one binary telemetry file'''
+    write_binary_header(path, angles)
+    with open(path, 'ab') as f:
+        f.write(np.ascontiguousarray(records, dtype=RECORD_DTYPE).tobytes())
+
+
+def read_header(path):
+    '''Return (header dict, byte offset of the first record) of a binary telemetry file'''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a binary telemetry file' % path)
+        size = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+        header = json.loads(f.read(size).decode('utf-8'))
+    if header.get('version') not in (1, BINARY_VERSION):
+        raise ValueError('%s has unsupported version %s' % (path, header.get('version')))
+    return header, len(MAGIC) + 4 + size
+
+
+def read_session(path):
+    '''Memory-map a binary telemetry file: (header, structured record array).
+    Columns such as records['speedX'] or records['track'] are views, nothing is copied.
+    Files of an older version are copied into RECORD_DTYPE records instead.'''
+    header, offset = read_header(path)
+    dtype = np.dtype([tuple(field) for field in header['dtype']])
+    count = (os.path.getsize(path) - offset) // dtype.itemsize  # ignores a torn last record
+    if count == 0:
+        records = np.zeros(0, dtype=dtype)
+    else:
+        records = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+    if dtype != RECORD_DTYPE:
+        records = upgrade_records(records)
+    return header, records
+
+
+def upgrade_records(records):
+    '''Copy records of an older layout into RECORD_DTYPE, fields they lack become NaN or 0'''
+    upgraded = np.zeros(len(records), dtype=RECORD_DTYPE)
+    for name in RECORD_DTYPE.names:
+        if name in records.dtype.names:
+            upgraded[name] = records[name]
+        elif RECORD_DTYPE[name].base.kind == 'f':
+            upgraded[name] = np.nan
+    return upgraded
+
+
+def csv_columns(header, rows):
+    '''Column index of every field of a CSV telemetry file. Legacy files have the
+    LEGACY_CSV_FIELDS header but LEGACY_CSV_ROW_FIELDS rows, which shows as a sensor
+    array ('[...]') under the 'z' header; those are mapped by position'''
+    columns = {name: i for i, name in enumerate(header)}
+    if rows and header == LEGACY_CSV_FIELDS:
+        first = rows[0]
+        z, track = columns['z'], columns['track']
+        if len(first) > track and first[z].lstrip().startswith('[') and not first[track].lstrip().startswith('['):
+            return {name: i for i, name in enumerate(LEGACY_CSV_ROW_FIELDS)}
+    return columns
+
+
+def read_csv_session(path):
+    '''Read a CSV telemetry file into a RECORD_DTYPE array, so CSV and binary
+    sessions can be used the same way (missing values become NaN or 0)'''
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        rows = list(reader)
+    columns = csv_columns(header, rows)
+    records = np.zeros(len(rows), dtype=RECORD_DTYPE)
+    for name in RECORD_DTYPE.names:
+        field = RECORD_DTYPE[name]
+        missing = np.nan if field.base.kind == 'f' else 0
+        column = records[name]
+        index = columns.get(name)
+        for i, row in enumerate(rows):
+            value = row[index].strip() if index is not None and index < len(row) else ''
+            try:
+                if field.shape:
+                    # Sensor arrays are written as '[1.0, 2.0, ...]'
+                    values = np.array(value.strip('[]').split(','), dtype=np.float64)
+                    column[i, :values.size] = values[:field.shape[0]]
+                    column[i, values.size:] = missing
+                else:
+                    column[i] = float(value)
+            except ValueError:
+                column[i] = missing
+    return records
+
+
+def load_sessions(directory, pattern='*.tlm'):
+    '''All binary sessions of a directory as one record array (this copies once)'''
+    paths = sorted(glob.glob(os.path.join(directory, pattern)))
+    sessions = [read_session(path)[1] for path in paths]
+    if not sessions:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.concatenate(sessions)
+
+
+def feature_matrix(records, schema):
+    '''(ticks, features) float32 model inputs in the order of a FeatureSchema'''
+    x = np.empty((len(records), len(schema)), dtype=np.float32)
+    for i, (tag, element) in enumerate(schema.slots):
+        column = records[tag]
+        x[:, i] = column[:, element] if column.ndim > 1 else column
+    return x
@@ -0,0 +1,102 @@
+'''
+Microbenchmark of one TFLite inference tick, the way the driver used to run it
+(set_tensor / get_tensor, which check and copy the arrays) against the tensor()
+views inferenceBackend.TFLiteBackend uses, for one or more interpreter thread
+counts. Also times the first invoke() of a fresh interpreter, the cost warm-up
+moves out of the first racing tick.
+
+    python tfliteBench.py ../models/model_driver.tflite --ticks 5000 --threads 1 2 4
+'''
+import sys
+import time
+import argparse
+import numpy as np
+import modelRuntime
+
+
+def tick_copy(interpreter, row):
+    '''One tick through set_tensor / get_tensor'''
+    interpreter.set_tensor(interpreter.get_input_details()[0]['index'], row)
+    interpreter.invoke()
+    return interpreter.get_tensor(interpreter.get_output_details()[0]['index'])[0]
+
+
+def tick_view(interpreter, row, input_tensor, output_tensor):
+    '''One tick through tensor() views of the interpreter's own buffers'''
+    input_tensor()[0] = row[0]
+    interpreter.invoke()
+    return output_tensor()[0]
+
+
+def time_ticks(run, rows):
+    '''Microseconds per call of run(row) over all rows'''
+    elapsed = np.empty(len(rows))
+    for i, row in enumerate(rows):
+        t = time.perf_counter_ns()
+        run(row)
+        elapsed[i] = time.perf_counter_ns() - t
+    return elapsed / 1000.0
+
+
+def first_invoke(path, num_threads, row):
+    '''Microseconds of the first and of the second invoke of a fresh interpreter'''
+    interpreter = modelRuntime.tflite_interpreter(path, num_threads)
+    index = interpreter.get_input_details()[0]['index']
+    times = []
+    for _ in range(2):
+        interpreter.set_tensor(index, row)
+        t = time.perf_counter_ns()
+        interpreter.invoke()
+        times.append((time.perf_counter_ns() - t) / 1000.0)
+    return times
+
+
+def print_times(name, micros):
+    print(f'  {name:8s} p50 {np.percentile(micros, 50):8.1f} us  p99 {np.percentile(micros, 99):8.1f} us  '
+          f'mean {micros.mean():8.1f} us')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time TFLite inference ticks with and without tensor() views.')
+    parser.add_argument('model', help='TFLite model file')
+    parser.add_argument('--ticks', action='store', type=int, dest='ticks', default=5000,
+                        help='Timed ticks per variant (default: 5000)')
+    parser.add_argument('--threads', action='store', type=int, nargs='+', dest='threads', default=[None],
+                        help='Interpreter thread counts to compare (default: the runtime\'s choice)')
+    arguments = parser.parse_args(argv)
+
+    for num_threads in arguments.threads:
+        interpreter = modelRuntime.tflite_interpreter(arguments.model, num_threads)
+        details = interpreter.get_input_details()[0]
+        rng = np.random.default_rng(0)
+        rows = rng.standard_normal((arguments.ticks, 1, details['shape'][-1])).astype(details['dtype'])
+        first, second = first_invoke(arguments.model, num_threads, rows[0])
+
+        input_tensor = interpreter.tensor(details['index'])
+        output_tensor = interpreter.tensor(interpreter.get_output_details()[0]['index'])
+        # Both variants must give the same outputs
+        if not np.array_equal(tick_copy(interpreter, rows[0]),
+                              tick_view(interpreter, rows[0], input_tensor, output_tensor)):
+            print('tensor() views give different outputs')
+            return 1
+
+        # Warm up, then alternate the variants so both see the same CPU conditions
+        for row in rows[:100]:
+            tick_copy(interpreter, row)
+        copy, view = [], []
+        for start in range(0, arguments.ticks, 500):
+            chunk = rows[start:start + 500]
+            copy.append(time_ticks(lambda row: tick_copy(interpreter, row), chunk))
+            view.append(time_ticks(lambda row: tick_view(interpreter, row, input_tensor, output_tensor), chunk))
+        copy, view = np.concatenate(copy), np.concatenate(view)
+
+        print(f'threads={num_threads if num_threads is not None else "default"}: '
+              f'first invoke {first:.1f} us, second {second:.1f} us')
+        print_times('copy', copy)
+        print_times('view', view)
+        print(f'  saved    {np.median(copy) - np.median(view):.1f} us per tick (p50)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+'''
+UDP receive helpers shared by the clients
+'''
+import time
+import socket
+import udpCapture
+import clientLog
+
+log = clientLog.get_logger('udpLink')
+
+
+def is_control(buf):
+    '''True for the server's ***restart*** / ***shutdown*** messages'''
+    return b'***shutdown***' in buf or b'***restart***' in buf
+
+
+# Room for the longest sensor message (about 1.2 KB with every sensor and 36 opponents)
+DEFAULT_BUFSIZE = 4096
+
+# Windows reports a datagram larger than the buffer as an error instead of truncating it
+WSAEMSGSIZE = 10040
+
+
+class DatagramReceiver(object):
+    '''
+    Receives datagrams with recv_into preallocated buffers, so a tick does not
+    allocate bytes or str objects. The memoryview returned by recv() is only valid
+    until the next call.
+    '''
+
+    def __init__(self, sock, bufsize=DEFAULT_BUFSIZE, rcvbuf=None):
+        '''Constructor, rcvbuf sets the socket's SO_RCVBUF (None keeps the OS default)'''
+        self.sock = sock
+        self.bufsize = bufsize
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        # One spare byte: a datagram that reaches it was longer than bufsize. Two buffers:
+        # receive_latest() reads newer datagrams into the one not holding the frame it keeps
+        self.buffers = [bytearray(bufsize + 1) for _ in range(2)]
+        self.views = [memoryview(b) for b in self.buffers]
+        self.current = 0
+        self.buffer, self.view = self.buffers[0], self.views[0]
+        self.size = 0
+        self.truncated = 0  # datagrams dropped because they did not fit
+        self.capture = None  # udpCapture.CaptureWriter that records every datagram
+        self.received_at = 0  # time.perf_counter_ns() when the frame receive_latest() returned arrived
+
+    def recv(self):
+        '''Receive one datagram, None (and a warning) if it did not fit in the buffer'''
+        try:
+            self.size = self.sock.recv_into(self.buffer)
+        except OSError as e:
+            if getattr(e, 'winerror', None) != WSAEMSGSIZE:
+                raise
+            self.size = len(self.buffer)
+        if self.size > self.bufsize:
+            self.size = 0
+            self.truncated += 1
+            log.warning('Dropped a datagram longer than the %d byte receive buffer (%d so far), '
+                        'increase the buffer size', self.bufsize, self.truncated)
+            return None
+        if self.capture is not None:
+            self.capture.write(udpCapture.INBOUND, self.view[:self.size])
+        return self.view[:self.size]
+
+    def contains(self, token):
+        '''True if the last datagram contains token, without copying it'''
+        return self.buffer.find(token, 0, self.size) >= 0
+
+    def is_control(self):
+        return self.contains(b'***shutdown***') or self.contains(b'***restart***')
+
+    def use_buffer(self, index, size):
+        self.current = index
+        self.buffer, self.view = self.buffers[index], self.views[index]
+        self.size = size
+
+    def receive_latest(self):
+        '''Wait for a datagram, then drain the socket without blocking and keep only the newest.
+        Returns (datagram or None, number of stale frames skipped). A datagram too long for
+        the buffer does not replace the newest valid one. A restart or shutdown message ends
+        the drain, so it is never skipped even in the middle of a burst.'''
+        data = self.recv()
+        self.received_at = time.perf_counter_ns()
+        skipped = 0
+        if data is not None and self.is_control():
+            return data, skipped
+        timeout = self.sock.gettimeout()
+        self.sock.settimeout(0.0)
+        try:
+            while True:
+                kept, size = self.current, self.size
+                if data is not None:
+                    self.use_buffer(1 - kept, 0)  # read the next one without overwriting data
+                newer = None
+                try:
+                    newer = self.recv()
+                except (BlockingIOError, socket.timeout):
+                    break
+                finally:
+                    if newer is None:
+                        # Drained, truncated or failed: keep the last valid frame
+                        self.use_buffer(kept, size)
+                skipped += 1
+                if newer is None:
+                    continue
+                self.received_at = time.perf_counter_ns()
+                data = newer
+                if self.is_control():
+                    break
+        finally:
+            self.sock.settimeout(timeout)
+        return data, skipped